@@ -7,6 +7,20 @@
 
 from __future__ import division, print_function
 
-from .elastix_interface import ElastixInterface
+from .elastix_interface import ElastixInterface, RegistrationResult
 from .transformix_interface import TransformixInterface
-from .log_files import logfile
+from .log_files import logfile, load_iteration_info, load_iteration_infos
+from .progress import IterationInfoTail, IterationRecord, LogLine
+from .early_stopping import EarlyStopping
+from .cache import RegistrationCache
+from .metaimage import MetaImage
+from .parameter_file import ParameterFile
+from .point_transform import TransformEvaluator
+from .transform_chain import collapse_chain, bake_chain, invert_chain
+from .atlas import AtlasSegmentation, fuse_labels
+from .job_queue import JobQueue
+from .sweep import Sweep
+from .resample import Resampler
+from .resources import ResourceGovernor
+from .instrumentation import Instrumentation, JsonLinesSink, PrometheusCounters
+from .cohort import Cohort, all_pairs, nearest_pairs
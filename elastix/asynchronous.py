@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+#
+# Asyncio support for running elastix and transformix. The `*_async`
+# methods of ElastixInterface and TransformixInterface are built on
+# `run_process`, which never blocks the event loop: the child's stderr is
+# read by the loop, and cancelling the awaiting task terminates the child.
+
+
+from __future__ import division, print_function
+
+import asyncio
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+# Seconds a cancelled child gets to exit after SIGTERM before it is killed
+TERMINATE_TIMEOUT = 5
+
+
+async def _run(command, call=None):
+    proc = await asyncio.create_subprocess_exec(
+        *command,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE)
+    if call is not None:
+        call.start(proc.pid)
+    try:
+        _, err = await proc.communicate()
+    except asyncio.CancelledError:
+        if proc.returncode is None:
+            logger.info('Cancelled, terminating child process {}'.format(proc.pid))
+            try:
+                proc.terminate()
+                await asyncio.wait_for(proc.wait(), TERMINATE_TIMEOUT)
+            except ProcessLookupError:
+                pass
+            except asyncio.TimeoutError:
+                proc.kill()
+                await proc.wait()
+        raise
+    return proc.returncode, err
+
+
+async def run_process(command, semaphore=None, call=None):
+    """
+    Run `command` without blocking the event loop and return its return
+    code and captured stderr. If a semaphore is given, it is held while
+    the process runs, which bounds the number of concurrent processes.
+    `call` is an `instrumentation.Call` that is started once the process
+    is; the caller finishes it. The loop reaps the child, so its resource
+    usage is not available.
+    """
+    logger.info('Started command ' + ' '.join(command))
+    if semaphore is not None:
+        async with semaphore:
+            returncode, err = await _run(command, call)
+    else:
+        returncode, err = await _run(command, call)
+    logger.info('Finished command ' + ' '.join(command))
+    return returncode, err
+
+
+class _Handoff(object):
+    """
+    Hands an allocation from the thread that waits for it to the task
+    that awaits it, or back to the governor if the task was cancelled.
+    """
+    def __init__(self, governor):
+        self.governor = governor
+        self.allocation = None
+        self.abandoned = False
+        self.lock = threading.Lock()
+
+    def acquire(self, threads, memory):
+        allocation = self.governor.acquire(threads, memory)
+        with self.lock:
+            if self.abandoned:
+                self.governor.release(allocation)
+            else:
+                self.allocation = allocation
+
+    def abandon(self):
+        with self.lock:
+            self.abandoned = True
+            if self.allocation is not None:
+                self.governor.release(self.allocation)
+                self.allocation = None
+
+
+async def acquire(governor, threads=None, memory=0):
+    """
+    Wait for an allocation of a `ResourceGovernor` without blocking the
+    event loop. If the awaiting task is cancelled, the allocation is
+    released as soon as the governor grants it, so it does not leak.
+    """
+    handoff = _Handoff(governor)
+    try:
+        await asyncio.get_running_loop().run_in_executor(
+            None, handoff.acquire, threads, memory)
+    except asyncio.CancelledError:
+        handoff.abandon()
+        raise
+    return handoff.allocation
+
+
+def lazy_semaphore(owner, limit):
+    """
+    Return the asyncio semaphore of `owner` that bounds its concurrent
+    processes to `limit`, creating it on first use (i.e. inside the event
+    loop). Returns None if there is no limit.
+    """
+    if not limit:
+        return None
+    if getattr(owner, '_async_semaphore', None) is None:
+        owner._async_semaphore = asyncio.Semaphore(limit)
+    return owner._async_semaphore
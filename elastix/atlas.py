@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+#
+# Multi-atlas segmentation: register N atlases to a target image, warp
+# their label maps with nearest neighbour interpolation, and fuse the
+# warped labels into a single segmentation.
+#
+# Registrations and label warps run concurrently. Fusion streams over the
+# memory-mapped label volumes slab by slab, so memory use does not grow
+# with the size of the volumes, only (linearly) with the number of atlases.
+
+
+from __future__ import division, print_function
+
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from . import metaimage
+from .elastix_interface import (ElastixInterface, ElastixError,
+                                DEFAULT_ELASTIX_PATH)
+from .transformix_interface import (TransformixInterface,
+                                    DEFAULT_TRANSFORMIX_PATH)
+from .resources import available_cores
+from .transform_parameter_editor import TransformParameterFileEditor
+
+logger = logging.getLogger(__name__)
+
+
+# Number of votes (voxels times candidate labels) held in memory at once
+# during label fusion
+FUSION_CHUNK_SIZE = 1 << 22
+
+
+def _volume(image):
+    """Accept a path, a MetaImage or an array, and return an array."""
+    if isinstance(image, str):
+        image = metaimage.MetaImage(image)
+    if isinstance(image, metaimage.MetaImage):
+        return image.data
+    return image
+
+
+def _slabs(shape, candidates, chunk_size):
+    slice_size = int(np.prod(shape[1:]))
+    step = max(1, chunk_size // max(slice_size * candidates, 1))
+    for start in range(0, shape[0], step):
+        yield slice(start, min(start + step, shape[0]))
+
+
+def find_labels(label_maps, chunk_size=FUSION_CHUNK_SIZE):
+    """Sorted array of all labels that occur in any of the label maps."""
+    volumes = [_volume(m) for m in label_maps]
+    labels = np.empty(0, dtype=volumes[0].dtype)
+    for volume in volumes:
+        for index in _slabs(volume.shape, 1, chunk_size):
+            labels = np.union1d(labels, np.unique(volume[index]))
+    return labels
+
+
+def _label_dtype(labels):
+    dtype = np.min_scalar_type(int(labels.max())) if labels.size else np.uint8
+    if labels.size and labels.min() < 0:
+        dtype = np.promote_types(dtype, np.min_scalar_type(int(labels.min())))
+    return np.dtype(dtype)
+
+
+def fuse_labels(label_maps, output_path, weights=None, target=None,
+                images=None, sigma=None, labels=None,
+                chunk_size=FUSION_CHUNK_SIZE):
+    """
+    Fuse warped label maps by (weighted) voting.
+
+    Without weights this is majority voting. `weights` holds one global
+    weight per atlas, e.g. derived from the final registration metric. If
+    the warped atlas `images` and the `target` image are given as well,
+    votes are additionally weighted locally by intensity similarity,
+    exp(-(image - target)^2 / (2 sigma^2)). Ties go to the lowest label.
+
+    Args:
+        label_maps: (list) Warped label maps: paths, MetaImages or arrays
+                    of the same shape.
+        output_path: (str) Path of the fused MetaImage (.mhd).
+        weights: (sequence) Optional weight of every atlas.
+        target: Target image for local weighting.
+        images: (list) Warped atlas images for local weighting.
+        sigma: (float) Intensity scale of local weighting. Defaults to the
+               standard deviation of the first slab of the target.
+        labels: (sequence) The labels to vote for. Found by a first pass
+                over the label maps if not given; voxels with other labels
+                do not vote.
+        chunk_size: (int) Number of votes held in memory at once.
+
+    Returns:
+        The fused segmentation as a `MetaImage`.
+    """
+    volumes = [_volume(m) for m in label_maps]
+    if not volumes:
+        raise ValueError('No label maps to fuse')
+    shape = volumes[0].shape
+    for volume in volumes[1:]:
+        if volume.shape != shape:
+            raise ValueError('Label maps differ in shape: {} and {}'.format(
+                shape, volume.shape))
+    if labels is None:
+        labels = find_labels(volumes, chunk_size)
+    labels = np.sort(np.asarray(labels))
+    if weights is None:
+        weights = np.ones(len(volumes))
+    weights = np.asarray(weights, dtype=float)
+    local = images is not None
+    if local:
+        if target is None:
+            raise ValueError('Local weighting needs the target image')
+        images = [_volume(i) for i in images]
+        target = _volume(target)
+
+    # The output geometry is taken from the first label map if it has one
+    geometry = {}
+    first = label_maps[0]
+    if isinstance(first, str):
+        first = metaimage.MetaImage(first)
+    if isinstance(first, metaimage.MetaImage):
+        geometry = dict(spacing=first.spacing, origin=first.origin,
+                        direction=first.direction)
+
+    dtype = _label_dtype(labels)
+    raw_path = os.path.splitext(output_path)[0] + '.raw'
+    fused = np.memmap(raw_path, dtype=dtype, mode='w+', shape=shape)
+
+    candidates = len(labels)
+    for index in _slabs(shape, max(candidates, len(volumes)), chunk_size):
+        stack = np.stack([v[index] for v in volumes]).reshape(len(volumes), -1)
+        voxels = stack.shape[1]
+        position = np.searchsorted(labels, stack)
+        valid = (position < candidates) & \
+            (labels[np.minimum(position, candidates - 1)] == stack)
+        votes = np.broadcast_to(weights[:, None], stack.shape)
+        if local:
+            reference = np.asarray(target[index], dtype=float).reshape(1, -1)
+            if sigma is None:
+                sigma = float(reference.std()) or 1.0
+            warped = np.stack([np.asarray(i[index], dtype=float).reshape(-1)
+                               for i in images])
+            votes = votes * np.exp(-(warped - reference) ** 2 /
+                                   (2.0 * sigma ** 2))
+        # One bin per (label, voxel) pair, so a single bincount tallies the
+        # votes of all atlases for the whole slab
+        bins = position * voxels + np.arange(voxels)
+        tally = np.bincount(bins[valid], weights=votes[valid],
+                            minlength=candidates * voxels)
+        winner = tally.reshape(candidates, voxels).argmax(axis=0)
+        fused[index] = labels[winner].reshape(fused[index].shape)
+    fused.flush()
+    metaimage.write_mhd(output_path, fused, data_file=raw_path, **geometry)
+    del fused
+    return metaimage.MetaImage(output_path)
+
+
+def nearest_neighbour_chain(transform_parameters, edits=None):
+    """
+    Write a nearest neighbour copy of a transform parameter file and of
+    all its initial transforms with `TransformParameterFileEditor`, for
+    warping label maps.
+
+    Args:
+        transform_parameters: (str) The last file of the chain, named
+                              TransformParameters.<n>.txt like elastix
+                              names them.
+        edits: (dict) Additional edits passed to the editor.
+
+    Returns:
+        The path of the edited copy of `transform_parameters`.
+    """
+    directory = os.path.dirname(transform_parameters)
+    last = int(os.path.basename(transform_parameters).split('.')[1])
+    path = None
+    for stage in range(last + 1):
+        path = os.path.join(directory,
+                            'TransformParameters_mask.{}.txt'.format(stage))
+        TransformParameterFileEditor(
+            os.path.join(directory, 'TransformParameters.{}.txt'.format(stage)),
+            path, edits=edits).modify_transform_parameter_file()
+    return path
+
+
+class AtlasSegmentation(object):
+    """
+    Multi-atlas segmentation of a target image.
+
+    >>> segmentation = AtlasSegmentation(['affine.txt', 'bspline.txt'],
+    ...                                  ELASTIX_PATH, TRANSFORMIX_PATH)
+    >>> atlases = [{'image': 'a0/image.mhd', 'labels': 'a0/labels.mhd'},
+    ...            {'image': 'a1/image.mhd', 'labels': 'a1/labels.mhd'}]
+    >>> fused = segmentation.segment('target.mhd', atlases, 'results')
+
+    Args:
+        parameters: (list) Elastix parameter files of the registration.
+        elastix_path, transformix_path: (str) Paths of the executables.
+        max_workers: (int) Number of registrations and warps that run at
+                     the same time.
+        threads_per_job: (int) Value of elastix' `-threads` option.
+        cache: (RegistrationCache) Optional cache of registration results.
+        label_edits: (dict) Additional edits of the nearest neighbour
+                     transform parameter files.
+    """
+
+    def __init__(self, parameters,
+                 elastix_path=DEFAULT_ELASTIX_PATH,
+                 transformix_path=DEFAULT_TRANSFORMIX_PATH,
+                 max_workers=None, threads_per_job=None, cache=None,
+                 label_edits=None):
+        self.parameters = list(parameters)
+        self.elastix = ElastixInterface(elastix_path, cache=cache)
+        self.transformix_path = transformix_path
+        self.max_workers = max_workers
+        self.threads_per_job = threads_per_job
+        self.label_edits = label_edits
+
+    def register(self, target_image, atlases, output_dir, target_mask=None):
+        """
+        Register every atlas image to the target, each in its own
+        subdirectory atlas_<i> of `output_dir`.
+
+        Returns:
+            A list of `RegistrationResult` objects in the order of
+            `atlases`.
+        """
+        jobs = []
+        for i, atlas in enumerate(atlases):
+            atlas_dir = os.path.join(output_dir, 'atlas_{}'.format(i))
+            if not os.path.exists(atlas_dir):
+                os.makedirs(atlas_dir)
+            jobs.append({'parameters': self.parameters,
+                         'fixed_image': target_image,
+                         'moving_image': atlas['image'],
+                         'fixed_mask': target_mask,
+                         'moving_mask': atlas.get('mask'),
+                         'output_dir': atlas_dir})
+        return self.elastix.register_many(jobs, self.max_workers,
+                                          self.threads_per_job)
+
+    def _transform(self, result):
+        return os.path.join(result.output_dir, 'TransformParameters.{}.txt'
+                            .format(len(self.parameters) - 1))
+
+    def _warp(self, result, atlas, images):
+        transform = self._transform(result)
+        labels_dir = os.path.join(result.output_dir, 'labels')
+        if not os.path.exists(labels_dir):
+            os.makedirs(labels_dir)
+        nearest = nearest_neighbour_chain(transform, self.label_edits)
+        labels = TransformixInterface(nearest, self.transformix_path) \
+            .transform_image(atlas['labels'], output_dir=labels_dir,
+                             verbose=False, load=True)
+        image = None
+        if images:
+            image_dir = os.path.join(result.output_dir, 'image')
+            if not os.path.exists(image_dir):
+                os.makedirs(image_dir)
+            image = TransformixInterface(transform, self.transformix_path) \
+                .transform_image(atlas['image'], output_dir=image_dir,
+                                 verbose=False, load=True)
+        return labels, image
+
+    def _try_warp(self, result, atlas, images):
+        try:
+            return self._warp(result, atlas, images)
+        except Exception as ex:
+            logger.warning('Warping atlas in {} failed: {}'.format(
+                result.output_dir, ex))
+            return None
+
+    def warp(self, results, atlases, images=False):
+        """
+        Warp the label maps (and, if `images` is True, the images) of the
+        atlases whose registration succeeded, concurrently.
+
+        Returns:
+            A list in the order of `atlases` of (labels, image) tuples of
+            `MetaImage` objects; image is None unless requested. Atlases
+            whose registration or warp failed are None; warp errors are
+            logged, not raised.
+        """
+        warped = [None] * len(atlases)
+        indices = [i for i, r in enumerate(results) if r.success]
+        if not indices:
+            return warped
+        workers = self.max_workers or available_cores()
+        with ThreadPoolExecutor(max_workers=min(workers, len(indices))) as executor:
+            futures = [(i, executor.submit(self._try_warp, results[i],
+                                           atlases[i], images))
+                       for i in indices]
+            for i, future in futures:
+                warped[i] = future.result()
+        return warped
+
+    def segment(self, target_image, atlases, output_dir, method='majority',
+                weights=None, target_mask=None, sigma=None, labels=None,
+                chunk_size=FUSION_CHUNK_SIZE):
+        """
+        Run the whole pipeline: registration, label warping and fusion.
+        Atlases whose registration or label warp fails are left out of the
+        fusion.
+
+        Args:
+            target_image: (str) The image to segment.
+            atlases: (list) Dicts with the 'image' and 'labels' of every
+                     atlas, and optionally its 'mask'.
+            output_dir: (str) Directory for all results. The fused labels
+                        are written to fused_labels.mhd.
+            method: (str) 'majority', 'weighted' (global `weights`, one per
+                    atlas) or 'local' (intensity-weighted voting, which
+                    requires `target_image` to be a MetaImage).
+            weights, sigma, labels, chunk_size: See `fuse_labels`.
+
+        Returns:
+            The fused segmentation as a `MetaImage`.
+        """
+        if method not in ('majority', 'weighted', 'local'):
+            raise ValueError('Unknown fusion method {}'.format(method))
+        if method == 'weighted' and weights is None:
+            raise ValueError('Weighted fusion needs a weight per atlas')
+        atlases = list(atlases)
+        results = self.register(target_image, atlases, output_dir, target_mask)
+        for result in results:
+            if not result.success:
+                logger.warning('Registration of atlas in {} failed: {}'.format(
+                    result.output_dir, result.error))
+        if not any(r.success for r in results):
+            raise ElastixError('All atlas registrations failed')
+
+        warped = self.warp(results, atlases, images=method == 'local')
+        succeeded = [i for i, w in enumerate(warped) if w is not None]
+        if not succeeded:
+            raise ElastixError('No atlas could be registered and warped')
+        warped = [warped[i] for i in succeeded]
+        if weights is not None:
+            weights = [weights[i] for i in succeeded]
+        return fuse_labels(
+            [warped_labels for warped_labels, _ in warped],
+            os.path.join(output_dir, 'fused_labels.mhd'),
+            weights=weights,
+            target=target_image if method == 'local' else None,
+            images=[image for _, image in warped] if method == 'local' else None,
+            sigma=sigma, labels=labels, chunk_size=chunk_size)
@@ -0,0 +1,15 @@
+#!/usr/bin/env python
+#
+# Reproducible benchmarks of registrations on synthetic image pairs with a
+# known deformation, and comparison of benchmark runs to catch
+# regressions across elastix versions, parameter files and changes to
+# this package. From the command line:
+#
+#   python -m elastix.benchmark run --elastix elastix \
+#       --transformix transformix -o results.json \
+#       example_data/parameters_*.txt
+#   python -m elastix.benchmark compare baseline.json results.json
+
+from .synthetic import SyntheticPair, generate_pair, deformation_error
+from .runner import run_benchmark, run_case, SIZES
+from .compare import compare, Difference
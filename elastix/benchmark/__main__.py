@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+#
+# Command line interface of the benchmark suite.
+
+
+from __future__ import division, print_function
+
+import argparse
+import glob
+import sys
+
+from ..elastix_interface import DEFAULT_ELASTIX_PATH
+from ..transformix_interface import DEFAULT_TRANSFORMIX_PATH
+from .compare import compare, format_differences
+from .runner import run_benchmark
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m elastix.benchmark',
+        description='Benchmark registrations on synthetic image pairs.')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    run = commands.add_parser('run', help='Run the benchmark')
+    run.add_argument('parameters', nargs='*',
+                     help='Parameter files (default: '
+                          'example_data/parameters_*.txt)')
+    run.add_argument('--elastix', default=DEFAULT_ELASTIX_PATH)
+    run.add_argument('--transformix', default=DEFAULT_TRANSFORMIX_PATH)
+    run.add_argument('-o', '--output', help='JSON file for the results')
+    run.add_argument('--sizes', type=int, nargs='+',
+                     help='Voxels per axis, for all dimensions')
+    run.add_argument('--dimensions', type=int, nargs='+', choices=(2, 3),
+                     help='Run every parameter file in these dimensions')
+    run.add_argument('--repeat', type=int, default=1)
+    run.add_argument('--threads', type=int, default=None,
+                     help='Value of elastix\' -threads option')
+    run.add_argument('--work-dir', help='Keep pairs and results here')
+    run.add_argument('--seed', type=int, default=0)
+
+    diff = commands.add_parser('compare', help='Compare two result files')
+    diff.add_argument('baseline')
+    diff.add_argument('current')
+    diff.add_argument('--tolerance', type=float, default=None,
+                      help='Relative tolerance of all metrics')
+    diff.add_argument('--all', action='store_true',
+                      help='Print all metrics, not only regressions')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'run':
+        parameters = args.parameters or \
+            sorted(glob.glob('example_data/parameters_*.txt'))
+        if not parameters:
+            parser.error('No parameter files given')
+        sizes = None
+        if args.sizes:
+            sizes = {2: args.sizes, 3: args.sizes}
+        run_benchmark(args.elastix, args.transformix, parameters, sizes,
+                      args.dimensions, args.repeat, args.threads,
+                      args.output, args.work_dir,
+                      keep=args.work_dir is not None, seed=args.seed)
+    elif args.command == 'compare':
+        differences = compare(args.baseline, args.current, args.tolerance)
+        regressions = [d for d in differences if d.regression]
+        report = format_differences(differences, args.all)
+        if report:
+            print(report)
+        print('{} regressions in {} comparisons'.format(
+            len(regressions), len(differences)))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
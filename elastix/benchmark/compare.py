@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+#
+# Comparison of two benchmark result files. Cases are matched by name,
+# and a metric is flagged as a regression when it got worse by more than
+# a relative tolerance and an absolute noise floor.
+
+
+from __future__ import division, print_function
+
+import json
+from collections import OrderedDict
+
+
+# Metrics that are compared: getter, relative tolerance and absolute noise
+# floor (differences below it are never flagged)
+METRICS = OrderedDict([
+    ('elastix_time', (lambda case: case.get('elastix_time'), 0.10, 0.05)),
+    ('transformix_time', (lambda case: case.get('transformix_time'),
+                          0.10, 0.05)),
+    ('peak_rss', (lambda case: case.get('peak_rss'), 0.10, 16 * 1024 ** 2)),
+    ('mean_error', (lambda case: case.get('accuracy', {}).get('mean_error'),
+                    0.10, 0.01)),
+])
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+class Difference(object):
+    """Change of one metric of one case between two benchmark runs."""
+    def __init__(self, case, metric, baseline, current, regression):
+        self.case = case
+        self.metric = metric
+        self.baseline = baseline
+        self.current = current
+        self.regression = regression
+
+    @property
+    def change(self):
+        """Relative change, or None if it is undefined."""
+        if self.baseline is None or self.current is None or not self.baseline:
+            return None
+        return self.current / self.baseline - 1.0
+
+    def __repr__(self):
+        return 'Difference({!r}, {!r}, {!r}, {!r}, regression={})'.format(
+            self.case, self.metric, self.baseline, self.current,
+            self.regression)
+
+
+def compare(baseline, current, tolerance=None):
+    """
+    Compare two benchmark results.
+
+    Args:
+        baseline, current: (dict or str) Results of `run_benchmark`, or
+                           the paths of their JSON files.
+        tolerance: (float) Relative tolerance of all metrics, instead of
+                   those in `METRICS`.
+
+    Returns:
+        A list of `Difference` objects for all metrics of all cases in
+        both results. A case that failed now but not before counts as a
+        regression; cases missing from either result are skipped.
+    """
+    if isinstance(baseline, str):
+        baseline = load_results(baseline)
+    if isinstance(current, str):
+        current = load_results(current)
+    before = OrderedDict((case['name'], case) for case in baseline['cases'])
+
+    differences = []
+    for case in current['cases']:
+        old = before.get(case['name'])
+        if old is None:
+            continue
+        if 'error' in case:
+            differences.append(Difference(case['name'], 'error', None,
+                                          case['error'], 'error' not in old))
+            continue
+        for metric, (get, relative, floor) in METRICS.items():
+            a, b = get(old), get(case)
+            if a is None or b is None:
+                continue
+            if tolerance is not None:
+                relative = tolerance
+            worse = b - a > max(relative * abs(a), floor)
+            differences.append(Difference(case['name'], metric, a, b, worse))
+    return differences
+
+
+def format_differences(differences, all_metrics=False):
+    lines = []
+    for d in differences:
+        if not (all_metrics or d.regression):
+            continue
+        change = '' if d.change is None else '{:+.1%}'.format(d.change)
+        lines.append('{:40} {:16} {:>12} {:>12} {:>8} {}'.format(
+            d.case, d.metric, _format(d.baseline), _format(d.current),
+            change, 'REGRESSION' if d.regression else ''))
+    return '\n'.join(lines)
+
+
+def _format(value):
+    if isinstance(value, float):
+        return '{:.4g}'.format(value)
+    return str(value)
@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+#
+# Runs parameter files on synthetic pairs of several sizes and records,
+# per case, the wall time of elastix and transformix, the time spent in
+# every resolution (from the IterationInfo files), the peak resident
+# memory of the processes and the error of the estimated deformation
+# against the ground truth. Every run happens in a fresh worker process,
+# so the peak memory of its children is that of this run alone.
+
+
+from __future__ import division, print_function
+
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from .. import metaimage, scratch
+from ..elastix_interface import ElastixInterface
+from ..log_files import load_iteration_infos
+from ..parameter_file import ParameterFile, write_overrides
+from ..resources import available_cores
+from ..transformix_interface import TransformixInterface
+from .synthetic import generate_pair, deformation_error
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+
+# Image sizes (voxels per axis) per dimension
+SIZES = {2: (64, 128, 256), 3: (32, 64, 96)}
+
+# Number of times the executables are started to measure spawn overhead
+SPAWN_REPEAT = 5
+
+# Relative intensity above which the fixed image is foreground
+FOREGROUND = 0.05
+
+
+def _peak_rss():
+    """Peak resident memory of the finished children, in bytes."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return int(peak if sys.platform == 'darwin' else peak * 1024)
+
+
+def spawn_overhead(path, repeat=SPAWN_REPEAT):
+    """Median time in seconds to start `path --version` and wait for it."""
+    times = []
+    with open(os.devnull, 'wb') as devnull:
+        for _ in range(repeat):
+            start = time.time()
+            subprocess.call([path, '--version'], stdout=devnull,
+                            stderr=devnull)
+            times.append(time.time() - start)
+    return float(np.median(times))
+
+
+def _resolution_times(output_dir):
+    """Seconds spent in every resolution, stage by stage."""
+    table = load_iteration_infos(output_dir)
+    if 'time[ms]' not in table:
+        return []
+    times = OrderedDict()
+    for stage, level, ms in zip(table['stage'], table['resolution'],
+                                table['time[ms]']):
+        key = (int(stage), int(level))
+        times[key] = times.get(key, 0.0) + ms / 1000.0
+    return [times[key] for key in sorted(times)]
+
+
+def run_case(elastix_path, transformix_path, parameters, pair, output_dir,
+             threads=None):
+    """
+    Register one synthetic pair and measure it. Meant to run in a worker
+    process of its own, see `run_benchmark`.
+
+    Returns:
+        A dict of measurements, with 'error' set if a step failed.
+    """
+    record = OrderedDict()
+    try:
+        el = ElastixInterface(elastix_path)
+        start = time.time()
+        transform = el.register([parameters], pair.fixed_image,
+                                pair.moving_image, output_dir=output_dir,
+                                verbose=False, threads=threads)
+        record['elastix_time'] = time.time() - start
+        record['elastix_peak_rss'] = _peak_rss()
+        record['resolution_times'] = _resolution_times(output_dir)
+
+        tr = TransformixInterface(transform, transformix_path)
+        start = time.time()
+        field = tr.deformation_field(output_dir=output_dir, verbose=False,
+                                     load=True)
+        record['transformix_time'] = time.time() - start
+        record['peak_rss'] = _peak_rss()
+
+        fixed = metaimage.MetaImage(pair.fixed_image).data
+        record['accuracy'] = deformation_error(
+            field, pair.deformation_field,
+            mask=fixed > FOREGROUND * fixed.max())
+    except Exception as ex:
+        record['error'] = repr(ex)
+    return record
+
+
+def _summary(runs):
+    """Combine the repeated runs of a case: medians of times, max of memory."""
+    good = [r for r in runs if 'error' not in r]
+    summary = OrderedDict()
+    if not good:
+        summary['error'] = runs[-1].get('error')
+        return summary
+    for key in ('elastix_time', 'transformix_time'):
+        summary[key] = float(np.median([r[key] for r in good]))
+    for key in ('elastix_peak_rss', 'peak_rss'):
+        values = [r[key] for r in good if r[key] is not None]
+        summary[key] = max(values) if values else None
+    levels = min(len(r['resolution_times']) for r in good)
+    summary['resolution_times'] = [
+        float(np.median([r['resolution_times'][i] for r in good]))
+        for i in range(levels)]
+    summary['accuracy'] = good[-1]['accuracy']
+    if len(good) < len(runs):
+        summary['failed_runs'] = len(runs) - len(good)
+    return summary
+
+
+def case_name(parameters, ndim, size):
+    base = os.path.splitext(os.path.basename(parameters))[0]
+    return '{}/{}d/{}'.format(base, ndim, size)
+
+
+def run_benchmark(elastix_path, transformix_path, parameters, sizes=None,
+                  dimensions=None, repeat=1, threads=None, output=None,
+                  work_dir=None, keep=False, seed=0, verbose=True):
+    """
+    Run every parameter file on synthetic pairs of every size.
+
+    Args:
+        elastix_path, transformix_path: (str) The executables.
+        parameters: (list) Parameter files, e.g. the example_data ones.
+        sizes: (dict) Voxels per axis for every dimension, see `SIZES`.
+        dimensions: (list) Dimensions to run every parameter file in.
+                    Defaults to the FixedImageDimension of each file.
+        repeat: (int) Number of runs per case; times are medians.
+        threads: (int) Value of elastix' -threads option.
+        output: (str) If given, the results are written to this JSON file.
+        work_dir: (str) Where the pairs and results go. Defaults to a
+                  scratch directory that is removed afterwards, unless
+                  `keep` is True.
+        seed: (int) Seed of the synthetic pairs.
+
+    Returns:
+        A dict with 'meta' (versions, machine, spawn overhead) and 'cases',
+        a list of results per case.
+    """
+    sizes = SIZES if sizes is None else sizes
+    el = ElastixInterface(elastix_path)
+    meta = OrderedDict()
+    meta['date'] = datetime.datetime.now().isoformat()
+    meta['elastix_version'] = el.version()
+    meta['python'] = platform.python_version()
+    meta['platform'] = platform.platform()
+    meta['cores'] = available_cores()
+    meta['threads'] = threads
+    meta['repeat'] = repeat
+    meta['spawn_overhead'] = OrderedDict([
+        ('elastix', spawn_overhead(elastix_path)),
+        ('transformix', spawn_overhead(transformix_path))])
+
+    cases = []
+    with scratch.ScratchDir('elastix-benchmark-', work_dir, keep=keep) as work:
+        pairs = {}
+        for prm in parameters:
+            native = int(ParameterFile.read(prm).scalar('FixedImageDimension',
+                                                        2))
+            for ndim in dimensions or [native]:
+                for size in sizes[ndim]:
+                    name = case_name(prm, ndim, size)
+                    directory = work.join(name.replace('/', '-'))
+                    os.makedirs(directory)
+                    if (ndim, size) not in pairs:
+                        data = work.join('pair-{}d-{}'.format(ndim, size))
+                        os.makedirs(data)
+                        pairs[ndim, size] = generate_pair(
+                            data, (size,) * ndim, seed=seed)
+                    case_parameters = write_overrides(
+                        prm, {'FixedImageDimension': ndim,
+                              'MovingImageDimension': ndim,
+                              'ResultImageFormat': 'mhd'},
+                        os.path.join(directory, 'parameters.txt'))
+
+                    runs = []
+                    for r in range(repeat):
+                        run_dir = os.path.join(directory, 'run{}'.format(r))
+                        os.makedirs(run_dir)
+                        with ProcessPoolExecutor(max_workers=1) as executor:
+                            runs.append(executor.submit(
+                                run_case, elastix_path, transformix_path,
+                                case_parameters, pairs[ndim, size], run_dir,
+                                threads).result())
+                    case = OrderedDict([('name', name),
+                                        ('parameters', prm),
+                                        ('ndim', ndim),
+                                        ('size', size)])
+                    case.update(_summary(runs))
+                    case['runs'] = runs
+                    cases.append(case)
+                    if verbose:
+                        print(format_case(case))
+
+    results = OrderedDict([('meta', meta), ('cases', cases)])
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+def format_case(case):
+    if 'error' in case:
+        return '{:40} failed: {}'.format(case['name'], case['error'])
+    rss = case.get('peak_rss')
+    return '{:40} elastix {:8.3f} s  transformix {:7.3f} s  ' \
+           'peak {:>8}  error {:.3f} (from {:.3f})'.format(
+               case['name'], case['elastix_time'], case['transformix_time'],
+               '{:.0f} MiB'.format(rss / 1024 ** 2) if rss else '-',
+               case['accuracy']['mean_error'],
+               case['accuracy']['mean_displacement'])
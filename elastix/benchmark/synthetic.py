@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+#
+# Synthetic image pairs with a known deformation. The moving image is a
+# random phantom of smooth blobs; the fixed image is the moving image
+# warped with a smooth random displacement field d, so that
+# fixed(x) = moving(x + d(x)). A perfect registration therefore yields
+# exactly the deformation field d, in the convention of transformix.
+
+
+from __future__ import division, print_function
+
+import os
+
+import numpy as np
+
+from .. import interpolation, metaimage
+
+
+class SyntheticPair(object):
+    """Paths of a generated pair and its ground truth deformation field."""
+    def __init__(self, fixed_image, moving_image, deformation_field):
+        self.fixed_image = fixed_image
+        self.moving_image = moving_image
+        self.deformation_field = deformation_field
+
+    def __repr__(self):
+        return 'SyntheticPair({!r}, {!r}, {!r})'.format(
+            self.fixed_image, self.moving_image, self.deformation_field)
+
+
+def _grid(shape, spacing):
+    """Physical coordinates of all voxels, (N, ndim) in ITK order."""
+    index = np.indices(shape).reshape(len(shape), -1).T
+    return index[:, ::-1] * spacing
+
+
+def phantom(shape, spacing=None, blobs=12, seed=0):
+    """
+    Random phantom of Gaussian blobs of various sizes and intensities,
+    scaled to 0-255.
+    """
+    ndim = len(shape)
+    spacing = np.ones(ndim) if spacing is None else np.asarray(spacing, float)
+    rng = np.random.RandomState(seed)
+    points = _grid(shape, spacing)
+    extent = np.asarray(shape[::-1]) * spacing
+    image = np.zeros(len(points))
+    for _ in range(blobs):
+        center = extent * rng.uniform(0.2, 0.8, ndim)
+        radius = extent.min() * rng.uniform(0.04, 0.15)
+        r2 = np.sum((points - center) ** 2, axis=1) / (2 * radius ** 2)
+        image += rng.uniform(0.3, 1.0) * np.exp(-r2)
+    image *= 255.0 / image.max()
+    return image.reshape(shape).astype(np.float32)
+
+
+def displacement(shape, spacing=None, magnitude=0.05, bumps=6, seed=0):
+    """
+    Smooth random displacement field: a sum of Gaussian bumps with random
+    displacement vectors. The largest displacement is about `magnitude`
+    times the extent of the image, and the bumps are wide enough for the
+    transform to stay invertible.
+
+    Returns:
+        An array of shape `shape` + (ndim,), with vector components in ITK
+        order and in physical units.
+    """
+    ndim = len(shape)
+    spacing = np.ones(ndim) if spacing is None else np.asarray(spacing, float)
+    rng = np.random.RandomState(seed + 1)
+    points = _grid(shape, spacing)
+    extent = np.asarray(shape[::-1]) * spacing
+    width = extent.min() / 5.0
+    # Largest Jacobian of one bump is 0.6 * amplitude / width
+    amplitude = min(magnitude * extent.min(), width)
+    field = np.zeros(points.shape)
+    for _ in range(bumps):
+        center = extent * rng.uniform(0.1, 0.9, ndim)
+        vector = rng.normal(size=ndim)
+        vector *= amplitude / bumps ** 0.5 / np.linalg.norm(vector)
+        r2 = np.sum((points - center) ** 2, axis=1) / (2 * width ** 2)
+        field += np.exp(-r2)[:, None] * vector
+    return field.reshape(tuple(shape) + (ndim,))
+
+
+def warp(image, field, spacing=None):
+    """Resample `image` at x + field(x), with linear interpolation."""
+    ndim = image.ndim
+    spacing = np.ones(ndim) if spacing is None else np.asarray(spacing, float)
+    points = _grid(image.shape, spacing) + field.reshape(-1, ndim)
+    cindex = (points / spacing)[:, ::-1]
+    return interpolation.linear(image, cindex).reshape(image.shape) \
+        .astype(image.dtype)
+
+
+def generate_pair(directory, shape, spacing=None, magnitude=0.05, seed=0):
+    """
+    Write a synthetic pair as MetaImages to `directory`: fixed.mhd,
+    moving.mhd and the ground truth deformationField.mhd on the grid of the
+    fixed image.
+
+    Args:
+        directory: (str) Existing output directory.
+        shape: (tuple) Image size in C order, 2D or 3D.
+        spacing: (sequence) Voxel spacing in ITK order. Defaults to 1.
+        magnitude: (float) Largest displacement relative to the extent.
+        seed: (int) Seed of both the phantom and the deformation.
+
+    Returns:
+        A `SyntheticPair`.
+    """
+    shape = tuple(shape)
+    spacing = np.ones(len(shape)) if spacing is None \
+        else np.asarray(spacing, float)
+    moving = phantom(shape, spacing, seed=seed)
+    field = displacement(shape, spacing, magnitude, seed=seed)
+    fixed = warp(moving, field, spacing)
+
+    paths = [os.path.join(directory, name) for name in
+             ('fixed.mhd', 'moving.mhd', 'deformationField.mhd')]
+    metaimage.write_mhd(paths[0], fixed, spacing=spacing)
+    metaimage.write_mhd(paths[1], moving, spacing=spacing)
+    metaimage.write_mhd(paths[2], field.astype(np.float32), spacing=spacing,
+                        vector=True)
+    return SyntheticPair(*paths)
+
+
+def deformation_error(estimate, truth, mask=None):
+    """
+    Error of an estimated deformation field against the ground truth.
+
+    Args:
+        estimate, truth: (str, MetaImage or ndarray) Deformation fields on
+                         the same grid.
+        mask: (ndarray) Optional boolean mask of the voxels to evaluate,
+              e.g. the foreground of the fixed image, since displacements
+              in empty background are not observable.
+
+    Returns:
+        A dict with the mean, 95th percentile and maximum of the
+        Euclidean error, and the mean of the true displacement (the error
+        of the identity transform) for reference.
+    """
+    def load(field):
+        if isinstance(field, str):
+            field = metaimage.MetaImage(field)
+        if isinstance(field, metaimage.MetaImage):
+            field = field.data
+        return np.asarray(field, dtype=float)
+
+    estimate, truth = load(estimate), load(truth)
+    error = np.linalg.norm(estimate - truth, axis=-1)
+    initial = np.linalg.norm(truth, axis=-1)
+    if mask is not None:
+        error, initial = error[mask], initial[mask]
+    return {'mean_error': float(error.mean()),
+            'p95_error': float(np.percentile(error, 95)),
+            'max_error': float(error.max()),
+            'mean_displacement': float(initial.mean())}
@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+#
+# Content-addressed cache for elastix registrations. A registration is
+# identified by the hash of everything that determines its result: the
+# bytes of the input images (including the .raw files referenced by .mhd
+# headers), masks, point sets, parameter files, the initial transform
+# chain and the elastix version. On a hit, the stored transform parameter
+# files and results are copied to the output directory without running
+# elastix, pointing at the caller's initial transform. The cache directory
+# is bounded in size and evicts the least recently used entries first.
+
+
+from __future__ import division, print_function
+
+import os
+import re
+import shutil
+import hashlib
+import tempfile
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_MAX_BYTES = 10 * 1024 ** 3
+
+# Output files that are worth keeping. Anything else elastix writes to the
+# output directory is not cached.
+CACHED_FILES = re.compile(r'^(TransformParameters\..*|result\..*|'
+                          r'IterationInfo\..*|elastix\.log)$')
+
+OUTPUT_DIR_PLACEHOLDER = '<ELASTIX_CACHE_OUTPUT_DIR>'
+
+INITIAL_TRANSFORM_PLACEHOLDER = '<ELASTIX_CACHE_INITIAL_TRANSFORM>'
+
+_INITIAL_TRANSFORM = re.compile(
+    r'\(InitialTransformParametersFileName\s+"([^"]*)"\)')
+_DATA_FILE = re.compile(r'^\s*ElementDataFile\s*=\s*(.*?)\s*$', re.MULTILINE)
+
+
+def _update_with_file(h, path):
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+
+
+def _referenced_data_files(header_path):
+    """
+    Return the data files referenced by a MetaImage (.mhd) header. Headers
+    with inline data (LOCAL) or no data file reference return nothing.
+    """
+    with open(header_path, 'rb') as f:
+        header = f.read().decode('latin-1')
+    match = _DATA_FILE.search(header)
+    if match is None:
+        return []
+    data_file = match.group(1)
+    directory = os.path.dirname(header_path)
+    if data_file == 'LOCAL':
+        return []
+    if data_file.startswith('LIST'):
+        names = header[match.end():].split()
+        return [os.path.join(directory, name) for name in names]
+    return [os.path.join(directory, data_file)]
+
+
+def _update_with_image(h, path):
+    _update_with_file(h, path)
+    if path.lower().endswith('.mhd'):
+        for data_file in _referenced_data_files(path):
+            _update_with_file(h, data_file)
+
+
+def _transform_chain(path):
+    """List a transform parameter file and all its initial transforms."""
+    chain = []
+    while path and path != 'NoInitialTransform' and path not in chain:
+        chain.append(path)
+        with open(path) as f:
+            match = _INITIAL_TRANSFORM.search(f.read())
+        path = match.group(1) if match else None
+    return chain
+
+
+def _directory_size(path):
+    size = 0
+    for name in os.listdir(path):
+        size += os.path.getsize(os.path.join(path, name))
+    return size
+
+
+class RegistrationCache(object):
+    """
+    On-disk cache of registration results.
+
+    Args:
+        cache_dir: (str) Directory that holds the cache entries. It is
+                   created if it does not exist, and may be shared by
+                   several processes.
+        max_bytes: (int) Size bound of the cache. When a new entry makes
+                   the cache exceed it, the least recently used entries
+                   are evicted.
+    """
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def key(self, elastix_version, parameters,
+            fixed_image=None, moving_image=None,
+            fixed_mask=None, moving_mask=None,
+            fixed_points=None, moving_points=None,
+            initial_transform=None):
+        """Hash all inputs that determine the result of a registration."""
+        h = hashlib.sha256()
+
+        def field(name):
+            h.update(b'\0' + name.encode('ascii') + b'\0')
+
+        field('version')
+        h.update(str(elastix_version).encode('utf-8'))
+        for name, images in [('fixed_image', fixed_image),
+                             ('moving_image', moving_image),
+                             ('fixed_mask', fixed_mask),
+                             ('moving_mask', moving_mask)]:
+            if images is None:
+                continue
+            if not isinstance(images, list):
+                images = [images]
+            for image in images:
+                field(name)
+                _update_with_image(h, image)
+        for name, path in [('fixed_points', fixed_points),
+                           ('moving_points', moving_points)]:
+            if path is not None:
+                field(name)
+                _update_with_file(h, path)
+        for path in parameters:
+            field('parameters')
+            _update_with_file(h, path)
+        if initial_transform:
+            for path in _transform_chain(initial_transform):
+                field('initial_transform')
+                _update_with_file(h, path)
+        return h.hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def restore(self, key, output_dir, initial_transform=None):
+        """
+        Copy a cached result to `output_dir`. Returns False on a miss.
+
+        The key covers the contents of the initial transform chain, not
+        its path, so the transform parameter files are made to point at
+        `initial_transform`, the initial transform of the caller.
+        """
+        entry = self._entry(key)
+        if not os.path.isdir(entry):
+            return False
+        try:
+            # Mark the entry as recently used
+            os.utime(entry, None)
+            for name in os.listdir(entry):
+                source = os.path.join(entry, name)
+                target = os.path.join(output_dir, name)
+                if name.startswith('TransformParameters.'):
+                    with open(source) as f:
+                        text = f.read()
+                    text = text.replace(OUTPUT_DIR_PLACEHOLDER, output_dir)
+                    if initial_transform:
+                        text = text.replace(INITIAL_TRANSFORM_PLACEHOLDER,
+                                            initial_transform)
+                    with open(target, 'w') as f:
+                        f.write(text)
+                else:
+                    shutil.copyfile(source, target)
+        except (IOError, OSError):
+            # The entry was evicted by another process while copying
+            logger.info('Cache entry {} disappeared while restoring.'.format(key))
+            return False
+        logger.info('Restored cached registration {} to {}'.format(key, output_dir))
+        return True
+
+    def store(self, key, output_dir, initial_transform=None):
+        """
+        Store the results elastix wrote to `output_dir`, which must be the
+        private directory of the run, so that no files of other runs are
+        picked up. References to `initial_transform` are stored as a
+        placeholder that `restore` fills in.
+        """
+        entry = self._entry(key)
+        if os.path.isdir(entry):
+            return
+        staging = tempfile.mkdtemp(prefix='.tmp-', dir=self.cache_dir)
+        output_prefix = os.path.join(output_dir, '')
+        try:
+            for name in os.listdir(output_dir):
+                source = os.path.join(output_dir, name)
+                if not CACHED_FILES.match(name) or not os.path.isfile(source):
+                    continue
+                target = os.path.join(staging, name)
+                if name.startswith('TransformParameters.'):
+                    # Initial transforms written by this run point into the
+                    # output directory, which differs when restoring.
+                    with open(source) as f:
+                        text = f.read()
+                    text = text.replace('"' + output_prefix,
+                                        '"' + os.path.join(OUTPUT_DIR_PLACEHOLDER, ''))
+                    if initial_transform:
+                        text = text.replace(
+                            '"{}"'.format(initial_transform),
+                            '"{}"'.format(INITIAL_TRANSFORM_PLACEHOLDER))
+                    with open(target, 'w') as f:
+                        f.write(text)
+                else:
+                    shutil.copyfile(source, target)
+            os.rename(staging, entry)
+        except OSError:
+            # Another process stored the same entry first
+            shutil.rmtree(staging, ignore_errors=True)
+            if not os.path.isdir(entry):
+                raise
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits."""
+        entries = []
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.startswith('.') or not os.path.isdir(path):
+                continue
+            try:
+                size = _directory_size(path)
+                entries.append((os.path.getmtime(path), size, path))
+            except OSError:
+                continue
+            total += size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            logger.info('Evicted cache entry {}'.format(path))
+
+    def clear(self):
+        for name in os.listdir(self.cache_dir):
+            shutil.rmtree(os.path.join(self.cache_dir, name), ignore_errors=True)
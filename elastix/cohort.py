@@ -0,0 +1,367 @@
+#!/usr/bin/env python
+#
+# Pairwise registration of a cohort of images, e.g. for template building
+# or inter-subject studies. A `Cohort` schedules the ordered pairs of its
+# images, all N x (N - 1) of them or a sparse subset such as the k nearest
+# neighbours in some feature space, on a pool of workers, and writes the
+# final metric of every pair into an N x N matrix as soon as the pair is
+# done, so partial results can be used while the rest is still running.
+#
+# The reverse direction of a pair need not be registered: with
+# reverse='invert' the transform of (j, i) is derived from that of (i, j)
+# by `invert_chain`, and with reverse='mirror' only the metric is
+# mirrored.
+
+
+from __future__ import division, print_function
+
+import os
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+
+from . import metaimage
+from .log_files import load_iteration_infos
+from .resources import worker_budget
+from .transform_chain import invert_chain
+
+
+# Ways to handle the reverse direction of a pair, see `Cohort.run`
+REVERSE_MODES = ('register', 'invert', 'mirror')
+
+# Histogram bins of `intensity_features`
+FEATURE_BINS = 32
+
+
+def all_pairs(n):
+    """All ordered pairs (fixed, moving) of n images, without (i, i)."""
+    return [(i, j) for i in range(n) for j in range(n) if i != j]
+
+
+def nearest_pairs(features, k):
+    """
+    The pairs (i, j) for which image j is one of the k nearest neighbours
+    of image i, by Euclidean distance between rows of `features`.
+
+    Args:
+        features: (ndarray) An (N, F) array with a feature vector per image.
+        k: (int) Number of neighbours per image.
+    """
+    features = np.asarray(features, dtype=float)
+    if features.ndim == 1:
+        features = features[:, None]
+    n = len(features)
+    k = min(k, n - 1)
+    squared = np.sum(features ** 2, axis=1)
+    distances = squared[:, None] + squared[None, :] - \
+        2 * features.dot(features.T)
+    np.fill_diagonal(distances, np.inf)
+    neighbours = np.argsort(distances, axis=1, kind='stable')[:, :k]
+    return [(i, int(j)) for i in range(n) for j in sorted(neighbours[i])]
+
+
+def intensity_features(images, bins=FEATURE_BINS):
+    """
+    A cheap feature vector per MetaImage for `nearest_pairs`: the
+    normalized intensity histogram between the image's 1st and 99th
+    percentile, followed by its physical extent. Images are read slab by
+    slab.
+    """
+    rows = []
+    for path in images:
+        image = metaimage.MetaImage(path)
+        # A subsample is enough for the percentiles
+        sample = np.concatenate([np.asarray(slab, dtype=float).ravel()[::7]
+                                 for _, slab in image.chunks()])
+        low, high = np.percentile(sample, [1, 99])
+        histogram = np.zeros(bins)
+        for _, slab in image.chunks():
+            histogram += np.histogram(slab, bins=bins,
+                                      range=(low, max(high, low + 1e-6)))[0]
+        histogram /= max(histogram.sum(), 1)
+        rows.append(np.concatenate([histogram,
+                                    np.asarray(image.size) * image.spacing]))
+    features = np.array(rows)
+    # Put the histogram and the extent on a comparable scale
+    spread = features.std(axis=0)
+    spread[spread == 0] = 1
+    return (features - features.mean(axis=0)) / spread
+
+
+def _final_metric(output_dir):
+    table = load_iteration_infos(output_dir)
+    if 'metric' in table and len(table['metric']):
+        return float(table['metric'][-1])
+    return None
+
+
+class PairResult(object):
+    """
+    Outcome of one ordered pair of a cohort: image `moving` registered to
+    image `fixed`. For a pair that was derived from its reverse,
+    `derived_from` is the reverse pair and `metric` is copied from it.
+    """
+    def __init__(self, fixed, moving, output_dir, transform=None, metric=None,
+                 error=None, elapsed=None, derived_from=None):
+        self.fixed = fixed
+        self.moving = moving
+        self.output_dir = output_dir
+        self.transform = transform
+        self.metric = metric
+        self.error = error
+        self.elapsed = elapsed
+        self.derived_from = derived_from
+
+    @property
+    def pair(self):
+        return self.fixed, self.moving
+
+    @property
+    def success(self):
+        return self.error is None
+
+    def __repr__(self):
+        status = 'metric {}'.format(self.metric) if self.success else \
+            'failed: {!r}'.format(self.error)
+        if self.derived_from is not None:
+            status += ', derived from {}'.format(self.derived_from)
+        return 'PairResult({}, {}, {})'.format(self.fixed, self.moving, status)
+
+
+class CohortResult(object):
+    """
+    Results of `Cohort.run`: `similarity[i, j]` is the final metric of
+    image j registered to image i (NaN where the pair was not run or
+    failed), and `pairs` maps (i, j) to its `PairResult`.
+    """
+    def __init__(self, similarity, pairs):
+        self.similarity = similarity
+        self.pairs = pairs
+
+    @property
+    def failed(self):
+        return [r for r in self.pairs.values() if not r.success]
+
+    def __getitem__(self, pair):
+        return self.pairs[pair]
+
+    def __repr__(self):
+        return 'CohortResult({} pairs, {} failed)'.format(len(self.pairs),
+                                                        len(self.failed))
+
+
+class Cohort(object):
+    """
+    A set of images to register pairwise.
+
+    >>> cohort = Cohort(['s01.mhd', 's02.mhd', 's03.mhd', 's04.mhd'])
+    >>> pairs = nearest_pairs(intensity_features(cohort.images), k=2)
+    >>> result = cohort.run(ElastixInterface(ELASTIX_PATH),
+    ...                     ['parameters_affine.txt'], 'pairs', pairs=pairs,
+    ...                     reverse='invert')
+    >>> result.similarity
+
+    Pairs are registered in parallel, and `run_iter` yields every pair as
+    it finishes.
+
+    Args:
+        images: (list) Paths of the images.
+        masks: (list) Optional mask per image (or None), used as the fixed
+               or moving mask depending on the role of the image.
+    """
+
+    def __init__(self, images, masks=None):
+        self.images = list(images)
+        if masks is not None and len(masks) != len(self.images):
+            raise ValueError('The masks need one entry per image')
+        self.masks = list(masks) if masks is not None else \
+            [None] * len(self.images)
+
+    def __len__(self):
+        return len(self.images)
+
+    def _job(self, parameters, pair, output_dir, options):
+        i, j = pair
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        job = dict(options)
+        # The metric of a pair is read from its IterationInfo files, which
+        # output modes such as 'transform_only' would switch off
+        job['overrides'] = dict(options.get('overrides') or {},
+                                WriteIterationInfo=True)
+        job.update({'parameters': list(parameters),
+                    'fixed_image': self.images[i],
+                    'moving_image': self.images[j],
+                    'fixed_mask': self.masks[i],
+                    'moving_mask': self.masks[j],
+                    'output_dir': output_dir})
+        return job
+
+    def _schedule(self, pairs, reverse):
+        """
+        Split the pairs into those to register and those to derive from
+        their reverse, as a dict mapping a registered pair to its derived
+        reverse (or None).
+        """
+        registered = {}
+        for i, j in pairs:
+            if i == j:
+                raise ValueError('Cannot register image {} to itself'.format(i))
+            if reverse != 'register' and (j, i) in registered:
+                registered[j, i] = (i, j)
+            elif (i, j) not in registered:
+                registered[i, j] = None
+        return registered
+
+    def run_iter(self, elastix, parameters, output_dir, pairs=None,
+                 reverse='register', similarity=None, max_workers=None,
+                 threads_per_job=None, **options):
+        """
+        Register the pairs and yield a `PairResult` for every pair as soon
+        as it is done (in the order of completion). If `similarity` is
+        given, the metric of every pair is written into it first.
+
+        See `run` for the arguments.
+        """
+        if reverse not in REVERSE_MODES:
+            raise ValueError('Unknown reverse mode {!r}, expected one of {}'
+                             .format(reverse, ', '.join(REVERSE_MODES)))
+        pairs = all_pairs(len(self)) if pairs is None else \
+            [(int(i), int(j)) for i, j in pairs]
+        registered = self._schedule(pairs, reverse)
+        if not registered:
+            return
+
+        def directory(pair):
+            return os.path.join(output_dir, 'pair-{}-{}'.format(*pair))
+
+        max_workers, threads_per_job = worker_budget(
+            len(registered), max_workers, threads_per_job, elastix.governor)
+
+        def invert(forward, pair):
+            target = directory(pair)
+            if not os.path.exists(target):
+                os.makedirs(target)
+            # The moving image of the forward pair is the fixed one now
+            return invert_chain(forward.transform, self.images[forward.moving],
+                                target)
+
+        def invertible(pair):
+            return os.path.splitext(self.images[pair[1]])[1].lower() in \
+                ('.mhd', '.mha')
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            running = {}
+
+            def register(pair):
+                job = self._job(parameters, pair, directory(pair), options)
+                future = executor.submit(elastix.register_job, job,
+                                         threads_per_job)
+                running[future] = ('register', pair, None)
+
+            for pair in registered:
+                if registered[pair] is not None and reverse == 'invert' \
+                        and not invertible(pair):
+                    # No grid to sample the inverse on
+                    register(registered[pair])
+                    registered[pair] = None
+                register(pair)
+
+            while running:
+                finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    kind, pair, forward = running.pop(future)
+                    if kind == 'register':
+                        outcome = future.result()
+                        result = PairResult(pair[0], pair[1],
+                                            outcome.output_dir,
+                                            error=outcome.error,
+                                            elapsed=outcome.elapsed)
+                        if outcome.success:
+                            result.transform = os.path.join(
+                                outcome.output_dir,
+                                'TransformParameters.{}.txt'.format(
+                                    len(parameters) - 1))
+                            result.metric = _final_metric(outcome.output_dir)
+                    else:
+                        result = PairResult(pair[0], pair[1], directory(pair),
+                                            metric=forward.metric,
+                                            derived_from=forward.pair)
+                        try:
+                            result.transform = future.result()
+                        except Exception as ex:
+                            result.error = ex
+                    if similarity is not None and result.metric is not None:
+                        similarity[pair] = result.metric
+
+                    derived = registered.get(pair) if kind == 'register' \
+                        else None
+                    if derived is not None and not result.success:
+                        yield result
+                        result = PairResult(derived[0], derived[1],
+                                            directory(derived),
+                                            error=result.error,
+                                            derived_from=pair)
+                    elif derived is not None and reverse == 'invert':
+                        running[executor.submit(invert, result, derived)] = \
+                            ('invert', derived, result)
+                    elif derived is not None:
+                        yield result
+                        result = PairResult(derived[0], derived[1], None,
+                                            metric=result.metric,
+                                            derived_from=pair)
+                        if similarity is not None and \
+                                result.metric is not None:
+                            similarity[derived] = result.metric
+                    yield result
+
+    def run(self, elastix, parameters, output_dir, pairs=None,
+            reverse='register', similarity=None, callback=None,
+            max_workers=None, threads_per_job=None, **options):
+        """
+        Register pairs of the cohort.
+
+        Args:
+            elastix: (ElastixInterface) Runs the registrations (and caches
+                     them, if it has a cache).
+            parameters: (list) Parameter files of the registration.
+            output_dir: (str) Every pair (i, j) gets a subdirectory
+                        pair-<i>-<j>.
+            pairs: (list) Ordered pairs (fixed, moving) of image indices,
+                   e.g. from `nearest_pairs`. Defaults to `all_pairs`.
+            reverse: (str) What to do when both (i, j) and (j, i) are
+                     requested. 'register' runs both. 'invert' only
+                     registers the first and writes the inverse of its
+                     transform for the second (see `invert_chain`; exact
+                     for linear transforms, approximate otherwise), which
+                     gets the metric of the first. It registers both when
+                     the image of the inverse is not a MetaImage. 'mirror'
+                     only registers the first and copies its metric; the
+                     second pair has no transform.
+            similarity: (ndarray) Optional N x N array (e.g. a memory-mapped
+                        .npy file that other processes read) in which the
+                        final metric of every pair is stored as soon as it
+                        is done. Defaults to a new array of NaNs.
+            callback: (callable) Called with every `PairResult` as soon as
+                      it is done, after `similarity` is updated.
+            max_workers, threads_per_job: As in
+                                          `ElastixInterface.register_many`.
+            options: Other keyword arguments of `register` for every pair,
+                     e.g. `mode` or `initial_transform`. IterationInfo
+                     files are always written, whatever the mode, since
+                     the metric is read from them.
+
+        Returns:
+            A `CohortResult`. Failed pairs do not stop the run; their
+            exception is stored in the `error` attribute of their result.
+        """
+        if similarity is None:
+            similarity = np.full((len(self), len(self)), np.nan)
+        results = {}
+        for result in self.run_iter(elastix, parameters, output_dir, pairs,
+                                    reverse, similarity, max_workers,
+                                    threads_per_job, **options):
+            results[result.pair] = result
+            if callback is not None:
+                callback(result)
+        return CohortResult(similarity, results)
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+#
+# Early stopping of elastix runs. Elastix always runs the full number of
+# iterations of every resolution, even when the metric has long stopped
+# improving. An EarlyStopping policy watches the live IterationInfo stream
+# of a run (see progress.py) and tells ElastixInterface.register when to
+# terminate the process. Because elastix only writes a transform at the end
+# of a stage, register makes elastix checkpoint the transform after every
+# resolution (or iteration) while a policy is active, so a usable transform
+# is left behind after termination.
+
+
+from __future__ import division, print_function
+
+import os
+import re
+
+from .progress import IterationRecord
+
+
+TRANSFORM_PARAMETERS = re.compile(
+    r'^TransformParameters\.(\d+)(?:\.R(\d+))?(?:\.It(\d+))?\.txt$')
+
+CHECKPOINT_PARAMETERS = {
+    'resolution': 'WriteTransformParametersEachResolution',
+    'iteration': 'WriteTransformParametersEachIteration',
+}
+
+
+class EarlyStopping(object):
+    """
+    Policy that stops a registration once the metric plateaus or a time
+    budget is exceeded.
+
+    Args:
+        window: (int) Number of iterations per window. The mean metric of
+                the last window is compared with that of the window before
+                it, so at least 2 * `window` iterations of a resolution are
+                needed before the plateau criterion can fire.
+        min_relative_improvement: (float) Stop when the mean metric of the
+                                  last window improved (decreased) by less
+                                  than this fraction of the previous
+                                  window's magnitude.
+        max_seconds_per_resolution: (float) Stop when a single resolution
+                                    takes longer than this.
+        min_resolution: (int) Only stop in this resolution level or later,
+                        so that coarse levels always complete. Negative
+                        values count from the last level, like Python
+                        indices: the default -1 only stops in the final
+                        (full resolution) level, since stopping a coarser
+                        level would return a coarse transform. Only the
+                        last stage of a chain is ever stopped, since
+                        stopping an earlier one would skip the later
+                        stages.
+        checkpoint: (str) 'resolution' or 'iteration': how often elastix
+                    writes the transform while the policy is active. Per
+                    iteration gives the most recent transform on stopping,
+                    but costs a file write every iteration.
+
+    After a run was stopped, `reason` describes why, and `stopped_at` holds
+    the (stage, resolution, iteration) of the last record seen.
+
+    `ElastixInterface.register` tells the policy the number of resolutions
+    of every stage through `reset`. A policy that is fed events without
+    them can stop in any stage, and a negative `min_resolution` then
+    allows every level.
+    """
+
+    def __init__(self, window=50, min_relative_improvement=1e-3,
+                 max_seconds_per_resolution=None, min_resolution=-1,
+                 checkpoint='resolution'):
+        if checkpoint not in CHECKPOINT_PARAMETERS:
+            raise ValueError('checkpoint must be one of {}'.format(
+                ', '.join(sorted(CHECKPOINT_PARAMETERS))))
+        self.window = window
+        self.min_relative_improvement = min_relative_improvement
+        self.max_seconds_per_resolution = max_seconds_per_resolution
+        self.min_resolution = min_resolution
+        self.checkpoint = checkpoint
+        self.reset()
+
+    def reset(self, resolutions=None):
+        """
+        Prepare for a new run whose stages have the numbers of resolutions
+        in the list `resolutions`, if known.
+        """
+        self.resolutions = resolutions
+        self.reason = None
+        self.stopped_at = None
+        self._level = None
+        self._level_start = None
+        self._metrics = []
+        self._last = None
+
+    @property
+    def overrides(self):
+        """
+        Parameter file overrides that make elastix write checkpoints and
+        the IterationInfo files the plateau criterion is evaluated on.
+        """
+        return {CHECKPOINT_PARAMETERS[self.checkpoint]: 'true',
+                'WriteIterationInfo': 'true'}
+
+    def _eligible(self, stage, resolution):
+        """Whether the run may be stopped in this level."""
+        if not self.resolutions:
+            return resolution >= max(self.min_resolution, 0)
+        if stage < len(self.resolutions) - 1:
+            return False
+        first = self.min_resolution
+        if first < 0:
+            first += self.resolutions[min(stage, len(self.resolutions) - 1)]
+        return resolution >= first
+
+    def _stop(self, reason):
+        self.reason = reason
+        if self._last is not None:
+            self.stopped_at = (self._last.stage, self._last.resolution,
+                               self._last.iteration)
+        return True
+
+    def update(self, event, now):
+        """
+        Feed an event of the progress stream (or None, to only check the
+        time budget) observed at time `now`. Returns True if the run
+        should be stopped.
+        """
+        if isinstance(event, IterationRecord):
+            level = (event.stage, event.resolution)
+            if level != self._level:
+                self._level = level
+                self._level_start = now
+                self._metrics = []
+            self._last = event
+            if event.metric is not None:
+                self._metrics.append(event.metric)
+
+        if self._level is None or not self._eligible(*self._level):
+            return False
+
+        if (self.max_seconds_per_resolution is not None and
+                now - self._level_start > self.max_seconds_per_resolution):
+            return self._stop('resolution {} of stage {} exceeded its time '
+                              'budget of {} s'.format(
+                                  self._level[1], self._level[0],
+                                  self.max_seconds_per_resolution))
+
+        if isinstance(event, IterationRecord) and \
+                len(self._metrics) >= 2 * self.window:
+            previous = self._metrics[-2 * self.window:-self.window]
+            current = self._metrics[-self.window:]
+            previous = sum(previous) / self.window
+            current = sum(current) / self.window
+            improvement = (previous - current) / max(abs(previous), 1e-12)
+            if improvement < self.min_relative_improvement:
+                return self._stop('relative metric improvement {:.2e} over '
+                                  'the last {} iterations is below {:.2e}'.format(
+                                      improvement, self.window,
+                                      self.min_relative_improvement))
+        return False
+
+
+def transform_files(output_dir):
+    """
+    Map the transform parameter files in `output_dir` to their
+    (modification time, size), to tell them apart from files written later.
+    """
+    files = {}
+    for name in os.listdir(output_dir):
+        if TRANSFORM_PARAMETERS.match(name):
+            st = os.stat(os.path.join(output_dir, name))
+            files[name] = (st.st_mtime, st.st_size)
+    return files
+
+
+def latest_checkpoint(output_dir, existing=None):
+    """
+    Return the most advanced complete transform parameter file written to
+    `output_dir`, ignoring unchanged files listed in `existing` (as returned
+    by `transform_files` before the run). Returns None if there is none.
+    """
+    existing = existing or {}
+    candidates = []
+    for name, stat in transform_files(output_dir).items():
+        if existing.get(name) == stat:
+            continue
+        match = TRANSFORM_PARAMETERS.match(name)
+        stage, resolution, iteration = match.groups()
+        final = resolution is None
+        # The end-of-resolution file comes after all its iterations
+        key = (int(stage), final, int(resolution or 0),
+               int(iteration) if iteration else float('inf'))
+        candidates.append((key, name))
+
+    for _, name in sorted(candidates, reverse=True):
+        path = os.path.join(output_dir, name)
+        with open(path) as f:
+            text = f.read()
+        # A file elastix was writing when it was killed is incomplete
+        if '(TransformParameters' in text and text.rstrip().endswith(')'):
+            return path
+    return None
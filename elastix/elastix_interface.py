@@ -4,15 +4,31 @@
 # a images with masks and pointsets.
 #
 # The Elastix class has one method called `register` that can do all
-# of the above.
+# of the above, and a `register_many` method that runs a batch of such
+# registrations concurrently.
 
 
 from __future__ import division, print_function
 
+import asyncio
 import os
+import re
 import signal
 import subprocess
 import logging
+import time
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from . import instrumentation, metaimage, scratch
+from .asynchronous import acquire, run_process, lazy_semaphore
+from .parameter_file import (ParameterFile, write_overrides,
+                             drop_coarse_resolutions)
+from .resources import admit, worker_budget, estimate_registration_memory
+from .progress import IterationInfoTail, stream_process
+from .early_stopping import transform_files, latest_checkpoint
+from .transform_chain import bake_chain
+from .transformix_interface import TransformixInterface
 
 logger = logging.getLogger(__name__)
 logger.setLevel(0)
@@ -20,19 +36,152 @@ logger.setLevel(0)
 
 DEFAULT_ELASTIX_PATH = 'elastix'
 
+# Parameter overrides of the output modes of `register`: 'full' runs the
+# parameter files as they are, 'transform_only' writes nothing but the
+# transform parameter files, and 'compressed' writes compressed result
+# images.
+OUTPUT_MODES = {
+    'full': {},
+    'transform_only': {'WriteResultImage': False,
+                       'WriteResultImageAfterEachResolution': False,
+                       'WriteResultImageAfterEachIteration': False,
+                       'WriteIterationInfo': False},
+    'compressed': {'CompressResultImage': True,
+                   'ResultImageFormat': 'mhd'},
+}
+
+# Output parameters transformix reads from transform parameter files, with
+# the values elastix assumes when a parameter file does not set them
+TRANSFORMIX_OUTPUT_DEFAULTS = {'WriteResultImage': True,
+                               'CompressResultImage': False,
+                               'ResultImageFormat': 'mhd'}
+
+
+# Function to cleanly kill a child process, e.g. post registration
+def kill_child(child_pid):  # Sorry if that sounds cruel
+    def kill_function():
+        if child_pid is None:
+            return
+        try:
+            os.kill(child_pid, signal.SIGTERM)
+        except OSError:
+            logger.info('Child process {}'
+                        ' already killed.'.format(child_pid))
+    return kill_function
+
 
 class ElastixInterface:
 
     def __init__(self,
-                 elastix_path=DEFAULT_ELASTIX_PATH
+                 elastix_path=DEFAULT_ELASTIX_PATH,
+                 cache=None,
+                 max_concurrent=None,
+                 scratch_dir=None,
+                 governor=None,
+                 instrumentation=None
                  ):
+        """
+        Args:
+            elastix_path: (str) Path to the elastix executable.
+            cache: (RegistrationCache) Optional cache of registration
+                   results. When given, registrations whose inputs have
+                   been registered before are restored from the cache
+                   instead of running elastix again.
+            max_concurrent: (int) Maximum number of elastix processes the
+                            `*_async` methods run at the same time.
+            scratch_dir: (str) Where private working directories and staged
+                         inputs are created. By default runs work inside
+                         their output directory and inputs are staged in
+                         the system temporary directory; `scratch.TMPFS`
+                         stages on tmpfs instead.
+            governor: (ResourceGovernor) Optional admission control. Every
+                      run then waits until the cores it asks for (its
+                      `threads`, or the governor's default) and its
+                      estimated peak memory are free, and gets `-threads`
+                      (and its CPU affinity, if the governor pins) from
+                      the governor.
+            instrumentation: (Instrumentation) Receives structured events
+                             of every elastix process, see
+                             `elastix.instrumentation`.
+        """
         self.elastix_path = elastix_path
+        self.cache = cache
+        self.max_concurrent = max_concurrent
+        self.scratch_dir = scratch_dir
+        self.governor = governor
+        self.instrumentation = instrumentation
+        self._version = None
+        self._async_semaphore = None
+
+    def version(self):
+        """The version string reported by the elastix executable."""
+        if self._version is None:
+            try:
+                out = subprocess.check_output([self.elastix_path, '--version'])
+            except (OSError, subprocess.CalledProcessError) as ex:
+                raise ElastixError('Quit with error', ex)
+            self._version = out.decode('utf-8', 'replace').strip()
+        return self._version
+
+    def _cache_key(self, parameters,
+                   fixed_image, moving_image,
+                   fixed_points, moving_points,
+                   fixed_mask, moving_mask,
+                   initial_transform):
+        return self.cache.key(self.version(), parameters,
+                              fixed_image=fixed_image,
+                              moving_image=moving_image,
+                              fixed_mask=fixed_mask,
+                              moving_mask=moving_mask,
+                              fixed_points=fixed_points,
+                              moving_points=moving_points,
+                              initial_transform=initial_transform)
+
+    def _cached(self, run, output_dir, parameters,
+                fixed_image, moving_image,
+                fixed_points, moving_points,
+                fixed_mask, moving_mask,
+                initial_transform):
+        """
+        Call `run` with the directory elastix should write to, unless the
+        registration is found in the cache.
+        """
+        if self.cache is None:
+            return run(output_dir)
+
+        key = self._cache_key(parameters,
+                              fixed_image, moving_image,
+                              fixed_points, moving_points,
+                              fixed_mask, moving_mask,
+                              initial_transform)
+        if self.cache.restore(key, output_dir, initial_transform):
+            return
+        with self._private_output(output_dir) as work:
+            run(work.path)
+            self.cache.store(key, work.path, initial_transform)
+
+    @contextmanager
+    def _private_output(self, output_dir):
+        """
+        Yield a private directory for the output of a single run inside
+        `output_dir`, so that only its own files end up in the cache.
+        All files are moved (renamed) to `output_dir` afterwards; the log
+        of a failed run is kept as well.
+        """
+        with scratch.ScratchDir('.elastix-run-', output_dir) as work:
+            try:
+                yield work
+            except ElastixError:
+                work.promote_matching(['elastix.log'], output_dir)
+                raise
+            work.promote_matching(['*'], output_dir)
 
     def _command(self, output_dir, parameter_files,
                  fixed_image, moving_image,
                  fixed_points, moving_points,
                  fixed_mask, moving_mask,
-                 initial_transform
+                 initial_transform,
+                 threads=None
                  ):
 
         command = [self.elastix_path]
@@ -71,50 +220,39 @@ class ElastixInterface:
 
         command += ['-out', output_dir]
 
+        if threads:
+            command += ['-threads', str(threads)]
+
         return command
 
     def _execute(self, command, verbose):
         logger.info('Started command ' + ' '.join(command))
-        err = ''
-
-        # Function to cleanly kill all processes post registration
-        def kill_child(child_pid):  # Sorry if that sounds cruel
-            if child_pid is None:
-                pass
-            else:
-                def kill_function():
-                    try:
-                        os.kill(child_pid, signal.SIGTERM)
-                    except OSError:
-                        logger.info('Child process {}'
-                                    ' already killed.'.format(child_pid))
-                    return kill_function
-
-        # Actually run the command
-        try:
-            if not verbose:
-                DEVNULL = open(os.devnull, 'wb')
-                proc = subprocess.Popen(command,
-                                        stderr=subprocess.PIPE,
-                                        stdout=DEVNULL)
-                out, err = proc.communicate()
-            else:
-                logger.info(command)
-                print(' '.join(command))
-                proc = subprocess.Popen(command,
-                                        stderr=subprocess.PIPE)
+        if verbose:
+            logger.info(command)
+            print(' '.join(command))
+        self._spawn(command, None if verbose else subprocess.DEVNULL)
+        logger.info('Finished command ' + ' '.join(command))
 
-            # Register the process to be killed post registration
-            # atexit.register(kill_child(proc.pid))
-            proc.wait()
+    def _run(self, command):
+        """
+        Run a command quietly and capture its stderr. Unlike `_execute`
+        this never prints, so it can safely be called from worker threads.
+        """
+        logger.info('Started command ' + ' '.join(command))
+        err = self._spawn(command, subprocess.DEVNULL)
+        logger.info('Finished command ' + ' '.join(command))
+        return err
 
+    def _spawn(self, command, stdout):
+        """Run an instrumented command and return its stderr."""
+        try:
+            returncode, err, tail = instrumentation.run(
+                self.instrumentation, 'elastix', command, stdout)
         except Exception as ex:
             raise ElastixError('Quit with error', ex)
-
-        # Check if succesful
-        if proc.returncode != 0:
-            raise ElastixError(proc.returncode, ' '.join(command))
-        logger.info('Finished command ' + ' '.join(command))
+        if returncode != 0:
+            raise ElastixError(returncode, ' '.join(command), tail)
+        return err
 
     def register(self,
                  parameters,
@@ -126,9 +264,324 @@ class ElastixInterface:
                  moving_points=None,
                  initial_transform=None,
                  output_dir=None,
-                 verbose=True
+                 verbose=True,
+                 threads=None,
+                 callback=None,
+                 early_stopping=None,
+                 artifacts=None,
+                 mode=None,
+                 overrides=None
                  ):
+        """
+        Register the moving image to the fixed image.
+
+        Args:
+            callback: (callable) Called with every `IterationRecord` and
+                      `LogLine` of the run as they are written (see
+                      `register_iter`).
+            early_stopping: (EarlyStopping) Policy evaluated on the live
+                            progress of the run. When it fires, elastix is
+                            terminated and the most advanced transform it
+                            wrote is returned; the policy's `reason` tells
+                            why it stopped. Early stopped runs are never
+                            cached.
+            artifacts: (list) If given, elastix runs in a private scratch
+                       directory and only the files matching these glob
+                       patterns (e.g. ['result.*']) are moved to
+                       `output_dir` afterwards, together with the
+                       transform parameter files, which are always kept.
+                       The elastix.log of a failed run is kept as well.
+            mode: (str) Output mode, one of `OUTPUT_MODES`: 'full' (the
+                  default), 'transform_only' to skip resampling and
+                  writing result images and IterationInfo files (which
+                  are still written when `callback` or `early_stopping`
+                  needs them), or 'compressed' to write compressed
+                  MetaImage results.
+            overrides: (dict) Further parameter overrides for all stages.
+                       Modes and overrides are applied to temporary copies
+                       of the parameter files. The output parameters of
+                       the original files are written back into the
+                       transform parameter files, so that transformix
+                       behaves the same whatever the mode of the run.
+
+        Returns:
+            The path of the final transform parameter file.
+        """
 
+        assert os.path.exists(output_dir)
+        assert type(parameters) is list
+        for prm in parameters:
+            assert type(prm) is str
+
+        if mode is not None or overrides:
+            edits = output_mode_overrides(mode, overrides)
+            if callback is not None or early_stopping is not None:
+                # Progress is read from the IterationInfo files
+                edits.pop('WriteIterationInfo', None)
+            with self._staged_overrides(parameters, edits) as staged:
+                path = self.register(
+                    staged, fixed_image, moving_image,
+                    fixed_mask, moving_mask, fixed_points, moving_points,
+                    initial_transform, output_dir, verbose, threads,
+                    callback, early_stopping, artifacts)
+            _restore_outputs(parameters, edits, output_dir, [path])
+            return path
+
+        if artifacts is not None:
+            with scratch.ScratchDir('.elastix-run-', self.scratch_dir,
+                                    near=output_dir) as work:
+                try:
+                    path = self.register(
+                        parameters, fixed_image, moving_image,
+                        fixed_mask, moving_mask, fixed_points, moving_points,
+                        initial_transform, work.path, verbose, threads,
+                        callback, early_stopping)
+                except ElastixError:
+                    work.promote_matching(['elastix.log'], output_dir)
+                    raise
+                work.promote_matching(
+                    ['TransformParameters.*'] + list(artifacts), output_dir)
+            self.output_dir = output_dir
+            return os.path.join(output_dir, os.path.basename(path))
+
+        self.output_dir = output_dir
+
+        with self._admit(threads, parameters, fixed_image, moving_image,
+                         fixed_mask, moving_mask) as allocation:
+            cmd = allocation.wrap(self._command(output_dir,
+                                                parameters,
+                                                fixed_image, moving_image,
+                                                fixed_points, moving_points,
+                                                fixed_mask, moving_mask,
+                                                initial_transform,
+                                                allocation.threads))
+
+            if early_stopping is not None:
+                return self._register_early_stopping(
+                    cmd, parameters, output_dir, callback, early_stopping)
+
+            def run(directory):
+                command = _replace_output_dir(cmd, directory)
+                if callback is None:
+                    self._execute(command, verbose)
+                else:
+                    for event in self._stream(command, directory):
+                        callback(event)
+
+            self._cached(run,
+                         output_dir, parameters,
+                         fixed_image, moving_image,
+                         fixed_points, moving_points,
+                         fixed_mask, moving_mask,
+                         initial_transform)
+        return os.path.join(output_dir, 'TransformParameters.{}.txt'.format(
+            len(parameters) - 1))
+
+    def _admit(self, threads, parameters, fixed_image, moving_image,
+               fixed_mask, moving_mask):
+        """Reserve resources for a run with the governor, if there is one."""
+        return admit(self.governor, threads,
+                     lambda: estimate_registration_memory(
+                         parameters, fixed_image, moving_image,
+                         fixed_mask, moving_mask))
+
+    @contextmanager
+    def _staged_overrides(self, parameters, edits):
+        """Yield copies of the parameter files with `edits` applied."""
+        if not edits:
+            yield parameters
+            return
+        with scratch.ScratchDir('elastix-prm-', self.scratch_dir) as staging:
+            yield [write_overrides(prm, edits,
+                                   staging.join('parameters.{}.txt'.format(i)))
+                   for i, prm in enumerate(parameters)]
+
+    def _register_early_stopping(self, command, parameters, output_dir,
+                                 callback, early_stopping):
+        # elastix runs 3 resolutions unless told otherwise
+        early_stopping.reset([
+            int(ParameterFile.read(prm).scalar('NumberOfResolutions', 3))
+            for prm in parameters])
+        existing = transform_files(output_dir)
+        with scratch.ScratchDir('elastix-prm-', self.scratch_dir) as staging:
+            # Swap the parameter files for copies that write checkpoints
+            staged = []
+            for i, prm in enumerate(parameters):
+                staged.append(write_overrides(
+                    prm, early_stopping.overrides,
+                    staging.join('parameters.{}.txt'.format(i))))
+            command = _replace_parameter_files(command, staged)
+
+            for event in self._stream(command, output_dir,
+                                      early_stopping=early_stopping):
+                if callback is not None:
+                    callback(event)
+
+        if early_stopping.reason is None:
+            return os.path.join(output_dir, 'TransformParameters.{}.txt'.format(
+                len(parameters) - 1))
+        path = latest_checkpoint(output_dir, existing)
+        if path is None:
+            raise ElastixError('Stopped early ({}) before elastix wrote any '
+                               'transform'.format(early_stopping.reason))
+        return path
+
+    async def register_async(self,
+                             parameters,
+                             fixed_image=None,
+                             moving_image=None,
+                             fixed_mask=None,
+                             moving_mask=None,
+                             fixed_points=None,
+                             moving_points=None,
+                             initial_transform=None,
+                             output_dir=None,
+                             threads=None,
+                             mode=None,
+                             overrides=None
+                             ):
+        """
+        Asyncio variant of `register`. The event loop is never blocked, at
+        most `max_concurrent` elastix processes run at the same time, and
+        cancelling the task terminates the elastix process.
+
+        Returns:
+            The path of the final transform parameter file.
+        """
+        assert os.path.exists(output_dir)
+        assert type(parameters) is list
+        for prm in parameters:
+            assert type(prm) is str
+
+        if mode is not None or overrides:
+            edits = output_mode_overrides(mode, overrides)
+            with self._staged_overrides(parameters, edits) as staged:
+                path = await self.register_async(
+                    staged, fixed_image, moving_image,
+                    fixed_mask, moving_mask, fixed_points, moving_points,
+                    initial_transform, output_dir, threads)
+            _restore_outputs(parameters, edits, output_dir, [path])
+            return path
+
+        async def run(directory):
+            allocation = None
+            if self.governor is not None:
+                # Waiting for resources would block the loop
+                memory = await asyncio.get_running_loop().run_in_executor(
+                    None, estimate_registration_memory, parameters,
+                    fixed_image, moving_image, fixed_mask, moving_mask)
+                allocation = await acquire(self.governor, threads, memory)
+            try:
+                cmd = self._command(directory,
+                                    parameters,
+                                    fixed_image, moving_image,
+                                    fixed_points, moving_points,
+                                    fixed_mask, moving_mask,
+                                    initial_transform,
+                                    threads if allocation is None
+                                    else allocation.threads)
+                if allocation is not None:
+                    cmd = allocation.wrap(cmd)
+                call = instrumentation.call(self.instrumentation,
+                                            'elastix', cmd)
+                try:
+                    returncode, err = await run_process(
+                        cmd, lazy_semaphore(self, self.max_concurrent), call)
+                except OSError as ex:
+                    raise ElastixError('Quit with error', ex)
+                tail = call.finish(returncode, None, err)
+                if returncode != 0:
+                    logger.error(err.decode('utf-8', 'replace'))
+                    raise ElastixError(returncode, ' '.join(cmd), tail)
+            finally:
+                if allocation is not None:
+                    self.governor.release(allocation)
+
+        if self.cache is None:
+            await run(output_dir)
+        else:
+            # Hashing and copying files would block the loop
+            loop = asyncio.get_running_loop()
+            key = await loop.run_in_executor(
+                None, self._cache_key, parameters,
+                fixed_image, moving_image,
+                fixed_points, moving_points,
+                fixed_mask, moving_mask,
+                initial_transform)
+            restored = await loop.run_in_executor(
+                None, self.cache.restore, key, output_dir, initial_transform)
+            if not restored:
+                with self._private_output(output_dir) as work:
+                    await run(work.path)
+                    await loop.run_in_executor(
+                        None, self.cache.store, key, work.path,
+                        initial_transform)
+
+        return os.path.join(output_dir, 'TransformParameters.{}.txt'.format(
+            len(parameters) - 1))
+
+    def _stream(self, command, output_dir, poll_interval=0.2,
+                early_stopping=None):
+        logger.info('Started command ' + ' '.join(command))
+        tail = IterationInfoTail(output_dir)
+        call = instrumentation.call(self.instrumentation, 'elastix', command)
+        try:
+            proc = subprocess.Popen(command,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE)
+        except Exception as ex:
+            raise ElastixError('Quit with error', ex)
+        call.start(proc.pid)
+
+        stopped = False
+        try:
+            for event in stream_process(proc, tail, poll_interval,
+                                        heartbeat=early_stopping is not None):
+                if early_stopping is not None and not stopped and \
+                        early_stopping.update(event, time.time()):
+                    logger.info('Stopping elastix early: ' +
+                                early_stopping.reason)
+                    kill_child(proc.pid)()
+                    stopped = True
+                if event is not None:
+                    yield event
+        finally:
+            # The consumer stopped listening before elastix finished
+            if not instrumentation.exited(proc):
+                kill_child(proc.pid)()
+            usage = instrumentation.wait(proc)
+            stderr = call.finish(proc.returncode, usage,
+                                 getattr(proc, 'stderr_tail', None))
+
+        if stopped:
+            return
+        if proc.returncode != 0:
+            raise ElastixError(proc.returncode, ' '.join(command), stderr)
+        logger.info('Finished command ' + ' '.join(command))
+
+    def register_iter(self,
+                      parameters,
+                      fixed_image=None,
+                      moving_image=None,
+                      fixed_mask=None,
+                      moving_mask=None,
+                      fixed_points=None,
+                      moving_points=None,
+                      initial_transform=None,
+                      output_dir=None,
+                      threads=None,
+                      poll_interval=0.2
+                      ):
+        """
+        Run a registration and follow its progress live.
+
+        This is a generator that yields `IterationRecord`s (stage,
+        resolution, iteration, metric, step size, time and all other
+        columns of the IterationInfo files) as elastix writes them, and a
+        `LogLine` for every line elastix prints. Only new data is read on
+        every poll. If the generator is closed before elastix finishes,
+        the elastix process is terminated.
+        """
         assert os.path.exists(output_dir)
         assert type(parameters) is list
         for prm in parameters:
@@ -141,15 +594,447 @@ class ElastixInterface:
                             fixed_image, moving_image,
                             fixed_points, moving_points,
                             fixed_mask, moving_mask,
-                            initial_transform)
-        self._execute(cmd, verbose)
+                            initial_transform,
+                            threads)
+        return self._stream(cmd, output_dir, poll_interval)
+
+    def register_arrays(self,
+                        parameters,
+                        fixed_image,
+                        moving_image,
+                        fixed_mask=None,
+                        moving_mask=None,
+                        fixed_spacing=None,
+                        moving_spacing=None,
+                        fixed_origin=None,
+                        moving_origin=None,
+                        initial_transform=None,
+                        output_dir=None,
+                        verbose=False,
+                        threads=None
+                        ):
+        """
+        Register NumPy arrays without encoding them into image files.
+
+        The arrays are staged as uncompressed MetaImages in the scratch
+        directory (arrays that are memory maps of a file, such as results
+        of earlier calls, are referenced in place instead of copied), and
+        elastix is told to write its result as a MetaImage as well.
+
+        Args:
+            parameters: (list) Paths to the parameter files.
+            fixed_image, moving_image: (ndarray) Images in C order.
+            fixed_mask, moving_mask: (ndarray) Optional masks, with the
+                                     geometry of the corresponding image.
+            fixed_spacing, moving_spacing: (sequence) Voxel spacing in ITK
+                                           (x, y, z) order.
+            fixed_origin, moving_origin: (sequence) Origin in ITK order.
+            output_dir: (str) Directory for the elastix output. A new
+                        temporary directory is used if it is not given;
+                        it is up to the caller to remove it.
+
+        Returns:
+            A tuple of the result image of the last stage as a read-only
+            `np.memmap`, and the path of the last transform parameter file.
+        """
+        assert type(parameters) is list
+        if output_dir is None:
+            output_dir = scratch.mkdtemp('elastix-out-', self.scratch_dir)
+
+        with scratch.ScratchDir('elastix-in-', self.scratch_dir) as staging:
+            def stage(array, name, spacing, origin):
+                if array is None:
+                    return None
+                return metaimage.stage_array(
+                    array, staging.join(name + '.mhd'),
+                    spacing=spacing, origin=origin)
+
+            staged_parameters = []
+            for i, prm in enumerate(parameters):
+                overrides = {'ResultImageFormat': 'mhd'}
+                if i == len(parameters) - 1:
+                    overrides['WriteResultImage'] = 'true'
+                staged_parameters.append(write_overrides(
+                    prm, overrides,
+                    staging.join('parameters.{}.txt'.format(i))))
+
+            self.register(staged_parameters,
+                          fixed_image=stage(fixed_image, 'fixed',
+                                            fixed_spacing, fixed_origin),
+                          moving_image=stage(moving_image, 'moving',
+                                             moving_spacing, moving_origin),
+                          fixed_mask=stage(fixed_mask, 'fixed_mask',
+                                           fixed_spacing, fixed_origin),
+                          moving_mask=stage(moving_mask, 'moving_mask',
+                                            moving_spacing, moving_origin),
+                          initial_transform=initial_transform,
+                          output_dir=output_dir,
+                          verbose=verbose,
+                          threads=threads)
+
+        last = len(parameters) - 1
+        result = metaimage.read_mhd(
+            os.path.join(output_dir, 'result.{}.mhd'.format(last)))
+        transform = os.path.join(output_dir,
+                                 'TransformParameters.{}.txt'.format(last))
+        return result, transform
+
+    def register_job(self, job, threads=None):
+        """
+        Run a single job of `register_many` in the calling thread.
+
+        Args:
+            job: (dict) The keyword arguments of `register` (at least
+                 `parameters` and `output_dir`).
+            threads: (int) Value passed to elastix' `-threads` option,
+                     unless the job has its own `threads` entry.
+
+        Returns:
+            A `RegistrationResult`. Exceptions are not raised but stored
+            in its `error` attribute.
+        """
+        start = time.time()
+        try:
+            parameters = job['parameters']
+            output_dir = job.get('output_dir')
+            assert output_dir is not None and os.path.exists(output_dir)
+            assert type(parameters) is list
+            for prm in parameters:
+                assert type(prm) is str
+            edits = output_mode_overrides(job.get('mode'),
+                                          job.get('overrides'))
+            with self._staged_overrides(parameters, edits) as staged, \
+                    self._admit(job.get('threads', threads), staged,
+                                job.get('fixed_image'),
+                                job.get('moving_image'),
+                                job.get('fixed_mask'),
+                                job.get('moving_mask')) as allocation:
+                cmd = allocation.wrap(self._command(
+                    output_dir,
+                    staged,
+                    job.get('fixed_image'),
+                    job.get('moving_image'),
+                    job.get('fixed_points'),
+                    job.get('moving_points'),
+                    job.get('fixed_mask'),
+                    job.get('moving_mask'),
+                    job.get('initial_transform'),
+                    allocation.threads))
+                self._cached(lambda directory: self._run(
+                                 _replace_output_dir(cmd, directory)),
+                             output_dir, staged,
+                             job.get('fixed_image'),
+                             job.get('moving_image'),
+                             job.get('fixed_points'),
+                             job.get('moving_points'),
+                             job.get('fixed_mask'),
+                             job.get('moving_mask'),
+                             job.get('initial_transform'))
+            if edits:
+                _restore_outputs(parameters, edits, output_dir)
+        except Exception as ex:
+            return RegistrationResult(job, error=ex,
+                                      elapsed=time.time() - start)
+        return RegistrationResult(job, elapsed=time.time() - start)
+
+    def register_many(self, jobs, max_workers=None, threads_per_job=None):
+        """
+        Run a batch of registrations concurrently.
+
+        Args:
+            jobs: (list) Each job is a dict with the keyword arguments of
+                  `register` (at least `parameters` and `output_dir`).
+                  Every job needs its own output directory.
+            max_workers: (int) Number of elastix processes that run at the
+                         same time. Defaults to the number of available
+                         cores divided by `threads_per_job`.
+            threads_per_job: (int) Value passed to elastix' `-threads`
+                             option. Defaults to the available cores divided
+                             by `max_workers`, so that the batch as a whole
+                             does not oversubscribe the machine. A job can
+                             override it with its own `threads` entry. With
+                             a governor, the default is that of the
+                             governor, which also holds jobs back until
+                             their cores and memory are free.
+
+        Returns:
+            A list of `RegistrationResult` objects in the order of `jobs`.
+            Failed jobs do not stop the batch; their exception is stored in
+            the `error` attribute of the result.
+        """
+        jobs = list(jobs)
+        if not jobs:
+            return []
+
+        max_workers, threads_per_job = worker_budget(
+            len(jobs), max_workers, threads_per_job, self.governor)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(self.register_job, job, threads_per_job)
+                       for job in jobs]
+            return [future.result() for future in futures]
+
+    def register_series(self,
+                        parameters,
+                        images,
+                        output_dir,
+                        reference=0,
+                        parents=None,
+                        masks=None,
+                        warm_start=True,
+                        drop_resolutions=0,
+                        bake_warm_start=False,
+                        transformix_path=None,
+                        max_workers=None,
+                        threads_per_job=None
+                        ):
+        """
+        Register the timepoints of a longitudinal series to a reference
+        timepoint, warm-starting every registration from the transform of
+        a neighbouring timepoint.
+
+        By default the series is registered outward from the reference:
+        timepoint t > reference starts from the result of t - 1, and
+        t < reference from t + 1, so the two sides run concurrently. Any
+        other tree can be given with `parents`. The transformix warps of
+        registered timepoints run while later timepoints are still being
+        registered.
+
+        Args:
+            parameters: (list) Paths to the parameter files.
+            images: (list) Image of every timepoint.
+            output_dir: (str) Timepoint t is registered in subdirectory
+                        timepoint_<t>.
+            reference: (int) Index of the fixed (reference) timepoint.
+            parents: (dict) Maps a timepoint to the timepoint it is warm
+                     started from. Timepoints mapped to `reference` (or
+                     missing) start cold.
+            masks: (list) Optional mask of every timepoint; the mask of the
+                   reference is used as fixed mask.
+            warm_start: (bool) Pass the parent's transform via `-t0`.
+            drop_resolutions: (int) Number of coarse resolutions to skip
+                              in warm started registrations.
+            bake_warm_start: (bool) Bake the parent's transform chain into a
+                             single deformation field before using it, so
+                             chains do not grow along the series.
+            transformix_path: (str) If given, every registered timepoint is
+                              warped to the reference into
+                              timepoint_<t>/warped.
+            max_workers, threads_per_job: As in `register_many`.
+
+        Returns:
+            A dict mapping every timepoint except the reference to its
+            `SeriesResult`.
+        """
+        images = list(images)
+        timepoints = [t for t in range(len(images)) if t != reference]
+        if parents is None:
+            parents = dict((t, t - 1 if t > reference else t + 1)
+                           for t in timepoints)
+        children = dict((t, []) for t in range(len(images)))
+        for t in timepoints:
+            children[parents.get(t, reference)].append(t)
+
+        warm_parameters = parameters
+        if warm_start and drop_resolutions:
+            staging = os.path.join(output_dir, 'warm_start_parameters')
+            if not os.path.exists(staging):
+                os.makedirs(staging)
+            warm_parameters = [
+                drop_coarse_resolutions(
+                    prm, drop_resolutions,
+                    os.path.join(staging, 'parameters.{}.txt'.format(i)))
+                for i, prm in enumerate(parameters)]
+
+        max_workers, threads_per_job = worker_budget(
+            len(timepoints), max_workers, threads_per_job, self.governor)
+
+        results = {}
+
+        def job(t):
+            directory = os.path.join(output_dir, 'timepoint_{}'.format(t))
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            parent = parents.get(t, reference)
+            initial = None
+            if warm_start and parent != reference:
+                initial = results[parent].transform
+                if bake_warm_start:
+                    initial = bake_chain(initial, directory,
+                                         prefix='WarmStart')
+            return {'parameters': warm_parameters if initial else parameters,
+                    'fixed_image': images[reference],
+                    'moving_image': images[t],
+                    'fixed_mask': masks[reference] if masks else None,
+                    'moving_mask': masks[t] if masks else None,
+                    'initial_transform': initial,
+                    'output_dir': directory}
+
+        def run(t):
+            try:
+                registration_job = job(t)
+            except Exception as ex:
+                return RegistrationResult({'output_dir': os.path.join(
+                    output_dir, 'timepoint_{}'.format(t))}, error=ex)
+            return self.register_job(registration_job, threads_per_job)
+
+        def warp(result):
+            directory = os.path.join(result.output_dir, 'warped')
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            return TransformixInterface(result.transform, transformix_path) \
+                .transform_image(result.image, output_dir=directory,
+                                 verbose=False)
+
+        def skip(t, error):
+            # Timepoints that depend on a failed one cannot be warm started
+            results[t] = SeriesResult(t, images[t], RegistrationResult(
+                {'output_dir': None}, error=error), len(parameters))
+            for child in children[t]:
+                skip(child, error)
+
+        warps = {}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor, \
+                ThreadPoolExecutor(max_workers=max_workers) as warper:
+            running = dict((executor.submit(run, t), t)
+                           for t in children[reference])
+            while running:
+                finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    t = running.pop(future)
+                    result = SeriesResult(t, images[t], future.result(),
+                                          len(parameters))
+                    results[t] = result
+                    if result.success and transformix_path is not None:
+                        warps[t] = warper.submit(warp, result)
+                    for child in children[t]:
+                        if result.success:
+                            running[executor.submit(run, child)] = child
+                        else:
+                            skip(child, result.error)
+            for t, future in warps.items():
+                try:
+                    results[t].warped = future.result()
+                except Exception as ex:
+                    results[t].error = ex
+        return results
+
+
+class SeriesResult(object):
+    """Outcome of one timepoint of `ElastixInterface.register_series`."""
+    def __init__(self, timepoint, image, result, stages):
+        self.timepoint = timepoint
+        self.image = image
+        self.output_dir = result.output_dir
+        self.initial_transform = result.job.get('initial_transform')
+        self.error = result.error
+        self.elapsed = result.elapsed
+        self.transform = None
+        if result.success:
+            self.transform = os.path.join(
+                self.output_dir, 'TransformParameters.{}.txt'.format(stages - 1))
+        self.warped = None
+
+    @property
+    def success(self):
+        return self.error is None
+
+    def __repr__(self):
+        status = 'ok' if self.success else 'failed: {!r}'.format(self.error)
+        return 'SeriesResult({}, {})'.format(self.timepoint, status)
+
+
+class RegistrationResult(object):
+    """Outcome of a single job of `ElastixInterface.register_many`."""
+    def __init__(self, job, error=None, elapsed=None):
+        self.job = job
+        self.output_dir = job.get('output_dir')
+        self.error = error
+        self.elapsed = elapsed
+
+    @property
+    def success(self):
+        return self.error is None
+
+    def __repr__(self):
+        status = 'ok' if self.success else 'failed: {!r}'.format(self.error)
+        return 'RegistrationResult({!r}, {}, {:.2f} s)'.format(
+            self.output_dir, status, self.elapsed or 0.0)
+
+
+def output_mode_overrides(mode=None, overrides=None):
+    """
+    The parameter overrides of an output mode of `register` (see
+    `OUTPUT_MODES`), updated with the dict `overrides`.
+    """
+    mode = 'full' if mode is None else mode
+    if mode not in OUTPUT_MODES:
+        raise ValueError('Unknown output mode {!r}, expected one of {}'
+                         .format(mode, ', '.join(sorted(OUTPUT_MODES))))
+    edits = dict(OUTPUT_MODES[mode])
+    edits.update(overrides or {})
+    return edits
+
+
+def _restore_outputs(parameters, edits, output_dir, paths=()):
+    """
+    Write the values the original parameter files have for the output
+    parameters transformix reads back into the transform parameter files
+    of a run that overrode them with `edits`: the final transform of every
+    stage in `output_dir`, and `paths`.
+    """
+    keys = [key for key in edits if key in TRANSFORMIX_OUTPUT_DEFAULTS]
+    if not keys:
+        return
+    paths = set(paths)
+    for i in range(len(parameters)):
+        paths.add(os.path.join(output_dir,
+                               'TransformParameters.{}.txt'.format(i)))
+    originals = [ParameterFile.read(prm) for prm in parameters]
+    for path in paths:
+        match = re.match(r'TransformParameters\.(\d+)\.',
+                         os.path.basename(path))
+        if match is None or not os.path.exists(path):
+            continue
+        original = originals[min(int(match.group(1)), len(originals) - 1)]
+        restore = {}
+        for key in keys:
+            value = original.get(key)
+            restore[key] = TRANSFORMIX_OUTPUT_DEFAULTS[key] if value is None \
+                else value
+        write_overrides(path, restore, path)
+
+
+def _replace_output_dir(command, output_dir):
+    """Return a copy of `command` that writes to another directory."""
+    command = list(command)
+    command[command.index('-out') + 1] = output_dir
+    return command
+
+
+def _replace_parameter_files(command, parameter_files):
+    """Return a copy of `command` with other parameter files."""
+    command = list(command)
+    parameter_files = iter(parameter_files)
+    for i, arg in enumerate(command[:-1]):
+        if arg == '-p':
+            command[i + 1] = next(parameter_files)
+    return command
 
 
 class ElastixError(Exception):
     """Exception at error in Elastix command."""
-    def __init__(self, returncode, command):
-        message = ('Elastix crashed with code'
-                   ' {0} for command \'{1}\'.').format(returncode, command)
+    def __init__(self, returncode, command=None, stderr=None):
+        if command is None:
+            message = str(returncode)
+        else:
+            message = ('Elastix crashed with code'
+                       ' {0} for command \'{1}\'.').format(returncode, command)
+        if stderr:
+            message += '\n' + '\n'.join(stderr)
+        self.returncode = returncode
+        # Last lines elastix wrote to stderr
+        self.stderr = stderr or []
         super(ElastixError, self).__init__(message)
         self.message = message
 
@@ -0,0 +1,356 @@
+#!/usr/bin/env python
+#
+# Structured instrumentation of elastix and transformix processes. Every
+# process started by ElastixInterface or TransformixInterface is wrapped
+# in a `Call`, which emits a 'start' and an 'end' event to the sinks of an
+# `Instrumentation`. End events carry the wall time, the CPU time and peak
+# resident memory of the child (from wait4), the bytes written to the
+# output directory, the durations reported in elastix.log or
+# transformix.log, and the tail of the captured stderr.
+#
+# A sink is any callable that takes an event dict. `JsonLinesSink` appends
+# events to a file, and `PrometheusCounters` aggregates them into
+# counters in the Prometheus text format.
+
+
+from __future__ import division, print_function
+
+import collections
+import itertools
+import json
+import logging
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+# Number of stderr lines kept for events and exceptions
+STDERR_TAIL_LINES = 20
+
+# Durations reported in the log files, e.g. 'Time spent in resolution 0
+# (ITK initialization and iterating): 1.23 s.' or 'Registration took 4.5
+# s.'
+_DURATION = re.compile(
+    r'^\s*(?P<label>[^\n]*?(?:took|time spent[^:\n]*|elapsed time|'
+    r'total time elapsed))\s*:?\s*(?P<value>\d+(?:\.\d*)?(?:[eE][-+]?\d+)?)'
+    r'\s*(?P<unit>ms|s|sec|seconds)\b', re.IGNORECASE | re.MULTILINE)
+
+_ids = itertools.count(1)
+
+
+def stage_timings(path):
+    """
+    Durations reported in an elastix.log or transformix.log.
+
+    Returns:
+        An OrderedDict mapping the text of every line that reports a
+        duration to the duration in seconds. Durations reported more than
+        once with the same text are summed.
+    """
+    timings = collections.OrderedDict()
+    try:
+        with open(path) as f:
+            text = f.read()
+    except (IOError, OSError):
+        return timings
+    for match in _DURATION.finditer(text):
+        label = re.sub(r'\s+took$', '', match.group('label').strip(),
+                       flags=re.IGNORECASE)
+        seconds = float(match.group('value'))
+        if match.group('unit').lower() == 'ms':
+            seconds /= 1000.0
+        timings[label] = timings.get(label, 0.0) + seconds
+    return timings
+
+
+def stderr_tail(err, lines=STDERR_TAIL_LINES):
+    """The last `lines` lines of captured stderr, as a list of strings."""
+    if err is None:
+        return []
+    if isinstance(err, bytes):
+        err = err.decode('utf-8', 'replace')
+    if not isinstance(err, str):
+        # E.g. the deque of `progress.stream_process`
+        return list(err)[-lines:]
+    return err.splitlines()[-lines:]
+
+
+def _exit_code(status):
+    if hasattr(os, 'waitstatus_to_exitcode'):
+        return os.waitstatus_to_exitcode(status)
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def wait(proc):
+    """
+    Wait for a `subprocess.Popen` like `proc.wait()`, and return the
+    resource usage of the child from wait4, or None where it is not
+    available (Windows, or a child that was already reaped).
+    """
+    if proc.returncode is not None or not hasattr(os, 'wait4'):
+        proc.wait()
+        return None
+    try:
+        _, status, usage = os.wait4(proc.pid, 0)
+    except ChildProcessError:
+        proc.wait()
+        return None
+    proc.returncode = _exit_code(status)
+    return usage
+
+
+def exited(proc):
+    """
+    Whether a `subprocess.Popen` has exited, like `proc.poll() is not
+    None` but without reaping the child, so that `wait` still gets its
+    resource usage.
+    """
+    if proc.returncode is not None:
+        return True
+    if hasattr(os, 'waitid'):
+        try:
+            return os.waitid(os.P_PID, proc.pid, os.WEXITED | os.WNOHANG |
+                             os.WNOWAIT) is not None
+        except ChildProcessError:
+            pass
+    return proc.poll() is not None
+
+
+def _output_dir(command):
+    try:
+        return command[command.index('-out') + 1]
+    except (ValueError, IndexError):
+        return None
+
+
+def _bytes_written(directory, since):
+    total = 0
+    try:
+        entries = os.listdir(directory)
+    except OSError:
+        return None
+    for name in entries:
+        try:
+            st = os.stat(os.path.join(directory, name))
+        except OSError:
+            continue
+        if st.st_mtime >= since:
+            total += st.st_size
+    return total
+
+
+class Call(object):
+    """
+    One elastix or transformix process. `finish` must be called once the
+    process has exited; it returns the stderr tail for exceptions. Without
+    an instrumentation nothing is measured or emitted.
+    """
+
+    def __init__(self, instrumentation, tool, command):
+        self.instrumentation = instrumentation
+        self.tool = tool
+        self.command = list(command)
+        self.id = next(_ids)
+        self.output_dir = _output_dir(self.command)
+        self.start_time = None
+
+    def start(self, pid=None):
+        self.start_time = time.time()
+        if self.instrumentation is not None:
+            self.instrumentation.emit(self._event(
+                'start', time=self.start_time, pid=pid))
+
+    def finish(self, returncode, usage=None, err=None):
+        tail = stderr_tail(err)
+        if self.instrumentation is None:
+            return tail
+        end = time.time()
+        event = self._event('end', time=end, returncode=returncode,
+                            success=returncode == 0)
+        event['wall_time'] = end - self.start_time \
+            if self.start_time is not None else None
+        if usage is not None:
+            event['user_time'] = usage.ru_utime
+            event['system_time'] = usage.ru_stime
+            event['cpu_time'] = usage.ru_utime + usage.ru_stime
+            # Kilobytes on Linux, bytes on macOS
+            event['peak_rss'] = usage.ru_maxrss if sys.platform == 'darwin' \
+                else usage.ru_maxrss * 1024
+        else:
+            event['user_time'] = event['system_time'] = None
+            event['cpu_time'] = event['peak_rss'] = None
+        if self.output_dir is not None and self.start_time is not None:
+            # Leave some slack for file systems with coarse timestamps
+            event['bytes_written'] = _bytes_written(self.output_dir,
+                                                    self.start_time - 1)
+            event['stages'] = stage_timings(os.path.join(
+                self.output_dir, self.tool + '.log'))
+        event['stderr_tail'] = tail
+        self.instrumentation.emit(event)
+        return tail
+
+    def _event(self, kind, **fields):
+        event = collections.OrderedDict([('event', kind),
+                                         ('tool', self.tool),
+                                         ('id', self.id),
+                                         ('command', self.command),
+                                         ('output_dir', self.output_dir)])
+        event.update(fields)
+        return event
+
+
+class Instrumentation(object):
+    """
+    Dispatches the events of all instrumented calls to a list of sinks.
+
+    >>> counters = PrometheusCounters()
+    >>> instrumentation = Instrumentation(JsonLinesSink('calls.jsonl'),
+    ...                                   counters)
+    >>> el = ElastixInterface(ELASTIX_PATH, instrumentation=instrumentation)
+    >>> tr = TransformixInterface(tp, TRANSFORMIX_PATH,
+    ...                           instrumentation=instrumentation)
+    >>> counters.write('/var/lib/node_exporter/elastix.prom')
+
+    Args:
+        sinks: Callables that receive every event, a dict with at least
+               'event' ('start' or 'end'), 'tool', 'id' (shared by the
+               start and end of a call), 'command' and 'output_dir'.
+    """
+
+    def __init__(self, *sinks):
+        self.sinks = list(sinks)
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    def emit(self, event):
+        # A broken sink must not break registrations
+        for sink in self.sinks:
+            try:
+                sink(event)
+            except Exception:
+                logger.exception('Instrumentation sink {!r} failed'.format(sink))
+
+
+def call(instrumentation, tool, command):
+    """A `Call` on `instrumentation`, which may be None."""
+    return Call(instrumentation, tool, command)
+
+
+def run(instrumentation, tool, command, stdout=None):
+    """
+    Run `command` as an instrumented call, with its stderr captured and
+    its stdout sent to `stdout` (inherited by default).
+
+    Returns:
+        A tuple (returncode, stderr bytes, stderr tail).
+
+    Raises:
+        Whatever Popen raises if the command cannot be started.
+    """
+    c = call(instrumentation, tool, command)
+    proc = subprocess.Popen(command, stdout=stdout, stderr=subprocess.PIPE)
+    c.start(proc.pid)
+    try:
+        err = proc.stderr.read()
+    finally:
+        proc.stderr.close()
+        usage = wait(proc)
+    return proc.returncode, err, c.finish(proc.returncode, usage, err)
+
+
+class JsonLinesSink(object):
+    """Appends every event as a line of JSON to a file (or file object)."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        line = json.dumps(event, default=str) + '\n'
+        with self._lock:
+            if hasattr(self.path, 'write'):
+                self.path.write(line)
+                self.path.flush()
+            else:
+                with open(self.path, 'a') as f:
+                    f.write(line)
+
+
+class PrometheusCounters(object):
+    """
+    Aggregates end events into counters per tool, in the Prometheus text
+    exposition format: the number of calls by status, and the totals of
+    wall time, CPU time, bytes written and the logged stage durations, and
+    the largest peak resident memory seen.
+    """
+
+    PREFIX = 'elastix_py_'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = collections.Counter()
+        self.totals = collections.Counter()
+        self.stages = collections.Counter()
+        self.peak_rss = {}
+
+    def __call__(self, event):
+        if event.get('event') != 'end':
+            return
+        tool = event['tool']
+        with self._lock:
+            status = 'success' if event.get('success') else 'failure'
+            self.calls[tool, status] += 1
+            for key in ('wall_time', 'cpu_time', 'bytes_written'):
+                if event.get(key) is not None:
+                    self.totals[tool, key] += event[key]
+            for stage, seconds in (event.get('stages') or {}).items():
+                self.stages[tool, stage] += seconds
+            if event.get('peak_rss') is not None:
+                self.peak_rss[tool] = max(self.peak_rss.get(tool, 0),
+                                          event['peak_rss'])
+
+    def render(self):
+        p = self.PREFIX
+        names = {'wall_time': ('wall_seconds_total', 'counter'),
+                 'cpu_time': ('cpu_seconds_total', 'counter'),
+                 'bytes_written': ('written_bytes_total', 'counter')}
+        lines = []
+        with self._lock:
+            lines.append('# TYPE {}calls_total counter'.format(p))
+            for (tool, status), n in sorted(self.calls.items()):
+                lines.append('{}calls_total{{tool="{}",status="{}"}} {}'
+                             .format(p, tool, status, n))
+            for key, (name, kind) in names.items():
+                lines.append('# TYPE {}{} {}'.format(p, name, kind))
+                for (tool, k), value in sorted(self.totals.items()):
+                    if k == key:
+                        lines.append('{}{}{{tool="{}"}} {}'.format(
+                            p, name, tool, value))
+            lines.append('# TYPE {}stage_seconds_total counter'.format(p))
+            for (tool, stage), seconds in sorted(self.stages.items()):
+                lines.append('{}stage_seconds_total{{tool="{}",stage="{}"}} {}'
+                             .format(p, tool, _escape(stage), seconds))
+            lines.append('# TYPE {}peak_rss_bytes gauge'.format(p))
+            for tool, rss in sorted(self.peak_rss.items()):
+                lines.append('{}peak_rss_bytes{{tool="{}"}} {}'.format(
+                    p, tool, rss))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """Write the counters atomically, e.g. for a textfile collector."""
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(self.render())
+        os.replace(tmp, path)
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', ' ')
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+#
+# Vectorized interpolation of NumPy volumes at continuous voxel indices.
+# Indices are in C order (z, y, x), matching the array axes; volumes may
+# have a trailing component axis (vector images) that is not interpolated.
+#
+# B-spline interpolation works on coefficients computed by `prefilter`,
+# with mirrored boundaries like itk::BSplineInterpolateImageFunction.
+
+
+from __future__ import division, print_function
+
+import itertools
+
+import numpy as np
+
+
+def linear(volume, cindex, fill=0.0):
+    """
+    N-linear interpolation of `volume` at the (N, ndim) continuous indices
+    `cindex`. Points more than half a voxel outside the volume get `fill`;
+    points within half a voxel of its edge take the value at the edge,
+    like itk::LinearInterpolateImageFunction.
+    """
+    cindex = np.asarray(cindex, dtype=float)
+    ndim = cindex.shape[1]
+    shape = np.asarray(volume.shape[:ndim])
+    component_shape = volume.shape[ndim:]
+
+    inside = np.all((cindex >= -0.5) & (cindex < shape - 0.5), axis=1)
+    cindex = np.clip(cindex, 0, shape - 1)
+    base = np.clip(np.floor(cindex).astype(int), 0, np.maximum(shape - 2, 0))
+    frac = cindex - base
+
+    result = np.zeros((len(cindex),) + component_shape)
+    for corner in itertools.product((0, 1), repeat=ndim):
+        corner = np.asarray(corner)
+        index = np.minimum(base + corner, shape - 1)
+        weight = np.prod(np.where(corner, frac, 1.0 - frac), axis=1)
+        values = volume[tuple(index.T)]
+        result += weight.reshape((-1,) + (1,) * len(component_shape)) * values
+    result[~inside] = fill
+    return result
+
+
+def nearest(volume, cindex, fill=0.0):
+    """
+    Nearest neighbour interpolation of `volume` at the (N, ndim)
+    continuous indices `cindex`. Points more than half a voxel outside the
+    volume get `fill`.
+    """
+    cindex = np.asarray(cindex, dtype=float)
+    ndim = cindex.shape[1]
+    shape = np.asarray(volume.shape[:ndim])
+    index = np.floor(cindex + 0.5).astype(int)
+    inside = np.all((index >= 0) & (index < shape), axis=1)
+    index = np.clip(index, 0, shape - 1)
+    result = np.array(volume[tuple(index.T)], dtype=float)
+    result[~inside] = fill
+    return result
+
+
+def bspline_kernel(t, order):
+    """Centered B-spline of the given order (0 to 3), evaluated at t."""
+    t = np.abs(t)
+    if order == 0:
+        return (t < 0.5).astype(float)
+    if order == 1:
+        return np.maximum(0.0, 1.0 - t)
+    if order == 2:
+        return np.where(t < 0.5, 0.75 - t * t,
+                        np.where(t < 1.5, 0.5 * (1.5 - t) ** 2, 0.0))
+    if order == 3:
+        return np.where(t < 1.0, (4.0 - 6.0 * t * t + 3.0 * t ** 3) / 6.0,
+                        np.where(t < 2.0, (2.0 - t) ** 3 / 6.0, 0.0))
+    raise ValueError('Unsupported B-spline order {}'.format(order))
+
+
+# Poles of the B-spline prefilters
+POLES = {
+    2: [np.sqrt(8.0) - 3.0],
+    3: [np.sqrt(3.0) - 2.0],
+}
+
+
+def _prefilter_axis(c, pole, tolerance):
+    # In-place causal and anticausal recursive filters along axis 0 of c,
+    # for mirrored boundary conditions (Unser, 1999)
+    n = len(c)
+    horizon = int(np.ceil(np.log(tolerance) / np.log(abs(pole))))
+    if horizon < n:
+        powers = pole ** np.arange(horizon)
+        c[0] = np.tensordot(powers, c[:horizon], axes=1)
+    else:
+        # Exact initialization for short signals: the mirrored signal has
+        # period 2 (n - 1)
+        k = np.arange(1, n - 1)
+        weights = pole ** k + pole ** (2 * (n - 1) - k)
+        c[0] = (c[0] + pole ** (n - 1) * c[n - 1] +
+                np.tensordot(weights, c[1:n - 1], axes=1)) / \
+            (1.0 - pole ** (2 * (n - 1)))
+    for k in range(1, n):
+        c[k] += pole * c[k - 1]
+    c[n - 1] = (pole / (pole * pole - 1.0)) * (c[n - 1] + pole * c[n - 2])
+    for k in range(n - 2, -1, -1):
+        c[k] = pole * (c[k + 1] - c[k])
+
+
+def prefilter(volume, order=3, ndim=None, tolerance=1e-10):
+    """
+    Compute the B-spline coefficients of `volume`, so that B-spline
+    interpolation of the coefficients reproduces the volume at the grid
+    points. Only the first `ndim` axes are filtered (all by default).
+    """
+    c = np.array(volume, dtype=float)
+    if order < 2:
+        return c
+    ndim = c.ndim if ndim is None else ndim
+    for axis in range(ndim):
+        if c.shape[axis] < 2:
+            continue
+        view = np.moveaxis(c, axis, 0)
+        for pole in POLES[order]:
+            view *= (1.0 - pole) * (1.0 - 1.0 / pole)
+            _prefilter_axis(view, pole, tolerance)
+    return c
+
+
+def _mirror(index, size):
+    if size == 1:
+        return np.zeros_like(index)
+    period = 2 * (size - 1)
+    index = np.abs(index) % period
+    return np.where(index >= size, period - index, index)
+
+
+def bspline(coefficients, cindex, order=3, fill=0.0):
+    """
+    B-spline interpolation at the (N, ndim) continuous indices `cindex`
+    of the coefficients computed by `prefilter`. Points more than half a
+    voxel outside the volume get `fill`.
+    """
+    cindex = np.asarray(cindex, dtype=float)
+    ndim = cindex.shape[1]
+    shape = coefficients.shape[:ndim]
+    component_shape = coefficients.shape[ndim:]
+    inside = np.all((cindex >= -0.5) & (cindex < np.asarray(shape) - 0.5),
+                    axis=1)
+
+    start = np.floor(cindex - (order - 1) / 2.0).astype(int)
+    offsets = np.arange(order + 1)
+    # weights[n, d, k] is the weight of support node k in dimension d
+    weights = bspline_kernel(
+        cindex[:, :, None] - (start[:, :, None] + offsets), order)
+    nodes = [_mirror(start[:, d, None] + offsets, shape[d])
+             for d in range(ndim)]
+
+    result = np.zeros((len(cindex),) + component_shape)
+    for combination in itertools.product(offsets, repeat=ndim):
+        index = tuple(nodes[d][:, k] for d, k in enumerate(combination))
+        w = np.prod([weights[:, d, k] for d, k in enumerate(combination)],
+                    axis=0)
+        result += w.reshape((-1,) + (1,) * len(component_shape)) * \
+            coefficients[index]
+    result[~inside] = fill
+    return result
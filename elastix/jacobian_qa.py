@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+#
+# Quality assurance of transforms from their spatial Jacobian determinant:
+# range, mean, approximate percentiles, the fraction of folded voxels
+# (det <= 0) and per-label means. The statistics are accumulated in a
+# single streaming pass over the memory-mapped spatialJacobian written by
+# transformix, or over determinants computed in-process from a deformation
+# field with finite differences, so memory use does not depend on the size
+# of the volume.
+
+
+from __future__ import division, print_function
+
+import math
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from . import metaimage
+from .resources import available_cores
+
+
+# Number of voxels processed at once
+CHUNK_SIZE = 1 << 20
+
+DEFAULT_PERCENTILES = (1, 5, 25, 50, 75, 95, 99)
+
+
+class QuantileSketch(object):
+    """
+    Mergeable quantile sketch with logarithmic buckets. Every quantile is
+    estimated with a relative error of at most `relative_accuracy`, using
+    memory proportional to the logarithm of the range of the values.
+    Positive, negative and zero values are all supported.
+    """
+
+    def __init__(self, relative_accuracy=0.01):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1.0 + relative_accuracy) / (1.0 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.positive = {}
+        self.negative = {}
+        self.zeros = 0
+        self.count = 0
+
+    def _bucket(self, magnitudes):
+        return np.ceil(np.log(magnitudes) / self._log_gamma).astype(np.int64)
+
+    @staticmethod
+    def _tally(store, keys):
+        keys, counts = np.unique(keys, return_counts=True)
+        for key, count in zip(keys.tolist(), counts.tolist()):
+            store[key] = store.get(key, 0) + count
+
+    def add(self, values):
+        values = np.asarray(values, dtype=float).ravel()
+        values = values[np.isfinite(values)]
+        if values.size == 0:
+            return
+        positive = values[values > 0]
+        negative = values[values < 0]
+        if positive.size:
+            self._tally(self.positive, self._bucket(positive))
+        if negative.size:
+            self._tally(self.negative, self._bucket(-negative))
+        self.zeros += int(values.size - positive.size - negative.size)
+        self.count += int(values.size)
+
+    def merge(self, other):
+        for store, other_store in ((self.positive, other.positive),
+                                   (self.negative, other.negative)):
+            for key, count in other_store.items():
+                store[key] = store.get(key, 0) + count
+        self.zeros += other.zeros
+        self.count += other.count
+
+    def _value(self, key):
+        # Center of the bucket, relative to its bounds
+        return 2.0 * self.gamma ** key / (self.gamma + 1.0)
+
+    def quantile(self, q):
+        """Approximate value of quantile q (0 <= q <= 1)."""
+        if self.count == 0:
+            return float('nan')
+        rank = q * (self.count - 1)
+        seen = 0
+        for key in sorted(self.negative, reverse=True):
+            seen += self.negative[key]
+            if seen > rank:
+                return -self._value(key)
+        seen += self.zeros
+        if seen > rank:
+            return 0.0
+        for key in sorted(self.positive):
+            seen += self.positive[key]
+            if seen > rank:
+                return self._value(key)
+        return self._value(max(self.positive))
+
+
+class JacobianStatistics(object):
+    """
+    Streaming accumulator of Jacobian determinant statistics. Feed it
+    chunks with `add`, and read the results with `summary`.
+    """
+
+    def __init__(self, relative_accuracy=0.01):
+        self.count = 0
+        self.minimum = np.inf
+        self.maximum = -np.inf
+        self.total = 0.0
+        self.total_squares = 0.0
+        self.folded = 0
+        self.sketch = QuantileSketch(relative_accuracy)
+        self.label_sums = np.zeros(0)
+        self.label_counts = np.zeros(0, dtype=np.int64)
+        self.label_folded = np.zeros(0, dtype=np.int64)
+
+    def add(self, determinants, labels=None):
+        values = np.asarray(determinants, dtype=float).ravel()
+        if values.size == 0:
+            return
+        self.count += values.size
+        self.minimum = min(self.minimum, float(values.min()))
+        self.maximum = max(self.maximum, float(values.max()))
+        self.total += float(values.sum())
+        self.total_squares += float(np.dot(values, values))
+        folded = values <= 0
+        self.folded += int(np.count_nonzero(folded))
+        self.sketch.add(values)
+        if labels is not None:
+            self._add_labels(values, folded,
+                             np.asarray(labels).ravel().astype(np.int64))
+
+    def _add_labels(self, values, folded, labels):
+        if labels.size and labels.min() < 0:
+            raise ValueError('Labels must be non-negative integers')
+        size = max(len(self.label_counts), int(labels.max()) + 1)
+        grow = size - len(self.label_counts)
+        if grow > 0:
+            self.label_sums = np.concatenate([self.label_sums, np.zeros(grow)])
+            self.label_counts = np.concatenate(
+                [self.label_counts, np.zeros(grow, dtype=np.int64)])
+            self.label_folded = np.concatenate(
+                [self.label_folded, np.zeros(grow, dtype=np.int64)])
+        self.label_sums += np.bincount(labels, weights=values, minlength=size)
+        self.label_counts += np.bincount(labels, minlength=size)
+        self.label_folded += np.bincount(labels[folded], minlength=size)
+
+    def summary(self, percentiles=DEFAULT_PERCENTILES):
+        """
+        Returns:
+            An OrderedDict with count, min, max, mean, std, the fraction of
+            folded voxels, the requested (approximate) percentiles as
+            'p<q>', and, if labels were given, 'labels': a dict mapping
+            every label to its voxel count, mean determinant and folded
+            fraction.
+        """
+        d = OrderedDict()
+        d['count'] = self.count
+        d['min'] = self.minimum if self.count else float('nan')
+        d['max'] = self.maximum if self.count else float('nan')
+        mean = self.total / self.count if self.count else float('nan')
+        d['mean'] = mean
+        d['std'] = math.sqrt(max(0.0, self.total_squares / self.count -
+                                 mean * mean)) if self.count else float('nan')
+        d['folded_fraction'] = self.folded / self.count if self.count \
+            else float('nan')
+        for p in percentiles:
+            d['p{:g}'.format(p)] = self.sketch.quantile(p / 100.0)
+        if len(self.label_counts):
+            labels = OrderedDict()
+            for label in np.flatnonzero(self.label_counts).tolist():
+                n = int(self.label_counts[label])
+                labels[label] = {'count': n,
+                                 'mean': self.label_sums[label] / n,
+                                 'folded_fraction': self.label_folded[label] / n}
+            d['labels'] = labels
+        return d
+
+
+def _image(image):
+    if isinstance(image, str):
+        image = metaimage.MetaImage(image)
+    if isinstance(image, metaimage.MetaImage):
+        return image
+    return None
+
+
+def _slabs(shape, chunk_size):
+    slice_size = int(np.prod(shape[1:]))
+    step = max(1, chunk_size // max(slice_size, 1))
+    for start in range(0, shape[0], step):
+        yield slice(start, min(start + step, shape[0]))
+
+
+def determinants_from_deformation_field(deformation_field,
+                                        chunk_size=CHUNK_SIZE):
+    """
+    Compute the spatial Jacobian determinant of x + d(x) from a
+    deformation field with central differences (one-sided at the borders,
+    like np.gradient), slab by slab. Each slab is read with a halo of one
+    slice on both sides.
+
+    Yields:
+        (slice, determinants) tuples, the slice being along the first axis
+        of the field.
+    """
+    field = _image(deformation_field)
+    ndim = field.ndim
+    shape = field.shape[:ndim]
+    # Derivatives of the index with respect to physical coordinates
+    inverse = np.linalg.inv(field.direction.dot(np.diag(field.spacing)))
+    for index in _slabs(shape, chunk_size):
+        start = max(index.start - 1, 0)
+        stop = min(index.stop + 1, shape[0])
+        d = np.asarray(field.data[start:stop], dtype=float)
+        # gradients[c][..., a]: derivative of component c along ITK axis a
+        # Axes of a single voxel have no derivative
+        axes = [a for a in range(ndim) if d.shape[a] > 1]
+        gradient = np.zeros(d.shape[:ndim] + (ndim, ndim))
+        for c in range(ndim):
+            parts = np.gradient(d[..., c], axis=axes) if len(axes) > 1 \
+                else [np.gradient(d[..., c], axis=axes[0])]
+            for axis, part in zip(axes, parts):
+                gradient[..., c, ndim - 1 - axis] = part
+        crop = slice(index.start - start, index.stop - start)
+        jacobian = gradient[crop].dot(inverse) + np.eye(ndim)
+        yield index, np.linalg.det(jacobian)
+
+
+def jacobian_statistics(jacobian=None, deformation_field=None, labels=None,
+                        percentiles=DEFAULT_PERCENTILES,
+                        relative_accuracy=0.01, chunk_size=CHUNK_SIZE):
+    """
+    Summary statistics of a spatial Jacobian determinant in constant
+    memory.
+
+    Args:
+        jacobian: (str, MetaImage or ndarray) The determinant, e.g. the
+                  spatialJacobian.mhd written by transformix.
+        deformation_field: (str or MetaImage) Alternatively, a deformation
+                           field from which the determinant is computed
+                           in-process.
+        labels: (str, MetaImage or ndarray) Optional label map on the same
+                grid, for per-label statistics.
+        percentiles: (sequence) Percentiles to estimate.
+        relative_accuracy: (float) Relative error of the percentiles.
+        chunk_size: (int) Number of voxels processed at once.
+
+    Returns:
+        The OrderedDict of `JacobianStatistics.summary`.
+    """
+    stats = JacobianStatistics(relative_accuracy)
+    label_data = None
+    if labels is not None:
+        image = _image(labels)
+        label_data = image.data if image is not None else labels
+
+    if deformation_field is not None:
+        chunks = determinants_from_deformation_field(deformation_field,
+                                                     chunk_size)
+    elif jacobian is not None:
+        image = _image(jacobian)
+        data = image.data if image is not None else jacobian
+        chunks = ((index, data[index])
+                  for index in _slabs(data.shape, chunk_size))
+    else:
+        raise ValueError('Either jacobian or deformation_field is required')
+
+    for index, determinants in chunks:
+        stats.add(determinants,
+                  None if label_data is None else label_data[index])
+    return stats.summary(percentiles)
+
+
+def directory_statistics(output_dir, labels=None, **kwargs):
+    """
+    Statistics of the transformix output in `output_dir`: the spatial
+    Jacobian determinant if it is there, otherwise the deformation field.
+    """
+    jacobian = os.path.join(output_dir, 'spatialJacobian.mhd')
+    if os.path.exists(jacobian):
+        return jacobian_statistics(jacobian, labels=labels, **kwargs)
+    field = os.path.join(output_dir, 'deformationField.mhd')
+    if os.path.exists(field):
+        return jacobian_statistics(deformation_field=field, labels=labels,
+                                   **kwargs)
+    raise IOError('No spatialJacobian.mhd or deformationField.mhd in {}'
+                  .format(output_dir))
+
+
+def batch_statistics(output_dirs, labels=None, max_workers=None, **kwargs):
+    """
+    Compute `directory_statistics` for many output directories on a
+    thread pool.
+
+    Args:
+        output_dirs: (list) transformix output directories.
+        labels: (list) Optional label map per directory.
+
+    Returns:
+        A list of summaries in the order of `output_dirs`; directories
+        that could not be processed get the exception instead.
+    """
+    output_dirs = list(output_dirs)
+    if labels is None:
+        labels = [None] * len(output_dirs)
+
+    def run(output_dir, label_map):
+        try:
+            return directory_statistics(output_dir, label_map, **kwargs)
+        except Exception as ex:
+            return ex
+
+    if not output_dirs:
+        return []
+    workers = min(max_workers or available_cores(), len(output_dirs))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(run, output_dirs, labels))
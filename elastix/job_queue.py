@@ -0,0 +1,469 @@
+#!/usr/bin/env python
+#
+# Crash-resumable job queue for large registration campaigns, stored in a
+# single SQLite file. Any number of worker processes, on this host or on
+# others that share the file system, claim jobs atomically, run them with
+# ElastixInterface or TransformixInterface, and record the outcome.
+#
+# A claimed job holds a lease that its worker renews while the job runs.
+# If the worker dies, the lease runs out and another worker picks the job
+# up again, up to `max_attempts` times. Finished jobs are never run again.
+#
+# Command line usage:
+#
+#   python -m elastix.job_queue campaign.db submit jobs.json
+#   python -m elastix.job_queue campaign.db worker --elastix ELASTIX_PATH
+#   python -m elastix.job_queue campaign.db status
+#
+# Note that SQLite relies on the file locking of the file system; NFS
+# mounts need working (lockd) locks for workers on several hosts.
+
+
+from __future__ import division, print_function
+
+import argparse
+import json
+import logging
+import os
+import socket
+import sqlite3
+import sys
+import threading
+import time
+import traceback
+
+from .elastix_interface import ElastixInterface, DEFAULT_ELASTIX_PATH
+from .transformix_interface import (TransformixInterface,
+                                    DEFAULT_TRANSFORMIX_PATH)
+
+logger = logging.getLogger(__name__)
+
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+STATES = (PENDING, RUNNING, DONE, FAILED)
+
+# Kinds of jobs: elastix registrations and transformix computations
+KINDS = ('register', 'transformix')
+
+DEFAULT_LEASE_SECONDS = 600
+DEFAULT_MAX_ATTEMPTS = 3
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    output_dir TEXT NOT NULL UNIQUE,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    lease_until REAL,
+    submitted REAL NOT NULL,
+    started REAL,
+    finished REAL,
+    duration REAL,
+    result TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, lease_until);
+"""
+
+
+def worker_name():
+    """Identifies a worker process across hosts."""
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+class LeaseLost(Exception):
+    """
+    The lease of a job expired and another claim took the job over, so
+    the outcome of this attempt was not recorded.
+    """
+    def __init__(self, job):
+        self.job = job
+        super(LeaseLost, self).__init__(
+            'Lost the lease of job {}; its outcome was discarded'.format(
+                job.id))
+
+
+class Job(object):
+    """A row of the queue."""
+    def __init__(self, row):
+        self.id = row['id']
+        self.kind = row['kind']
+        self.payload = json.loads(row['payload'])
+        self.output_dir = row['output_dir']
+        self.status = row['status']
+        self.attempts = row['attempts']
+        self.worker = row['worker']
+        self.duration = row['duration']
+        self.result = json.loads(row['result']) if row['result'] else None
+        self.error = row['error']
+
+    def __repr__(self):
+        return 'Job({}, {}, {!r}, {})'.format(self.id, self.kind,
+                                             self.output_dir, self.status)
+
+
+class JobQueue(object):
+    """
+    SQLite-backed queue of elastix and transformix jobs.
+
+    Args:
+        path: (str) The database file. It is created if it does not exist.
+        lease_seconds: (float) How long a claim stays valid without being
+                       renewed. Workers renew it every third of this time.
+        max_attempts: (int) Number of times a job is tried before it is
+                      marked as failed.
+    """
+
+    def __init__(self, path, lease_seconds=DEFAULT_LEASE_SECONDS,
+                 max_attempts=DEFAULT_MAX_ATTEMPTS):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        with self._connect() as connection:
+            connection.executescript(_SCHEMA)
+
+    def _connect(self):
+        # Transactions are managed explicitly, see `_Transaction`
+        connection = sqlite3.connect(self.path, timeout=60,
+                                     isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        return _Connection(connection)
+
+    def submit(self, kind, payload):
+        """
+        Add a job, unless a job with the same output directory exists.
+
+        Args:
+            kind: (str) 'register' for the keyword arguments of
+                  `ElastixInterface.register`, or 'transformix' for a dict
+                  with 'parameters' (the transform parameter file),
+                  'outputs', 'image_path' and 'output_dir', as used by
+                  `TransformixInterface.compute`.
+            payload: (dict) The arguments of the job. 'output_dir' is
+                     required and identifies the job.
+
+        Returns:
+            The id of the job, or None if it was already submitted.
+        """
+        return self.submit_many([(kind, payload)])[0]
+
+    def submit_many(self, jobs):
+        """Submit (kind, payload) pairs in a single transaction."""
+        rows = []
+        for kind, payload in jobs:
+            if kind not in KINDS:
+                raise ValueError('Unknown job kind {}'.format(kind))
+            if payload.get('output_dir') is None:
+                raise ValueError('Every job needs an output_dir')
+            rows.append((kind, json.dumps(payload),
+                         os.path.abspath(payload['output_dir'])))
+        ids = []
+        now = time.time()
+        with self._connect() as connection, connection.transaction():
+            for kind, payload, output_dir in rows:
+                cursor = connection.execute(
+                    'INSERT OR IGNORE INTO jobs (kind, payload, output_dir,'
+                    ' submitted) VALUES (?, ?, ?, ?)',
+                    (kind, payload, output_dir, now))
+                ids.append(cursor.lastrowid if cursor.rowcount else None)
+        return ids
+
+    def claim(self, worker=None):
+        """
+        Atomically take the oldest runnable job: a pending job, or a
+        running job whose lease has expired because its worker died.
+
+        Returns:
+            The claimed `Job`, or None if there is nothing to do.
+        """
+        worker = worker or worker_name()
+        now = time.time()
+        with self._connect() as connection, connection.transaction():
+            # Jobs whose worker died too often are given up on
+            connection.execute(
+                'UPDATE jobs SET status = ?, error = ?, finished = ?'
+                ' WHERE status = ? AND lease_until < ? AND attempts >= ?',
+                (FAILED, 'Lease expired', now, RUNNING, now,
+                 self.max_attempts))
+            row = connection.execute(
+                'SELECT id FROM jobs WHERE status = ?'
+                ' OR (status = ? AND lease_until < ?)'
+                ' ORDER BY id LIMIT 1', (PENDING, RUNNING, now)).fetchone()
+            if row is None:
+                return None
+            connection.execute(
+                'UPDATE jobs SET status = ?, worker = ?, lease_until = ?,'
+                ' started = ?, attempts = attempts + 1 WHERE id = ?',
+                (RUNNING, worker, now + self.lease_seconds, now, row['id']))
+            return Job(connection.execute(
+                'SELECT * FROM jobs WHERE id = ?', (row['id'],)).fetchone())
+
+    def renew(self, job, worker=None):
+        """
+        Extend the lease of a running job. Returns False if the job was
+        taken over by another claim in the meantime.
+        """
+        worker = worker or worker_name()
+        with self._connect() as connection:
+            cursor = connection.execute(
+                'UPDATE jobs SET lease_until = ? WHERE id = ? AND worker = ?'
+                ' AND attempts = ? AND status = ?',
+                (time.time() + self.lease_seconds, job.id, worker,
+                 job.attempts, RUNNING))
+            return cursor.rowcount == 1
+
+    def complete(self, job, result, duration, worker=None):
+        """
+        Record the result of a job.
+
+        Raises:
+            LeaseLost: If the job was taken over by another claim, which
+                       is then the one that records the outcome.
+        """
+        worker = worker or worker_name()
+        with self._connect() as connection:
+            cursor = connection.execute(
+                'UPDATE jobs SET status = ?, result = ?, duration = ?,'
+                ' finished = ?, error = NULL, lease_until = NULL'
+                ' WHERE id = ? AND worker = ? AND attempts = ? AND status = ?',
+                (DONE, json.dumps(result), duration, time.time(), job.id,
+                 worker, job.attempts, RUNNING))
+            if cursor.rowcount != 1:
+                raise LeaseLost(job)
+
+    def fail(self, job, error, duration=None, worker=None):
+        """
+        Record a failed attempt. The job is retried until it has been
+        attempted `max_attempts` times.
+
+        Raises:
+            LeaseLost: As in `complete`.
+        """
+        worker = worker or worker_name()
+        with self._connect() as connection:
+            cursor = connection.execute(
+                'UPDATE jobs SET status = CASE WHEN attempts >= ? THEN ?'
+                ' ELSE ? END, error = ?, duration = ?, finished = ?,'
+                ' lease_until = NULL WHERE id = ? AND worker = ?'
+                ' AND attempts = ? AND status = ?',
+                (self.max_attempts, FAILED, PENDING, error, duration,
+                 time.time(), job.id, worker, job.attempts, RUNNING))
+            if cursor.rowcount != 1:
+                raise LeaseLost(job)
+
+    def retry_failed(self):
+        """Make all failed jobs pending again, with fresh attempts."""
+        with self._connect() as connection:
+            return connection.execute(
+                'UPDATE jobs SET status = ?, attempts = 0 WHERE status = ?',
+                (PENDING, FAILED)).rowcount
+
+    def status(self):
+        """Number of jobs in every state."""
+        counts = dict((state, 0) for state in STATES)
+        with self._connect() as connection:
+            for row in connection.execute(
+                    'SELECT status, COUNT(*) AS n FROM jobs GROUP BY status'):
+                counts[row['status']] = row['n']
+        return counts
+
+    def jobs(self, status=None):
+        """All jobs, or the jobs in the given state."""
+        with self._connect() as connection:
+            if status is None:
+                rows = connection.execute('SELECT * FROM jobs ORDER BY id')
+            else:
+                rows = connection.execute(
+                    'SELECT * FROM jobs WHERE status = ? ORDER BY id',
+                    (status,))
+            return [Job(row) for row in rows]
+
+
+class _Connection(object):
+    """sqlite3 connection that is closed (not committed) on exit."""
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.connection.close()
+
+    def execute(self, *args):
+        return self.connection.execute(*args)
+
+    def executescript(self, script):
+        return self.connection.executescript(script)
+
+    def transaction(self):
+        return _Transaction(self.connection)
+
+
+class _Transaction(object):
+    """
+    BEGIN IMMEDIATE takes the database's write lock up front, so two
+    workers can never select the same job before either updates it.
+    """
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        self.connection.execute('BEGIN IMMEDIATE')
+        return self.connection
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.connection.execute('COMMIT')
+        else:
+            self.connection.execute('ROLLBACK')
+
+
+def run_job(job, elastix_path=DEFAULT_ELASTIX_PATH,
+            transformix_path=DEFAULT_TRANSFORMIX_PATH, threads=None,
+            cache=None):
+    """
+    Run a single job and return its JSON-serializable result: the final
+    transform parameter file for registrations, or the dict of output
+    paths for transformix jobs.
+    """
+    payload = dict(job.payload)
+    output_dir = payload['output_dir']
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    if job.kind == 'register':
+        payload.setdefault('threads', threads)
+        el = ElastixInterface(elastix_path, cache=cache)
+        return el.register(verbose=False, **payload)
+    tr = TransformixInterface(payload.pop('parameters'), transformix_path)
+    return tr.compute(payload.pop('outputs', ['image']), verbose=False,
+                      **payload)
+
+
+def worker(queue, elastix_path=DEFAULT_ELASTIX_PATH,
+           transformix_path=DEFAULT_TRANSFORMIX_PATH, threads=None,
+           cache=None, poll_interval=5.0, exit_when_idle=True, max_jobs=None):
+    """
+    Claim and run jobs until the queue is drained (or forever if
+    `exit_when_idle` is False). The lease of the running job is renewed in
+    a background thread.
+
+    Returns:
+        The number of jobs this worker ran.
+    """
+    name = worker_name()
+    done = 0
+    while max_jobs is None or done < max_jobs:
+        job = queue.claim(name)
+        if job is None:
+            if exit_when_idle and queue.status()[RUNNING] == 0:
+                break
+            time.sleep(poll_interval)
+            continue
+
+        stop = threading.Event()
+
+        def renew_lease(job=job, stop=stop):
+            while not stop.wait(queue.lease_seconds / 3.0):
+                if not queue.renew(job, name):
+                    logger.warning('Lost the lease of job {}'.format(job.id))
+                    return
+
+        renewer = threading.Thread(target=renew_lease)
+        renewer.daemon = True
+        renewer.start()
+        logger.info('Running job {} ({}) in {}'.format(
+            job.id, job.kind, job.output_dir))
+        start = time.time()
+        try:
+            try:
+                result = run_job(job, elastix_path, transformix_path,
+                                 threads, cache)
+            except Exception:
+                queue.fail(job, traceback.format_exc(), time.time() - start,
+                           name)
+                logger.warning('Job {} failed'.format(job.id))
+            else:
+                queue.complete(job, result, time.time() - start, name)
+        except LeaseLost as ex:
+            logger.warning(str(ex))
+        finally:
+            stop.set()
+            renewer.join()
+        done += 1
+    return done
+
+
+def _read_jobs(path):
+    """
+    Read a JSON list of jobs. Every job is a payload dict with an optional
+    'kind' entry, which defaults to 'register'.
+    """
+    with (sys.stdin if path == '-' else open(path)) as f:
+        jobs = json.load(f)
+    return [(job.pop('kind', 'register'), job) for job in jobs]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m elastix.job_queue',
+        description='Crash-resumable queue of elastix and transformix jobs.')
+    parser.add_argument('database', help='SQLite file of the queue')
+    parser.add_argument('--lease', type=float, default=DEFAULT_LEASE_SECONDS,
+                        help='Lease of a claimed job in seconds')
+    parser.add_argument('--max-attempts', type=int,
+                        default=DEFAULT_MAX_ATTEMPTS)
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    submit = commands.add_parser('submit', help='Add jobs from a JSON file')
+    submit.add_argument('jobs', help='JSON list of job payloads, or -')
+
+    work = commands.add_parser('worker', help='Run jobs until none are left')
+    work.add_argument('--elastix', default=DEFAULT_ELASTIX_PATH)
+    work.add_argument('--transformix', default=DEFAULT_TRANSFORMIX_PATH)
+    work.add_argument('--threads', type=int, default=None,
+                      help='Value of elastix\' -threads option')
+    work.add_argument('--poll-interval', type=float, default=5.0)
+    work.add_argument('--forever', action='store_true',
+                      help='Keep waiting for new jobs when idle')
+
+    status = commands.add_parser('status', help='Count jobs per state')
+    status.add_argument('--failed', action='store_true',
+                        help='Also print the errors of failed jobs')
+
+    commands.add_parser('retry', help='Make failed jobs pending again')
+
+    args = parser.parse_args(argv)
+    queue = JobQueue(args.database, args.lease, args.max_attempts)
+
+    if args.command == 'submit':
+        ids = queue.submit_many(_read_jobs(args.jobs))
+        new = sum(1 for i in ids if i is not None)
+        print('Submitted {} jobs ({} already queued)'.format(
+            new, len(ids) - new))
+    elif args.command == 'worker':
+        logging.basicConfig(level=logging.INFO)
+        ran = worker(queue, args.elastix, args.transformix, args.threads,
+                     poll_interval=args.poll_interval,
+                     exit_when_idle=not args.forever)
+        print('Ran {} jobs'.format(ran))
+    elif args.command == 'status':
+        for state, count in queue.status().items():
+            print('{:8} {}'.format(state, count))
+        if args.failed:
+            for job in queue.jobs(FAILED):
+                print('\n{} {}\n{}'.format(job.id, job.output_dir, job.error))
+    elif args.command == 'retry':
+        print('Retrying {} jobs'.format(queue.retry_failed()))
+
+
+if __name__ == '__main__':
+    main()
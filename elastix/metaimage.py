@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+#
+# MetaImage (.mhd/.raw and .mha) support. Elastix and transformix read and
+# write uncompressed MetaImages natively, which makes them a cheap way to
+# exchange NumPy arrays with them: writing one is a plain dump of the
+# buffer, and reading one is a memory map of the .raw file.
+#
+# Arrays are indexed in NumPy (C) order, i.e. [z, y, x] for 3D images,
+# whereas header fields such as DimSize and ElementSpacing are in ITK
+# order, i.e. [x, y, z].
+
+
+from __future__ import division, print_function
+
+import os
+import sys
+
+import numpy as np
+
+
+MET_TYPES = {
+    'MET_CHAR': np.int8,
+    'MET_UCHAR': np.uint8,
+    'MET_SHORT': np.int16,
+    'MET_USHORT': np.uint16,
+    'MET_INT': np.int32,
+    'MET_UINT': np.uint32,
+    'MET_LONG': np.int32,
+    'MET_ULONG': np.uint32,
+    'MET_LONG_LONG': np.int64,
+    'MET_ULONG_LONG': np.uint64,
+    'MET_FLOAT': np.float32,
+    'MET_DOUBLE': np.float64,
+}
+
+NUMPY_TYPES = {
+    np.dtype(np.int8): 'MET_CHAR',
+    np.dtype(np.uint8): 'MET_UCHAR',
+    np.dtype(np.int16): 'MET_SHORT',
+    np.dtype(np.uint16): 'MET_USHORT',
+    np.dtype(np.int32): 'MET_INT',
+    np.dtype(np.uint32): 'MET_UINT',
+    np.dtype(np.int64): 'MET_LONG_LONG',
+    np.dtype(np.uint64): 'MET_ULONG_LONG',
+    np.dtype(np.float32): 'MET_FLOAT',
+    np.dtype(np.float64): 'MET_DOUBLE',
+}
+
+
+def _file_region(array):
+    """
+    Return (filename, offset) of the file region a memory-mapped array
+    views, or None if its data does not live in a file in C order.
+    """
+    if not isinstance(array, np.memmap) or not array.flags.c_contiguous:
+        return None
+    if getattr(array, 'filename', None) is None:
+        return None
+    root = array
+    while isinstance(root.base, np.memmap):
+        root = root.base
+    delta = array.ctypes.data - root.ctypes.data
+    return array.filename, root.offset + delta
+
+
+def _format(values):
+    return ' '.join(str(v) for v in values)
+
+
+def write_mhd(path, array, spacing=None, origin=None, direction=None,
+              vector=False, data_file=None, header_size=0):
+    """
+    Write an array as an uncompressed MetaImage.
+
+    Args:
+        path: (str) Path of the .mhd header.
+        array: (ndarray) Image data in C order.
+        spacing, origin: (sequence) Voxel spacing and origin in ITK order.
+        direction: (ndarray) D x D matrix of direction cosines, whose
+                   columns are the directions of the image axes.
+        vector: (bool) If True, the last axis of `array` holds the
+                components of a vector image.
+        data_file: (str) Existing file that already holds the data of
+                   `array`. The header then points to it and no data is
+                   written.
+        header_size: (int) Byte offset of the data in `data_file`.
+    """
+    array = np.asanyarray(array)
+    shape = array.shape[:-1] if vector else array.shape
+    ndim = len(shape)
+    dtype = array.dtype
+    if dtype.newbyteorder('=') not in NUMPY_TYPES:
+        raise ValueError('Unsupported pixel type {}'.format(array.dtype))
+    big_endian = (dtype.byteorder == '>' or
+                  (dtype.byteorder == '=' and sys.byteorder == 'big'))
+
+    if spacing is None:
+        spacing = [1.0] * ndim
+    if origin is None:
+        origin = [0.0] * ndim
+    if direction is None:
+        direction = np.eye(ndim)
+
+    if data_file is None:
+        data_file = os.path.splitext(path)[0] + '.raw'
+        array.tofile(data_file)
+        header_size = 0
+
+    header = [
+        ('ObjectType', 'Image'),
+        ('NDims', ndim),
+        ('BinaryData', 'True'),
+        ('BinaryDataByteOrderMSB', big_endian),
+        ('CompressedData', 'False'),
+        # MetaIO lists the direction of one axis after the other
+        ('TransformMatrix', _format(
+            np.asarray(direction, dtype=float).reshape(ndim, ndim).T.ravel())),
+        ('Offset', _format(origin)),
+        ('ElementSpacing', _format(spacing)),
+        ('DimSize', _format(shape[::-1])),
+    ]
+    if vector:
+        header.append(('ElementNumberOfChannels', array.shape[-1]))
+    header.append(('ElementType', NUMPY_TYPES[dtype.newbyteorder('=')]))
+    if header_size:
+        header.append(('HeaderSize', header_size))
+    if os.path.dirname(os.path.abspath(data_file)) == \
+            os.path.dirname(os.path.abspath(path)):
+        data_file = os.path.basename(data_file)
+    else:
+        data_file = os.path.abspath(data_file)
+    header.append(('ElementDataFile', data_file))
+
+    with open(path, 'w') as f:
+        for key, value in header:
+            f.write('{} = {}\n'.format(key, value))
+    return path
+
+
+def stage_array(array, path, spacing=None, origin=None, direction=None,
+                vector=False):
+    """
+    Make `array` available to elastix as the MetaImage `path`. Arrays that
+    are memory maps of a file (such as the results returned by `read_mhd`)
+    are not copied: the header simply points at the existing file.
+    `MetaImage` objects are staged the same way, with their own geometry
+    unless it is given explicitly.
+    """
+    if isinstance(array, MetaImage):
+        image = array
+        spacing = image.spacing if spacing is None else spacing
+        origin = image.origin if origin is None else origin
+        direction = image.direction if direction is None else direction
+        vector = image.channels > 1
+        array = image.data
+    region = _file_region(array)
+    if region is not None:
+        filename, offset = region
+        return write_mhd(path, array, spacing, origin, direction, vector,
+                         data_file=filename, header_size=offset)
+    return write_mhd(path, array, spacing, origin, direction, vector)
+
+
+def _parse_header(path):
+    """
+    Parse a MetaImage header into a dict of strings. Also returns the byte
+    offset at which the header ends, which is where inline (.mha) data
+    starts.
+    """
+    header = {}
+    end = 0
+    with open(path, 'rb') as f:
+        for line in f:
+            end += len(line)
+            line = line.decode('latin-1')
+            if '=' not in line:
+                continue
+            key, value = line.split('=', 1)
+            key = key.strip()
+            header[key] = value.strip()
+            if key == 'ElementDataFile':
+                break
+    return header, end
+
+
+def read_header(path):
+    """Parse a MetaImage header into a dict of strings."""
+    return _parse_header(path)[0]
+
+
+def _is_true(value):
+    return value.strip().lower() == 'true'
+
+
+class MetaImage(object):
+    """
+    A MetaImage (.mhd or .mha) whose voxel data is memory-mapped on first
+    access. Only the header is read when the object is created, so huge
+    images (e.g. 3D deformation fields) can be inspected, sliced and
+    reduced chunk by chunk without ever being fully loaded.
+
+    The data is indexed in C order ([z, y, x] for 3D images) with a
+    trailing component axis for vector images. `spacing`, `origin` and
+    `size` are in ITK (x, y, z) order, and `direction` is the D x D matrix
+    of direction cosines, whose columns are the directions of the axes.
+    """
+
+    def __init__(self, path, mode='r'):
+        self.path = path
+        self.mode = mode
+        self.header, self._header_end = _parse_header(path)
+        self._data = None
+
+        header = self.header
+        self.ndim = int(header['NDims'])
+        self.size = tuple(int(v) for v in header['DimSize'].split())
+        self.spacing = np.array(
+            header.get('ElementSpacing', ' '.join(['1'] * self.ndim)).split(),
+            dtype=float)
+        self.origin = np.array(
+            header.get('Offset', header.get('Origin',
+                       header.get('Position', ' '.join(['0'] * self.ndim)))).split(),
+            dtype=float)
+        direction = header.get('TransformMatrix', header.get('Rotation',
+                               header.get('Orientation')))
+        if direction is None:
+            self.direction = np.eye(self.ndim)
+        else:
+            # MetaIO lists the direction of one axis after the other
+            self.direction = np.array(direction.split(),
+                                      dtype=float).reshape(self.ndim, self.ndim).T
+        self.channels = int(header.get('ElementNumberOfChannels', 1))
+
+        dtype = np.dtype(MET_TYPES[header['ElementType']])
+        msb = header.get('BinaryDataByteOrderMSB',
+                         header.get('ElementByteOrderMSB', 'False'))
+        self.dtype = dtype.newbyteorder('>' if _is_true(msb) else '<')
+
+        shape = list(self.size[::-1])
+        if self.channels > 1:
+            shape.append(self.channels)
+        self.shape = tuple(shape)
+        self.compressed = _is_true(header.get('CompressedData', 'False'))
+
+    @property
+    def nbytes(self):
+        return int(np.prod(self.shape)) * self.dtype.itemsize
+
+    def _data_location(self):
+        data_file = self.header['ElementDataFile']
+        if data_file == 'LOCAL':
+            return self.path, self._header_end
+        if data_file.startswith('LIST') or '%' in data_file:
+            raise ValueError('Multi-file MetaImage {} is not supported'.format(
+                self.path))
+        if not os.path.isabs(data_file):
+            data_file = os.path.join(os.path.dirname(self.path), data_file)
+        offset = int(self.header.get('HeaderSize', 0))
+        if offset == -1:
+            # The data is at the end of the file
+            offset = os.path.getsize(data_file) - self.nbytes
+        return data_file, offset
+
+    @property
+    def data(self):
+        """
+        The voxel data as an `np.memmap`. Compressed images cannot be
+        memory-mapped and are decompressed into memory instead.
+        """
+        if self._data is None:
+            data_file, offset = self._data_location()
+            if self.compressed:
+                import zlib
+                with open(data_file, 'rb') as f:
+                    f.seek(offset)
+                    raw = zlib.decompress(f.read())
+                self._data = np.frombuffer(raw, dtype=self.dtype).reshape(self.shape)
+            else:
+                self._data = np.memmap(data_file, dtype=self.dtype,
+                                       mode=self.mode, offset=offset,
+                                       shape=self.shape)
+        return self._data
+
+    def __getitem__(self, index):
+        return self.data[index]
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self.data, dtype=dtype)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def chunks(self, size=16):
+        """
+        Iterate over the image in slabs of `size` slices along the first
+        (slowest) axis. Yields tuples of the slice and the memory-mapped
+        slab, so a reduction only ever touches one slab at a time.
+        """
+        for start in range(0, self.shape[0], size):
+            index = slice(start, min(start + size, self.shape[0]))
+            yield index, self.data[index]
+
+    def index_to_physical(self, index):
+        """
+        Convert (N, D) continuous indices in C order to physical points in
+        ITK order.
+        """
+        index = np.asarray(index, dtype=float)[..., ::-1]
+        return (index * self.spacing).dot(self.direction.T) + self.origin
+
+    def physical_to_index(self, points):
+        """
+        Convert (N, D) physical points in ITK order to continuous indices
+        in C order.
+        """
+        points = np.asarray(points, dtype=float) - self.origin
+        index = points.dot(np.linalg.inv(self.direction).T) / self.spacing
+        return index[..., ::-1]
+
+    def __repr__(self):
+        return 'MetaImage({!r}, shape={}, dtype={})'.format(
+            self.path, self.shape, self.dtype)
+
+
+def read_mhd(path, mode='r'):
+    """
+    Memory-map the data of an uncompressed MetaImage. The array is in C
+    order and has a trailing component axis for vector images.
+    """
+    image = MetaImage(path, mode)
+    if image.compressed:
+        raise ValueError('Cannot memory-map compressed MetaImage {}'.format(path))
+    return image.data
+
@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+#
+# Helpers for elastix parameter files, i.e. both the parameter files that
+# configure elastix and the transform parameter files it writes.
+
+
+from __future__ import division, print_function
+
+import os
+import re
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+def format_value(value):
+    """Format a Python value the way elastix expects it in a parameter file."""
+    if isinstance(value, (list, tuple)):
+        return ' '.join(format_value(v) for v in value)
+    if isinstance(value, (bool, np.bool_)):
+        return '"true"' if value else '"false"'
+    if isinstance(value, str):
+        return '"{}"'.format(value)
+    return str(value)
+
+
+def write_overrides(path, overrides, output_path):
+    """
+    Write a copy of the parameter file `path` to `output_path` in which the
+    parameters in the dict `overrides` are replaced (or added).
+    """
+    with open(path) as f:
+        text = f.read()
+    for key in overrides:
+        text = re.sub(r'^[ \t]*\({}[ \t][^\n]*$'.format(re.escape(key)),
+                      '', text, flags=re.MULTILINE)
+    lines = [text.rstrip('\n'), '']
+    for key, value in overrides.items():
+        lines.append('({} {})'.format(key, format_value(value)))
+    with open(output_path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    return output_path
+
+
+# Parameters whose values are parsed into a NumPy array instead of a list
+ARRAY_PARAMETERS = ('TransformParameters',)
+
+_TOKEN = re.compile(r'"([^"]*)"|(\S+)')
+
+
+def _parse_value(token, quoted):
+    if quoted:
+        if token == 'true':
+            return True
+        if token == 'false':
+            return False
+        return token
+    try:
+        return int(token)
+    except ValueError:
+        return float(token)
+
+
+def _format_array(array):
+    # repr gives the shortest string that round-trips every float
+    return ' '.join(map(repr, array.tolist()))
+
+
+class ParameterFile(object):
+    """
+    Typed, editable model of an elastix parameter file.
+
+    Every parameter maps to a list of values: quoted values become strings
+    (or booleans for "true" and "false"), unquoted ones ints or floats. The
+    potentially huge `TransformParameters` vector is parsed straight into a
+    float64 NumPy array. Parsing and writing both take linear time.
+
+    >>> tp = ParameterFile.read('TransformParameters.0.txt')
+    >>> tp['Transform']
+    ['BSplineTransform']
+    >>> tp.update({'FinalBSplineInterpolationOrder': 0,
+    ...            'ResultImagePixelType': 'float'})
+    >>> tp.write('TransformParameters_mask.0.txt')
+    """
+
+    def __init__(self, parameters=None, path=None):
+        self.path = path
+        self._parameters = OrderedDict()
+        if parameters:
+            self.update(parameters)
+
+    @classmethod
+    def parse(cls, text, path=None):
+        pf = cls(path=path)
+        for line in text.splitlines():
+            line = line.strip()
+            if not line.startswith('('):
+                continue
+            end = line.rfind(')')
+            if end < 0:
+                continue
+            fields = line[1:end].split(None, 1)
+            if not fields:
+                continue
+            key = fields[0]
+            rest = fields[1] if len(fields) > 1 else ''
+            if key in ARRAY_PARAMETERS:
+                value = np.fromstring(rest, sep=' ') if rest.strip() \
+                    else np.empty(0)
+            else:
+                value = [_parse_value(quoted or bare, bare == '')
+                         for quoted, bare in _TOKEN.findall(rest)]
+            pf._parameters[key] = value
+        return pf
+
+    @classmethod
+    def read(cls, path):
+        with open(path) as f:
+            return cls.parse(f.read(), path=path)
+
+    def __getitem__(self, key):
+        return self._parameters[key]
+
+    def __setitem__(self, key, value):
+        if key in ARRAY_PARAMETERS:
+            value = np.asarray(value, dtype=float).ravel()
+        elif isinstance(value, (list, tuple, np.ndarray)):
+            value = list(value)
+        else:
+            value = [value]
+        self._parameters[key] = value
+
+    def __delitem__(self, key):
+        del self._parameters[key]
+
+    def __contains__(self, key):
+        return key in self._parameters
+
+    def __iter__(self):
+        return iter(self._parameters)
+
+    def __len__(self):
+        return len(self._parameters)
+
+    def keys(self):
+        return self._parameters.keys()
+
+    def items(self):
+        return self._parameters.items()
+
+    def get(self, key, default=None):
+        return self._parameters.get(key, default)
+
+    def scalar(self, key, default=None):
+        """The first value of a parameter, or `default` if it is not set."""
+        values = self._parameters.get(key)
+        if values is None or len(values) == 0:
+            return default
+        return values[0]
+
+    def update(self, edits):
+        """Apply a batch of edits: a dict of parameter names to values."""
+        for key, value in edits.items():
+            self[key] = value
+
+    def copy(self):
+        pf = ParameterFile(path=self.path)
+        for key, value in self._parameters.items():
+            pf._parameters[key] = value.copy() if isinstance(value, np.ndarray) \
+                else list(value)
+        return pf
+
+    def to_string(self):
+        parts = []
+        for key, value in self._parameters.items():
+            if isinstance(value, np.ndarray):
+                value = _format_array(value)
+            else:
+                value = format_value(value)
+            parts.append('({} {})\n'.format(key, value))
+        return ''.join(parts)
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            f.write(self.to_string())
+        return path
+
+    @property
+    def initial_transform(self):
+        """Path of the initial transform, or None if there is none."""
+        path = self.scalar('InitialTransformParametersFileName')
+        if path in (None, 'NoInitialTransform'):
+            return None
+        return path
+
+    def chain(self):
+        """
+        Return this file preceded by all its initial transforms, innermost
+        first. Every file in the chain is parsed once and cached.
+        """
+        chain = [self]
+        seen = set()
+        path = self.initial_transform
+        while path is not None:
+            key = os.path.abspath(path)
+            if key in seen:
+                raise ValueError('Cyclic initial transform chain at {}'.format(path))
+            seen.add(key)
+            pf = load(path)
+            chain.insert(0, pf)
+            path = pf.initial_transform
+        return chain
+
+
+# Number of parsed files kept by `load`, least recently used first out
+CACHE_SIZE = 64
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def load(path):
+    """
+    Read a parameter file through a cache keyed by path, modification time
+    and size, so chains shared by many transforms are parsed only once.
+    The returned object is shared: `copy` it before editing.
+    """
+    st = os.stat(path)
+    key = os.path.abspath(path)
+    stamp = (st.st_mtime, st.st_size)
+    with _cache_lock:
+        cached = _cache.get(key)
+        if cached is not None and cached[0] == stamp:
+            _cache.move_to_end(key)
+            return cached[1]
+    pf = ParameterFile.read(path)
+    with _cache_lock:
+        _cache[key] = (stamp, pf)
+        _cache.move_to_end(key)
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return pf
+
+
+def load_chain(path):
+    """Load a transform parameter file and all its initial transforms."""
+    return load(path).chain()
+
+
+# Schedules hold one block of values (typically one per dimension) for
+# every resolution, coarsest first
+SCHEDULE_PARAMETERS = (
+    'ImagePyramidSchedule', 'FixedImagePyramidSchedule',
+    'MovingImagePyramidSchedule', 'ImagePyramidRescaleSchedule',
+    'ImagePyramidSmoothingSchedule', 'FixedImagePyramidRescaleSchedule',
+    'FixedImagePyramidSmoothingSchedule', 'MovingImagePyramidRescaleSchedule',
+    'MovingImagePyramidSmoothingSchedule', 'GridSpacingSchedule',
+)
+
+# Parameters that may be given once for every resolution
+PER_RESOLUTION_PARAMETERS = (
+    'MaximumNumberOfIterations', 'NumberOfSpatialSamples',
+    'NumberOfHistogramBins', 'NumberOfFixedHistogramBins',
+    'NumberOfMovingHistogramBins', 'SP_a', 'SP_A', 'SP_alpha',
+    'MaximumStepLength', 'MinimumStepLength', 'MinimumGradientMagnitude',
+    'NumberOfSamplesForExactGradient', 'BSplineInterpolationOrder',
+    'NewSamplesEveryIteration', 'SampleRegionSize', 'NumberOfJacobianMeasurements',
+)
+
+
+def drop_coarse_resolutions(path, count, output_path):
+    """
+    Write a copy of the parameter file `path` that skips its `count`
+    coarsest resolutions, e.g. for a registration that is initialized
+    close to the solution. NumberOfResolutions is reduced, and the values
+    of schedules and per-resolution parameters of the dropped resolutions
+    are removed. Parameters with a single value apply to all resolutions
+    and are left alone. At least one resolution is kept.
+
+    Returns:
+        `output_path`
+    """
+    pf = ParameterFile.read(path)
+    resolutions = int(pf.scalar('NumberOfResolutions', 1))
+    count = max(0, min(count, resolutions - 1))
+    if count:
+        pf['NumberOfResolutions'] = resolutions - count
+        for key in SCHEDULE_PARAMETERS + PER_RESOLUTION_PARAMETERS:
+            values = pf.get(key)
+            if values is None or len(values) < resolutions or \
+                    len(values) % resolutions:
+                continue
+            block = len(values) // resolutions
+            if key in PER_RESOLUTION_PARAMETERS and block != 1:
+                continue
+            pf[key] = values[count * block:]
+    return pf.write(output_path)
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+#
+# Reading and writing elastix/transformix point set files. Both the
+# elastix text format and legacy VTK polydata are supported, selected by
+# the file extension. All files are parsed in a single vectorized pass
+# over their whole text, so millions of points take about as long as
+# loading the numbers.
+
+
+from __future__ import division, print_function
+
+import os
+import re
+
+import numpy as np
+
+
+_FIELD = re.compile(r'(\w+)\s*=\s*\[([^\]]*)\]')
+
+_PUNCTUATION = str.maketrans('=;[]', '    ')
+
+VTK_HEADER = '# vtk DataFile Version 2.0\n'
+
+
+def _is_vtk(path):
+    return os.path.splitext(path)[1].lower() == '.vtk'
+
+
+def write_points(path, points, kind='point'):
+    """
+    Write an (N, D) array as an elastix point set file: a .vtk file
+    (legacy polydata, always in physical coordinates) or otherwise the
+    elastix text format. `kind` is 'point' for physical coordinates or
+    'index' for voxel indices.
+    """
+    points = np.asarray(points)
+    if kind not in ('point', 'index'):
+        raise ValueError("kind must be 'point' or 'index'")
+    if _is_vtk(path):
+        if kind != 'point':
+            raise ValueError('VTK point sets hold physical points only')
+        # VTK points are always 3D
+        padded = np.zeros((len(points), 3))
+        padded[:, :points.shape[1]] = points
+        with open(path, 'w') as f:
+            f.write('{}elastix points\nASCII\nDATASET POLYDATA\n'
+                    'POINTS {} double\n'.format(VTK_HEADER, len(points)))
+            np.savetxt(f, padded, fmt='%.17g', delimiter=' ')
+        return path
+    fmt = '%d' if kind == 'index' else '%.17g'
+    with open(path, 'w') as f:
+        f.write('{}\n{}\n'.format(kind, len(points)))
+        np.savetxt(f, points, fmt=fmt, delimiter=' ')
+    return path
+
+
+def _read_vtk_points(text, ndim=None):
+    match = re.search(r'^POINTS\s+(\d+)\s+\w+\s*$', text, re.MULTILINE)
+    if match is None:
+        raise ValueError('No POINTS section in VTK file')
+    count = int(match.group(1))
+    body = text[match.end():]
+    # Numbers up to the next section, if any
+    end = re.search(r'^[A-Za-z_]', body, re.MULTILINE)
+    if end is not None:
+        body = body[:end.start()]
+    values = np.fromstring(body, sep=' ') if body.strip() else np.empty(0)
+    points = values[:count * 3].reshape(count, 3)
+    return points if ndim is None else points[:, :ndim]
+
+
+def read_points(path, ndim=None):
+    """
+    Read an elastix point set file (text or .vtk).
+
+    Args:
+        ndim: (int) Dimension of the points in a .vtk file, which always
+              stores three coordinates. Defaults to 3.
+
+    Returns:
+        A tuple (kind, points): 'point' or 'index', and an (N, D) array.
+    """
+    with open(path) as f:
+        text = f.read()
+    if _is_vtk(path):
+        return 'point', _read_vtk_points(text, ndim)
+    lines = text.split('\n', 2)
+    kind = lines[0].strip().lower()
+    if kind in ('point', 'index'):
+        count = int(lines[1])
+        body = lines[2] if len(lines) > 2 else ''
+    else:
+        # Without a header, the points are indices
+        kind, count = 'index', int(lines[0])
+        body = '\n'.join(lines[1:])
+    values = np.fromstring(body, sep=' ') if body.strip() else np.empty(0)
+    if count == 0:
+        return kind, np.empty((0, ndim or 0))
+    points = values.reshape(count, -1)
+    if kind == 'index':
+        points = points.astype(np.int64)
+    return kind, points
+
+
+def read_output_points(path, ndim=None):
+    """
+    Parse transformix' outputpoints.txt into a dict mapping every field
+    (InputIndex, InputPoint, OutputIndexFixed, OutputPoint, Deformation,
+    ...) to an (N, D) array. For an outputpoints.vtk, which holds the
+    transformed points only, the dict has just 'OutputPoint'.
+    """
+    with open(path) as f:
+        text = f.read()
+    if _is_vtk(path):
+        return {'OutputPoint': _read_vtk_points(text, ndim)}
+
+    first = text[:text.find('\n')] if '\n' in text else text
+    fields = [(name, len(values.split()))
+              for name, values in _FIELD.findall(first)]
+    if not fields:
+        return {}
+    # Every line holds 'Point', its number and the fields. Blank out all
+    # words (longest first, since 'Point' is part of 'OutputPoint') and
+    # punctuation, and parse the remaining numbers in one go.
+    for word in sorted([name for name, _ in fields] + ['Point'], key=len,
+                       reverse=True):
+        text = text.replace(word, ' ')
+    values = np.fromstring(text.translate(_PUNCTUATION), sep=' ')
+    width = 1 + sum(n for _, n in fields)
+    values = values[:len(values) // width * width].reshape(-1, width)
+
+    result = {}
+    column = 1
+    for name, n in fields:
+        result[name] = values[:, column:column + n]
+        column += n
+    return result
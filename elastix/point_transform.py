@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+#
+# In-process evaluation of elastix transforms on point sets. Instead of
+# writing a points file and launching transformix, the transform parameter
+# file chain is parsed once and applied to (N, D) NumPy arrays with
+# vectorized math. Like transformix, the transform maps points from the
+# fixed image domain to the moving image domain.
+#
+# Points are physical coordinates in ITK (x, y, z) order. Direction
+# matrices in transform parameter files are listed axis after axis, i.e.
+# column-major, like in MetaImage headers.
+
+
+from __future__ import division, print_function
+
+import itertools
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from . import interpolation
+from .metaimage import MetaImage
+from .parameter_file import ParameterFile, load
+from .point_sets import write_points, read_output_points
+from .transformix_interface import TransformixInterface
+
+
+# Number of points evaluated at once by dense transforms, which bounds
+# the size of the temporary arrays
+CHUNK_SIZE = 65536
+
+
+def _dimension(pf):
+    return int(pf.scalar('FixedImageDimension',
+                         len(pf.get('Size', [])) or 3))
+
+
+def _vector(pf, key, dimension, default):
+    values = pf.get(key)
+    if values is None or len(values) == 0:
+        return np.full(dimension, default, dtype=float)
+    return np.asarray(values, dtype=float)
+
+
+def _direction(pf, key, dimension):
+    values = pf.get(key)
+    if values is None or len(values) == 0:
+        return np.eye(dimension)
+    return np.asarray(values, dtype=float).reshape(dimension, dimension).T
+
+
+class LinearTransform(object):
+    """
+    y = M (x - c) + c + t. Euler, similarity, affine and translation
+    transforms all reduce to this form.
+    """
+
+    def __init__(self, matrix, center, translation):
+        self.matrix = np.asarray(matrix, dtype=float)
+        self.center = np.asarray(center, dtype=float)
+        self.translation = np.asarray(translation, dtype=float)
+
+    def affine(self):
+        """Return (A, b) such that y = A x + b."""
+        offset = self.center + self.translation - self.matrix.dot(self.center)
+        return self.matrix, offset
+
+    def __call__(self, points):
+        matrix, offset = self.affine()
+        return points.dot(matrix.T) + offset
+
+
+def _rotation_2d(angle):
+    c, s = np.cos(angle), np.sin(angle)
+    return np.array([[c, -s], [s, c]])
+
+
+def _euler_matrix_3d(ax, ay, az, zyx):
+    cx, sx = np.cos(ax), np.sin(ax)
+    cy, sy = np.cos(ay), np.sin(ay)
+    cz, sz = np.cos(az), np.sin(az)
+    rx = np.array([[1, 0, 0], [0, cx, -sx], [0, sx, cx]])
+    ry = np.array([[cy, 0, sy], [0, 1, 0], [-sy, 0, cy]])
+    rz = np.array([[cz, -sz, 0], [sz, cz, 0], [0, 0, 1]])
+    # Same order as itk::Euler3DTransform
+    if zyx:
+        return rz.dot(ry).dot(rx)
+    return rz.dot(rx).dot(ry)
+
+
+def _versor_matrix(x, y, z):
+    w = np.sqrt(max(0.0, 1.0 - x * x - y * y - z * z))
+    return np.array([
+        [1 - 2 * (y * y + z * z), 2 * (x * y - z * w), 2 * (x * z + y * w)],
+        [2 * (x * y + z * w), 1 - 2 * (x * x + z * z), 2 * (y * z - x * w)],
+        [2 * (x * z - y * w), 2 * (y * z + x * w), 1 - 2 * (x * x + y * y)],
+    ])
+
+
+def _center(pf, dimension):
+    return _vector(pf, 'CenterOfRotationPoint', dimension, 0.0)
+
+
+def euler_transform(pf):
+    p = pf['TransformParameters']
+    dimension = _dimension(pf)
+    if dimension == 2:
+        matrix = _rotation_2d(p[0])
+        translation = p[1:3]
+    else:
+        matrix = _euler_matrix_3d(p[0], p[1], p[2],
+                                  pf.scalar('ComputeZYX', False))
+        translation = p[3:6]
+    return LinearTransform(matrix, _center(pf, dimension), translation)
+
+
+def similarity_transform(pf):
+    p = pf['TransformParameters']
+    dimension = _dimension(pf)
+    if dimension == 2:
+        matrix = p[0] * _rotation_2d(p[1])
+        translation = p[2:4]
+    else:
+        matrix = p[6] * _versor_matrix(p[0], p[1], p[2])
+        translation = p[3:6]
+    return LinearTransform(matrix, _center(pf, dimension), translation)
+
+
+def affine_transform(pf):
+    p = pf['TransformParameters']
+    dimension = _dimension(pf)
+    matrix = p[:dimension * dimension].reshape(dimension, dimension)
+    translation = p[dimension * dimension:dimension * (dimension + 1)]
+    return LinearTransform(matrix, _center(pf, dimension), translation)
+
+
+def translation_transform(pf):
+    p = pf['TransformParameters']
+    dimension = _dimension(pf)
+    return LinearTransform(np.eye(dimension), np.zeros(dimension),
+                           p[:dimension])
+
+
+class BSplineTransform(object):
+    """
+    B-spline deformable transform, y = x + sum of weighted coefficients
+    over the support of x. Points whose support does not lie entirely on
+    the control point grid are not displaced, as in ITK.
+    """
+
+    def __init__(self, pf):
+        dimension = _dimension(pf)
+        self.dimension = dimension
+        self.order = int(pf.scalar('BSplineTransformSplineOrder', 3))
+        self.size = np.asarray(pf['GridSize'], dtype=int)
+        self.grid_index = _vector(pf, 'GridIndex', dimension, 0.0)
+        self.spacing = _vector(pf, 'GridSpacing', dimension, 1.0)
+        self.origin = _vector(pf, 'GridOrigin', dimension, 0.0)
+        direction = _direction(pf, 'GridDirection', dimension)
+        self.point_to_index = np.linalg.inv(direction.dot(np.diag(self.spacing)))
+
+        count = int(np.prod(self.size))
+        # Coefficients are stored per dimension, x fastest within each
+        self.coefficients = pf['TransformParameters'][:dimension * count] \
+            .reshape(dimension, count).T
+        # Strides of the flattened grid, in x, y, z order
+        self.strides = np.concatenate([[1], np.cumprod(self.size[:-1])]).astype(int)
+
+    def _displacement(self, points):
+        order = self.order
+        cindex = (points - self.origin).dot(self.point_to_index.T) - self.grid_index
+        start = np.floor(cindex - (order - 1) / 2.0).astype(int)
+        inside = np.all((start >= 0) & (start + order <= self.size - 1), axis=1)
+
+        # weights[n, d, k] is the weight of support node k in dimension d
+        offsets = np.arange(order + 1)
+        weights = interpolation.bspline_kernel(
+            cindex[:, :, None] - (start[:, :, None] + offsets), order)
+
+        start = np.where(inside[:, None], start, 0)
+        displacement = np.zeros_like(points)
+        for combination in itertools.product(offsets, repeat=self.dimension):
+            combination = np.asarray(combination)
+            flat = (start + combination).dot(self.strides)
+            w = np.prod(weights[:, np.arange(self.dimension), combination], axis=1)
+            displacement += w[:, None] * self.coefficients[flat]
+        displacement[~inside] = 0.0
+        return displacement
+
+    def __call__(self, points):
+        result = np.empty_like(points)
+        for begin in range(0, len(points), CHUNK_SIZE):
+            chunk = points[begin:begin + CHUNK_SIZE]
+            result[begin:begin + CHUNK_SIZE] = chunk + self._displacement(chunk)
+        return result
+
+
+class DeformationFieldTransform(object):
+    """
+    Dense deformation field transform, y = x + d(x), with d interpolated
+    from the vector image `DeformationFieldFileName` and zero outside of
+    it. Like elastix, d is interpolated nearest neighbour unless
+    `DeformationFieldInterpolationOrder` is 1.
+    """
+
+    def __init__(self, pf):
+        self.order = int(pf.scalar('DeformationFieldInterpolationOrder', 0))
+        if self.order not in (0, 1):
+            raise ValueError('DeformationFieldInterpolationOrder must be 0 '
+                             'or 1, not {}'.format(self.order))
+        path = pf.scalar('DeformationFieldFileName')
+        if not os.path.isabs(path) and pf.path is not None and \
+                not os.path.exists(path):
+            path = os.path.join(os.path.dirname(pf.path), path)
+        self.field = MetaImage(path)
+
+    def __call__(self, points):
+        result = np.empty_like(points)
+        for begin in range(0, len(points), CHUNK_SIZE):
+            chunk = points[begin:begin + CHUNK_SIZE]
+            cindex = self.field.physical_to_index(chunk)
+            interpolate = interpolation.linear if self.order == 1 \
+                else interpolation.nearest
+            result[begin:begin + CHUNK_SIZE] = chunk + interpolate(
+                self.field.data, cindex)
+        return result
+
+
+# Maps the elastix `Transform` name to a function that builds a callable
+# transform from a ParameterFile
+TRANSFORMS = {
+    'EulerTransform': euler_transform,
+    'SimilarityTransform': similarity_transform,
+    'AffineTransform': affine_transform,
+    'TranslationTransform': translation_transform,
+    'BSplineTransform': BSplineTransform,
+    'RecursiveBSplineTransform': BSplineTransform,
+    'DeformationFieldTransform': DeformationFieldTransform,
+}
+
+
+def make_transform(pf):
+    """Build the callable transform of a single ParameterFile."""
+    name = pf.scalar('Transform')
+    if name not in TRANSFORMS:
+        raise ValueError('Transform {} is not supported in-process'.format(name))
+    return TRANSFORMS[name](pf)
+
+
+class TransformEvaluator(object):
+    """
+    Applies a transform parameter file, including its chain of initial
+    transforms, to point sets in-process.
+
+    >>> evaluator = TransformEvaluator('results/TransformParameters.1.txt')
+    >>> moving_points = evaluator(fixed_points)  # (N, D) arrays
+
+    Args:
+        parameter_file: (str or ParameterFile) The last transform of the
+                        chain, i.e. the file that would be given to
+                        transformix.
+    """
+
+    def __init__(self, parameter_file):
+        if not isinstance(parameter_file, ParameterFile):
+            parameter_file = load(parameter_file)
+        self.parameter_file = parameter_file
+        self.chain = parameter_file.chain()
+        self.transforms = [make_transform(pf) for pf in self.chain]
+        self.dimension = _dimension(parameter_file)
+
+    def index_to_physical(self, index):
+        """
+        Convert fixed image indices (in x, y, z order, like in elastix
+        'index' point files) to physical points, using the fixed image
+        geometry stored in the transform parameter file.
+        """
+        pf = self.parameter_file
+        spacing = _vector(pf, 'Spacing', self.dimension, 1.0)
+        origin = _vector(pf, 'Origin', self.dimension, 0.0)
+        direction = _direction(pf, 'Direction', self.dimension)
+        return (np.asarray(index, dtype=float) * spacing).dot(direction.T) + origin
+
+    def __call__(self, points):
+        points = np.asarray(points, dtype=float)
+        if points.ndim != 2 or points.shape[1] != self.dimension:
+            raise ValueError('Expected an (N, {}) array of points'.format(
+                self.dimension))
+        result = self.transforms[0](points)
+        for pf, transform in zip(self.chain[1:], self.transforms[1:]):
+            if pf.scalar('HowToCombineTransforms', 'Compose') == 'Compose':
+                result = transform(result)
+            else:
+                # Addition: T(x) = T0(x) + T1(x) - x
+                result = result + transform(points) - points
+        return result
+
+
+def transform_points(parameter_file, points):
+    """Apply a transform parameter file chain to (N, D) points."""
+    return TransformEvaluator(parameter_file)(points)
+
+
+def validate_against_transformix(parameter_file, points, transformix_path,
+                                 output_dir=None):
+    """
+    Transform `points` both in-process and with transformix, and return
+    the maximum absolute difference between the two results.
+    """
+    points = np.asarray(points, dtype=float)
+    expected = transform_points(parameter_file, points)
+
+    cleanup = output_dir is None
+    if cleanup:
+        output_dir = tempfile.mkdtemp(prefix='transformix-validate-')
+    try:
+        points_file = write_points(os.path.join(output_dir, 'points.txt'),
+                                   points)
+        tr = TransformixInterface(parameter_file, transformix_path)
+        path = tr.transform_points(points_file, output_dir=output_dir,
+                                   verbose=False)
+        actual = read_output_points(path)['OutputPoint']
+    finally:
+        if cleanup:
+            shutil.rmtree(output_dir, ignore_errors=True)
+    return float(np.max(np.abs(actual - expected)))
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+#
+# Live progress of running elastix processes. Elastix appends a line to
+# IterationInfo.<stage>.R<level>.txt after every iteration and echoes its
+# log to stdout; both are read incrementally while the process runs, so
+# nothing is ever read twice.
+
+
+from __future__ import division, print_function
+
+import collections
+import os
+import queue
+import threading
+
+from .instrumentation import exited
+from .log_files import ITERATION_INFO, _column_names
+
+
+IterationRecord = collections.namedtuple(
+    'IterationRecord',
+    ['stage', 'resolution', 'iteration', 'metric', 'step_size', 'time_ms',
+     'values'])
+IterationRecord.__doc__ = """
+One line of an IterationInfo file. `values` holds all columns of the line
+by their `logfile` names; the other fields are shortcuts to the common
+ones and are None if the optimizer does not report them.
+"""
+
+LogLine = collections.namedtuple('LogLine', ['line'])
+LogLine.__doc__ = """One line elastix wrote to stdout (i.e. to elastix.log)."""
+
+
+def _number(token):
+    try:
+        return int(token)
+    except ValueError:
+        return float(token)
+
+
+class _TailedFile(object):
+
+    def __init__(self, stage, resolution, path):
+        self.stage = stage
+        self.resolution = resolution
+        self.path = path
+        self.offset = 0
+        self.buffer = ''
+        self.names = None
+
+    def read(self):
+        """Return the complete lines appended since the last call."""
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            return []
+        if size < self.offset:
+            # The file was truncated, e.g. rewritten by a new run
+            self.offset, self.buffer, self.names = 0, '', None
+        if size == self.offset:
+            return []
+        with open(self.path) as f:
+            f.seek(self.offset)
+            text = f.read()
+            self.offset = f.tell()
+        text = self.buffer + text
+        lines = text.split('\n')
+        self.buffer = lines.pop()
+        return [line for line in lines if line.strip()]
+
+
+class IterationInfoTail(object):
+    """
+    Incrementally read the IterationInfo files of an elastix output
+    directory while elastix writes them.
+
+    Args:
+        output_dir: (str) The elastix output directory.
+        ignore_existing: (bool) If True, files that already exist when the
+                         tail is created are ignored until they are
+                         rewritten, so results of earlier runs in the same
+                         directory are not reported. Create the tail
+                         before starting elastix in that case.
+    """
+
+    def __init__(self, output_dir, ignore_existing=True):
+        self.output_dir = output_dir
+        self._files = {}
+        self._existing = {}
+        if ignore_existing:
+            for name in os.listdir(output_dir):
+                if ITERATION_INFO.match(name):
+                    self._existing[name] = self._stat(name)
+
+    def _stat(self, name):
+        try:
+            st = os.stat(os.path.join(self.output_dir, name))
+        except OSError:
+            return None
+        return st.st_mtime, st.st_size
+
+    def _discover(self):
+        for name in os.listdir(self.output_dir):
+            if name in self._files:
+                continue
+            match = ITERATION_INFO.match(name)
+            if match is None:
+                continue
+            if name in self._existing:
+                if self._stat(name) == self._existing[name]:
+                    continue
+                del self._existing[name]
+            path = os.path.join(self.output_dir, name)
+            self._files[name] = _TailedFile(int(match.group(1)),
+                                            int(match.group(2)), path)
+
+    def poll(self):
+        """Return the records written since the last call, in order."""
+        self._discover()
+        records = []
+        tailed = sorted(self._files.values(),
+                        key=lambda t: (t.stage, t.resolution))
+        for t in tailed:
+            for line in t.read():
+                if t.names is None:
+                    t.names = _column_names(line) or None
+                    continue
+                values = collections.OrderedDict(
+                    (name, _number(token))
+                    for name, token in zip(t.names, line.split()))
+                records.append(IterationRecord(
+                    t.stage, t.resolution,
+                    values.get('itnr'), values.get('metric'),
+                    values.get('stepsize'), values.get('time[ms]'),
+                    values))
+        return records
+
+
+def _pump(stream, sink):
+    for line in iter(stream.readline, b''):
+        sink(line.decode('utf-8', 'replace').rstrip('\r\n'))
+    stream.close()
+
+
+def stream_process(proc, tail, poll_interval=0.2, heartbeat=False):
+    """
+    Yield `LogLine`s from the stdout pipe of a running elastix process and
+    the `IterationRecord`s of an `IterationInfoTail` on its output
+    directory until the process exits. With `heartbeat`, None is yielded
+    after every poll, so consumers can act on time even when elastix is
+    silent.
+    The stderr pipe, if any, is drained in the background; its last lines
+    are available as `proc.stderr_tail` afterwards.
+    """
+    lines = queue.Queue()
+    proc.stderr_tail = collections.deque(maxlen=50)
+    readers = []
+    if proc.stdout is not None:
+        readers.append(threading.Thread(target=_pump,
+                                        args=(proc.stdout, lines.put)))
+    if proc.stderr is not None:
+        readers.append(threading.Thread(target=_pump,
+                                        args=(proc.stderr,
+                                              proc.stderr_tail.append)))
+    for reader in readers:
+        reader.daemon = True
+        reader.start()
+
+    while True:
+        finished = exited(proc)
+        try:
+            yield LogLine(lines.get(timeout=poll_interval))
+            while True:
+                yield LogLine(lines.get_nowait())
+        except queue.Empty:
+            pass
+        for record in tail.poll():
+            yield record
+        if heartbeat:
+            yield None
+        if finished and not any(reader.is_alive() for reader in readers):
+            break
+
+    # Lines that arrived between the last poll and the end of the readers
+    while not lines.empty():
+        yield LogLine(lines.get_nowait())
+    for record in tail.poll():
+        yield record
@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+#
+# In-process resampling of images with a deformation field computed by
+# transformix (`TransformixInterface.deformation_field`). Once the field
+# exists, warping extra volumes (dose maps, probability maps, ...) with
+# the same transform needs no further transformix runs: the output grid
+# is split into tiles that are warped independently on a thread pool, so
+# memory use is bounded by the tile size rather than the volume size.
+# B-spline coefficients of large volumes are computed per tile as well,
+# on the part of the volume the tile samples plus a halo.
+#
+# The deformation field is defined on the fixed image grid: the output
+# voxel at physical point x takes the value of the moving volume at
+# x + d(x), like transformix does.
+
+
+from __future__ import division, print_function
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from . import interpolation, metaimage
+from .resources import available_cores
+
+
+# Number of output voxels warped at once by a single task
+TILE_SIZE = 1 << 18
+
+# Volumes whose B-spline coefficients (in double precision) take more
+# bytes than this are prefiltered tile by tile instead of as a whole
+PREFILTER_BYTES = 1 << 28
+
+# Relative error of B-spline coefficients computed on part of a volume
+HALO_TOLERANCE = 1e-10
+
+
+def _halo(order):
+    """
+    Voxels around the sampled region that are prefiltered along, so that
+    the recursive filter has decayed below `HALO_TOLERANCE` at the nodes
+    of the interpolation kernel.
+    """
+    pole = abs(interpolation.POLES[order][0])
+    return int(np.ceil(np.log(HALO_TOLERANCE) / np.log(pole))) + order
+
+
+def _local_bspline(volume, cindex, order, fill, ndim):
+    """
+    B-spline interpolation of `volume` at the continuous indices `cindex`,
+    prefiltering only the box of the volume around the points that are
+    inside it.
+    """
+    shape = np.asarray(volume.shape[:ndim])
+    inside = np.all((cindex >= -0.5) & (cindex < shape - 0.5), axis=1)
+    result = np.full((len(cindex),) + volume.shape[ndim:], fill, dtype=float)
+    if not inside.any():
+        return result
+    halo = _halo(order)
+    points = cindex[inside]
+    lower = np.maximum(np.floor(points.min(axis=0)).astype(int) - halo, 0)
+    upper = np.minimum(np.ceil(points.max(axis=0)).astype(int) + halo + 1,
+                       shape)
+    box = tuple(slice(l, u) for l, u in zip(lower, upper))
+    # At the edges of the volume the box has the same mirrored boundaries
+    coefficients = interpolation.prefilter(volume[box], order, ndim=ndim,
+                                           tolerance=HALO_TOLERANCE)
+    result[inside] = interpolation.bspline(coefficients, points - lower,
+                                           order, fill)
+    return result
+
+
+class _Volume(object):
+    """A volume to resample, with its geometry."""
+    def __init__(self, volume, spacing, origin, direction):
+        if isinstance(volume, str):
+            volume = metaimage.MetaImage(volume)
+        if isinstance(volume, metaimage.MetaImage):
+            spacing = volume.spacing if spacing is None else spacing
+            origin = volume.origin if origin is None else origin
+            direction = volume.direction if direction is None else direction
+            volume = volume.data
+        self.data = volume
+        self.ndim = None
+        self.spacing, self.origin, self.direction = spacing, origin, direction
+
+    def geometry(self, ndim):
+        self.ndim = ndim
+        self.spacing = np.ones(ndim) if self.spacing is None \
+            else np.asarray(self.spacing, dtype=float)
+        self.origin = np.zeros(ndim) if self.origin is None \
+            else np.asarray(self.origin, dtype=float)
+        self.direction = np.eye(ndim) if self.direction is None \
+            else np.asarray(self.direction, dtype=float)
+        self.inverse = np.linalg.inv(self.direction)
+
+    def physical_to_index(self, points):
+        index = (points - self.origin).dot(self.inverse.T) / self.spacing
+        return index[:, ::-1]
+
+
+class Resampler(object):
+    """
+    Warps volumes with a (memory-mapped) deformation field.
+
+    >>> field = tr.deformation_field(output_dir='results', load=True)
+    >>> resampler = Resampler(field)
+    >>> warped_dose = resampler(dose, order=3, spacing=dose_spacing)
+    >>> resampler('labels.mhd', order=0, output_path='warped_labels.mhd')
+
+    Args:
+        deformation_field: (str or MetaImage) The vector image written by
+                           transformix, e.g. deformationField.mhd.
+        tile_size: (int) Number of output voxels warped per task.
+        max_workers: (int) Number of threads. Defaults to the number of
+                     available cores.
+    """
+
+    def __init__(self, deformation_field, tile_size=TILE_SIZE,
+                 max_workers=None):
+        if not isinstance(deformation_field, metaimage.MetaImage):
+            deformation_field = metaimage.MetaImage(deformation_field)
+        self.field = deformation_field
+        self.ndim = deformation_field.ndim
+        self.shape = deformation_field.shape[:self.ndim]
+        self.tile_size = tile_size
+        self.max_workers = max_workers or available_cores()
+
+    def _tiles(self):
+        slice_size = int(np.prod(self.shape[1:]))
+        step = max(1, self.tile_size // max(slice_size, 1))
+        for start in range(0, self.shape[0], step):
+            yield slice(start, min(start + step, self.shape[0]))
+
+    def _warp_tile(self, tile, volume, values, order, fill, output, local):
+        field = self.field
+        shape = (tile.stop - tile.start,) + self.shape[1:]
+        cindex = np.indices(shape).reshape(self.ndim, -1).T
+        cindex[:, 0] += tile.start
+        points = field.index_to_physical(cindex)
+        points += np.asarray(field.data[tile], dtype=float).reshape(-1, self.ndim)
+        moving = volume.physical_to_index(points)
+        if order == 0:
+            result = interpolation.nearest(values, moving, fill)
+        elif order == 1:
+            result = interpolation.linear(values, moving, fill)
+        elif local:
+            result = _local_bspline(values, moving, order, fill, self.ndim)
+        else:
+            result = interpolation.bspline(values, moving, order, fill)
+        result = result.reshape(shape + values.shape[self.ndim:])
+        if np.issubdtype(output.dtype, np.integer):
+            result = np.rint(result)
+        output[tile] = result
+
+    def __call__(self, volume, order=1, spacing=None, origin=None,
+                 direction=None, fill=0.0, output_path=None, dtype=None):
+        """
+        Warp a volume.
+
+        Args:
+            volume: (ndarray, str or MetaImage) The moving volume, in C
+                    order, optionally with a trailing component axis.
+            order: (int) 0 for nearest neighbour, 1 for linear, and 2 or 3
+                   for B-spline interpolation, like elastix'
+                   FinalBSplineInterpolationOrder. The B-spline
+                   coefficients of volumes larger than `PREFILTER_BYTES`
+                   are computed for every tile on the region it samples,
+                   which bounds memory at the cost of prefiltering the
+                   halo around every tile again.
+            spacing, origin, direction: Geometry of the volume in ITK
+                                        order; taken from the MetaImage or
+                                        the identity by default.
+            fill: (float) Value of points that map outside the volume.
+            output_path: (str) If given, the result is written to this
+                         MetaImage (.mhd) tile by tile and returned as a
+                         `MetaImage`; otherwise it is returned as an array.
+            dtype: Type of the result. Defaults to the type of the volume
+                   for nearest neighbour interpolation, and float32
+                   otherwise.
+
+        Returns:
+            The warped volume on the grid of the deformation field.
+        """
+        volume = _Volume(volume, spacing, origin, direction)
+        volume.geometry(self.ndim)
+        values = volume.data
+        local = order >= 2 and 8 * values.size > PREFILTER_BYTES
+        if order >= 2 and not local:
+            # Small enough to compute the coefficients once for all tiles
+            values = interpolation.prefilter(values, order, ndim=self.ndim)
+        if dtype is None:
+            dtype = volume.data.dtype if order == 0 else np.float32
+        shape = self.shape + values.shape[self.ndim:]
+
+        if output_path is None:
+            output = np.empty(shape, dtype=dtype)
+        else:
+            raw_path = os.path.splitext(output_path)[0] + '.raw'
+            output = np.memmap(raw_path, dtype=dtype, mode='w+', shape=shape)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(self._warp_tile, tile, volume, values,
+                                       order, fill, output, local)
+                       for tile in self._tiles()]
+            for future in futures:
+                future.result()
+
+        if output_path is None:
+            return output
+        output.flush()
+        metaimage.write_mhd(output_path, output, spacing=self.field.spacing,
+                            origin=self.field.origin,
+                            direction=self.field.direction,
+                            vector=len(shape) > self.ndim, data_file=raw_path)
+        del output
+        return metaimage.MetaImage(output_path)
+
+
+def resample(deformation_field, volume, order=1, **kwargs):
+    """Shorthand for `Resampler(deformation_field)(volume, order, ...)`."""
+    return Resampler(deformation_field)(volume, order, **kwargs)
@@ -0,0 +1,395 @@
+#!/usr/bin/env python
+#
+# Resource-aware admission control for concurrent elastix and transformix
+# processes. Left alone, every elastix process uses all cores, and a few
+# large 3D registrations started together can exhaust the memory of a
+# node. A ResourceGovernor hands out cores and memory: every job states
+# (or has estimated) its thread count and peak memory, waits until both
+# are free, optionally gets pinned to its own cores, and returns them when
+# it finishes.
+#
+# Core and memory detection honours CPU affinity and cgroup (v1 and v2)
+# limits, as set by container runtimes and batch schedulers.
+
+
+from __future__ import division, print_function
+
+import logging
+import math
+import multiprocessing
+import os
+import sys
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+
+from .metaimage import MetaImage
+from .parameter_file import ParameterFile
+
+logger = logging.getLogger(__name__)
+
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+
+# Memory of an elastix process with tiny images
+BASE_MEMORY = 200 * 1024 ** 2
+
+# Pinning wrapper: sets the affinity and then becomes the actual process,
+# so its pid, return code and signals are those of elastix itself
+_PIN = ('import os, sys; '
+        'os.sched_setaffinity(0, [int(c) for c in sys.argv[1].split(",")]); '
+        'os.execvp(sys.argv[2], sys.argv[2:])')
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def _cgroup_cpu_limit():
+    """CPU limit of the cgroup in (fractional) cores, or None."""
+    value = _read(os.path.join(CGROUP_ROOT, 'cpu.max'))
+    if value is not None:
+        quota, _, period = value.partition(' ')
+        if quota != 'max':
+            return int(quota) / int(period or 100000)
+        return None
+    quota = _read(os.path.join(CGROUP_ROOT, 'cpu', 'cpu.cfs_quota_us'))
+    period = _read(os.path.join(CGROUP_ROOT, 'cpu', 'cpu.cfs_period_us'))
+    if quota is not None and period is not None and int(quota) > 0:
+        return int(quota) / int(period)
+    return None
+
+
+def _cgroup_memory_free():
+    """Memory the cgroup may still use, or None if it is not limited."""
+    limit = _read(os.path.join(CGROUP_ROOT, 'memory.max'))
+    usage = _read(os.path.join(CGROUP_ROOT, 'memory.current'))
+    if limit is None:
+        limit = _read(os.path.join(CGROUP_ROOT, 'memory',
+                                   'memory.limit_in_bytes'))
+        usage = _read(os.path.join(CGROUP_ROOT, 'memory',
+                                   'memory.usage_in_bytes'))
+    if limit is None or limit == 'max':
+        return None
+    limit = int(limit)
+    # cgroup v1 reports "no limit" as a huge page-aligned number
+    if limit >= 1 << 60:
+        return None
+    return max(0, limit - int(usage or 0))
+
+
+def available_cores():
+    """
+    Number of cores this process may use: its CPU affinity, further
+    limited by the CPU quota of its cgroup.
+    """
+    try:
+        cores = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cores = multiprocessing.cpu_count()
+    limit = _cgroup_cpu_limit()
+    if limit is not None:
+        cores = min(cores, max(1, int(math.ceil(limit))))
+    return cores
+
+
+def worker_budget(count, max_workers=None, threads_per_job=None,
+                  governor=None):
+    """
+    Number of concurrent workers and elastix threads per worker of a batch
+    of `count` jobs, such that the batch as a whole does not oversubscribe
+    the cores: the available cores, or those of `governor`.
+
+    Returns:
+        A tuple (max_workers, threads_per_job). With a governor,
+        `threads_per_job` stays None unless it was given, so that the
+        governor's default applies.
+    """
+    cores = available_cores() if governor is None else governor.cores
+    if max_workers is None:
+        default = governor.default_threads if governor is not None else 1
+        max_workers = max(1, cores // (threads_per_job or default))
+    max_workers = max(1, min(max_workers, count))
+    if threads_per_job is None and governor is None:
+        threads_per_job = max(1, cores // max_workers)
+    return max_workers, threads_per_job
+
+
+def available_memory():
+    """
+    Bytes of memory available to new processes: MemAvailable of the
+    system, further limited by the memory limit of the cgroup.
+    """
+    available = None
+    meminfo = _read('/proc/meminfo')
+    if meminfo is not None:
+        for line in meminfo.splitlines():
+            if line.startswith('MemAvailable:'):
+                available = int(line.split()[1]) * 1024
+                break
+    if available is None:
+        try:
+            available = os.sysconf('SC_AVPHYS_PAGES') * \
+                os.sysconf('SC_PAGE_SIZE')
+        except (ValueError, OSError, AttributeError):
+            available = 0
+    cgroup = _cgroup_memory_free()
+    if cgroup is not None:
+        available = min(available, cgroup)
+    return available
+
+
+class _ImageInfo(object):
+    """
+    Voxel count, bytes per voxel and physical extent of an image. For the
+    list of channels of a multichannel image, the voxels of all channels
+    are summed.
+    """
+    def __init__(self, path):
+        self.voxels = 0
+        self.itemsize = 2
+        self.extent = None
+        if isinstance(path, (list, tuple)):
+            channels = [_ImageInfo(channel) for channel in path]
+            self.voxels = sum(c.voxels for c in channels)
+            if channels:
+                self.itemsize = max(c.itemsize for c in channels)
+                self.extent = channels[0].extent
+            return
+        if path is None or not os.path.exists(path):
+            # Left to elastix to complain about
+            return
+        if path.lower().endswith(('.mhd', '.mha')):
+            image = MetaImage(path)
+            self.voxels = int(np.prod(image.shape))
+            self.itemsize = image.dtype.itemsize
+            self.extent = [sp * n for sp, n in zip(image.spacing, image.size)]
+        else:
+            # No cheap way to read the header: assume uncompressed 16 bit
+            self.voxels = os.path.getsize(path) // self.itemsize
+
+
+def _pyramid_fraction(pf, prefix, dimension, resolutions):
+    """
+    Memory of all pyramid levels relative to the full image. Smoothing
+    pyramids keep every level at full size; the others downsample.
+    """
+    pyramid = pf.scalar(prefix + 'ImagePyramid', '')
+    if 'Smoothing' in pyramid:
+        return float(resolutions)
+    schedule = pf.get(prefix + 'ImagePyramidSchedule') or \
+        pf.get('ImagePyramidSchedule')
+    total = 0.0
+    for r in range(resolutions):
+        if schedule and len(schedule) == resolutions * dimension:
+            factors = schedule[r * dimension:(r + 1) * dimension]
+        else:
+            factors = [2 ** (resolutions - 1 - r)] * dimension
+        total += 1.0 / float(np.prod([max(f, 1) for f in factors]))
+    return total
+
+
+def estimate_registration_memory(parameters, fixed_image=None,
+                                 moving_image=None, fixed_mask=None,
+                                 moving_mask=None):
+    """
+    Rough estimate of the peak memory of an elastix run in bytes, from
+    the image headers and the parameter files. The stages of a chain run
+    one after the other, so the estimate is that of the largest stage.
+    Images whose header cannot be read cheaply (anything but MetaImage)
+    are estimated from their file size.
+    """
+    fixed = _ImageInfo(fixed_image)
+    moving = _ImageInfo(moving_image)
+    masks = _ImageInfo(fixed_mask).voxels + _ImageInfo(moving_mask).voxels
+    inputs = fixed.voxels * fixed.itemsize + moving.voxels * moving.itemsize
+
+    peak = 0
+    for prm in parameters:
+        pf = ParameterFile.read(prm)
+        dimension = int(pf.scalar('FixedImageDimension', 3))
+        resolutions = int(pf.scalar('NumberOfResolutions', 1))
+        # Internal images are float
+        pyramids = 4 * (
+            fixed.voxels * _pyramid_fraction(pf, 'Fixed', dimension,
+                                             resolutions) +
+            moving.voxels * _pyramid_fraction(pf, 'Moving', dimension,
+                                              resolutions))
+        interpolation = 0
+        if 'BSpline' in pf.scalar('Interpolator', '') and \
+                int(pf.scalar('BSplineInterpolationOrder', 1)) > 1:
+            # Double precision coefficients of the moving image
+            interpolation = 8 * moving.voxels
+        resampling = 0
+        if pf.scalar('WriteResultImage', True) not in (False, 'false'):
+            resampling = 4 * fixed.voxels
+            if int(pf.scalar('FinalBSplineInterpolationOrder', 3)) > 1:
+                resampling += 8 * moving.voxels
+        transform = 0
+        if 'BSpline' in pf.scalar('Transform', '') and fixed.extent:
+            spacing = pf.get('FinalGridSpacingInPhysicalUnits') or [16.0]
+            if len(spacing) < dimension:
+                spacing = list(spacing) * dimension
+            points = np.prod([math.ceil(e / s) + 3
+                              for e, s in zip(fixed.extent, spacing)])
+            # Parameters, gradient and optimizer state in double precision
+            transform = 8 * 6 * dimension * int(points)
+        peak = max(peak, pyramids + interpolation + max(resampling,
+                                                         transform))
+    return int(BASE_MEMORY + inputs + masks + peak)
+
+
+def estimate_transformix_memory(parameters=None, image=None, outputs=()):
+    """
+    Rough estimate of the peak memory of a transformix run in bytes. The
+    output grid is the Size in the transform parameter file `parameters`;
+    without it, the input image is assumed to be on a similar grid.
+    """
+    image = _ImageInfo(image)
+    grid = 0
+    if parameters is not None:
+        size = ParameterFile.read(parameters).get('Size')
+        if size:
+            grid = int(np.prod(size))
+    grid = grid or image.voxels
+    total = BASE_MEMORY + image.voxels * (image.itemsize + 8) + 4 * grid
+    components = {'deformation_field': 3, 'jacobian_determinant': 1,
+                  'jacobian_matrix': 9}
+    for output in outputs:
+        total += 4 * components.get(output, 0) * grid
+    return int(total)
+
+
+class Allocation(object):
+    """Cores and memory granted to one job by a `ResourceGovernor`."""
+    def __init__(self, threads, memory, cpus=None):
+        self.threads = threads
+        self.memory = memory
+        self.cpus = cpus
+
+    def wrap(self, command):
+        """Prefix a command so that it runs pinned to this allocation."""
+        if not self.cpus:
+            return command
+        return [sys.executable, '-c', _PIN,
+                ','.join(str(c) for c in sorted(self.cpus))] + list(command)
+
+    def __repr__(self):
+        return 'Allocation(threads={}, memory={}, cpus={})'.format(
+            self.threads, self.memory, self.cpus)
+
+
+class ResourceGovernor(object):
+    """
+    Admission control of concurrent jobs by cores and memory.
+
+    >>> governor = ResourceGovernor(default_threads=4, pin=True)
+    >>> el = ElastixInterface(ELASTIX_PATH, governor=governor)
+    >>> el.register_many(jobs, max_workers=32)  # admitted as resources free up
+
+    Args:
+        cores: (int) Cores to hand out. Defaults to `available_cores()`.
+        memory: (int) Bytes to hand out. Defaults to `memory_fraction`
+                of `available_memory()` when the governor is created.
+        memory_fraction: (float) Safety margin of the default memory.
+        default_threads: (int) Threads of jobs that do not ask for a
+                         number. Defaults to all cores, i.e. jobs run one
+                         at a time unless they ask for fewer threads.
+        pin: (bool) Pin every job to its own set of cores.
+    """
+
+    def __init__(self, cores=None, memory=None, memory_fraction=0.9,
+                 default_threads=None, pin=False):
+        self.cores = cores or available_cores()
+        if memory is None:
+            memory = int(available_memory() * memory_fraction)
+        self.memory = memory
+        self.default_threads = min(default_threads or self.cores, self.cores)
+        self.pin = pin
+        self._free_cores = self.cores
+        self._free_memory = self.memory
+        self._running = 0
+        try:
+            cpus = sorted(os.sched_getaffinity(0))
+        except AttributeError:
+            cpus = list(range(self.cores))
+        self._free_cpus = cpus[:self.cores]
+        self._condition = threading.Condition()
+
+    def _fits(self, threads, memory):
+        if self._running == 0:
+            # A job larger than the machine still runs, on its own
+            return True
+        return threads <= self._free_cores and memory <= self._free_memory
+
+    def acquire(self, threads=None, memory=0, timeout=None):
+        """
+        Wait until `threads` cores and `memory` bytes are free and take
+        them.
+
+        Returns:
+            An `Allocation`, or None if `timeout` expired.
+        """
+        threads = min(threads or self.default_threads, self.cores)
+        if memory > self.memory:
+            logger.warning('Job needs an estimated {:.1f} GiB of the {:.1f} '
+                           'GiB available; it will run alone'.format(
+                               memory / 1024 ** 3, self.memory / 1024 ** 3))
+        with self._condition:
+            if not self._condition.wait_for(
+                    lambda: self._fits(threads, memory), timeout):
+                return None
+            self._free_cores -= threads
+            self._free_memory -= memory
+            self._running += 1
+            cpus = None
+            if self.pin:
+                cpus = self._free_cpus[:threads]
+                self._free_cpus = self._free_cpus[threads:]
+            return Allocation(threads, memory, cpus)
+
+    def release(self, allocation):
+        with self._condition:
+            self._free_cores += allocation.threads
+            self._free_memory += allocation.memory
+            self._running -= 1
+            if allocation.cpus:
+                self._free_cpus = sorted(self._free_cpus + allocation.cpus)
+            self._condition.notify_all()
+
+    @contextmanager
+    def reserve(self, threads=None, memory=0):
+        """Context manager around `acquire` and `release`."""
+        allocation = self.acquire(threads, memory)
+        try:
+            yield allocation
+        finally:
+            self.release(allocation)
+
+    def status(self):
+        with self._condition:
+            return {'running': self._running,
+                    'free_cores': self._free_cores,
+                    'free_memory': self._free_memory}
+
+
+@contextmanager
+def admit(governor, threads, estimate):
+    """
+    Reserve resources for a job if there is a governor. `estimate` is
+    called for the memory estimate only when needed.
+
+    Yields:
+        The `Allocation`, or an allocation of `threads` without pinning
+        if there is no governor.
+    """
+    if governor is None:
+        yield Allocation(threads, 0)
+        return
+    with governor.reserve(threads, estimate()) as allocation:
+        yield allocation
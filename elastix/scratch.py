@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+#
+# Managed scratch directories. Every elastix or transformix run gets a
+# fresh, private working directory (by default inside its output
+# directory, so promoting a result is a rename on the same file system),
+# so outputs are found by their exact name instead of by guessing among
+# whatever is in a shared output directory, and concurrent jobs can never
+# pick up each other's files or stale results of earlier runs. Only the
+# requested artifacts are promoted to the final output directory; logs and
+# other by-products are removed with the scratch directory. Staging on
+# tmpfs is opt-in, see TMPFS.
+
+
+from __future__ import division, print_function
+
+import fnmatch
+import os
+import re
+import shutil
+import tempfile
+
+
+_DATA_FILE = re.compile(r'^\s*ElementDataFile\s*=\s*(.*?)\s*$', re.MULTILINE)
+
+# Pass as a scratch directory to stage on tmpfs (/dev/shm) when available
+TMPFS = 'tmpfs'
+
+
+def scratch_root(preferred=None, near=None):
+    """
+    Directory for short-lived files exchanged with elastix: `preferred`
+    if given, otherwise `near` (typically the final output directory, so
+    promoting an artifact is a rename on the same file system), and the
+    system temporary directory otherwise. `preferred` may be `TMPFS`,
+    which stands for /dev/shm if it is writable.
+    """
+    if preferred == TMPFS:
+        shm = '/dev/shm'
+        if os.path.isdir(shm) and os.access(shm, os.W_OK):
+            return shm
+        return tempfile.gettempdir()
+    if preferred is not None:
+        return preferred
+    if near is not None:
+        return near
+    return tempfile.gettempdir()
+
+
+def mkdtemp(prefix, root=None, near=None):
+    """Create a new directory in the scratch root; the caller owns it."""
+    return tempfile.mkdtemp(prefix=prefix, dir=scratch_root(root, near))
+
+
+def find_artifact(directory, basename, extensions):
+    """
+    Path of `basename` with the first of `extensions` that exists in
+    `directory`, or None. In a private scratch directory this is
+    unambiguous: the only files in it are those of a single run.
+    """
+    for extension in extensions:
+        path = os.path.join(directory, basename + extension)
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def _companion_files(path):
+    """
+    Data files that belong with `path`: the .raw file of a MetaImage
+    header, if it lives next to it.
+    """
+    if not path.lower().endswith('.mhd'):
+        return []
+    with open(path, 'rb') as f:
+        match = _DATA_FILE.search(f.read().decode('latin-1'))
+    if match is None or match.group(1) == 'LOCAL':
+        return []
+    data_file = match.group(1)
+    if os.path.isabs(data_file) or os.sep in data_file:
+        return []
+    return [os.path.join(os.path.dirname(path), data_file)]
+
+
+def _move(source, destination):
+    """
+    Move a file, replacing `destination` atomically. Across file systems
+    the file is copied next to `destination` first, so readers never see
+    a partially written file.
+    """
+    try:
+        os.replace(source, destination)
+    except OSError:
+        partial = '{}.partial-{}'.format(destination, os.getpid())
+        shutil.copyfile(source, partial)
+        os.replace(partial, destination)
+        os.remove(source)
+
+
+class ScratchDir(object):
+    """
+    A private working directory that is removed on exit.
+
+    >>> with ScratchDir('transformix-') as work:
+    ...     run(['transformix', ..., '-out', work.path])
+    ...     path = work.promote(work.join('result.mhd'), output_dir)
+
+    Args:
+        prefix: (str) Prefix of the directory name.
+        root: (str) Where to create it, or `TMPFS`. Overrides `near`.
+        near: (str) Directory to create it in if `root` is not given,
+              usually the destination of `promote`. Defaults to the
+              system temporary directory.
+        keep: (bool) Do not remove the directory on exit, e.g. to debug a
+              failing run.
+    """
+
+    def __init__(self, prefix='elastix-', root=None, keep=False, near=None):
+        self.path = mkdtemp(prefix, root, near)
+        self.keep = keep
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if not self.keep:
+            self.cleanup()
+
+    def join(self, *names):
+        return os.path.join(self.path, *names)
+
+    def cleanup(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def promote(self, path, destination):
+        """
+        Move an artifact of this directory into `destination`, together
+        with the .raw file of a MetaImage header. References to the
+        scratch directory in text files (such as the initial transform of
+        a transform parameter file) are rewritten to `destination`.
+
+        Returns:
+            The new path of the artifact.
+        """
+        target = os.path.join(destination, os.path.basename(path))
+        # Data before header, so a header never points at missing data
+        for companion in _companion_files(path):
+            _move(companion, os.path.join(destination,
+                                          os.path.basename(companion)))
+        if path.endswith('.txt'):
+            with open(path) as f:
+                text = f.read()
+            if self.path in text:
+                with open(path, 'w') as f:
+                    f.write(text.replace(self.path,
+                                         os.path.abspath(destination)))
+        _move(path, target)
+        return target
+
+    def promote_matching(self, patterns, destination):
+        """
+        Promote every file whose name matches one of the glob `patterns`.
+
+        Returns:
+            The sorted list of the new paths.
+        """
+        promoted = []
+        for name in sorted(os.listdir(self.path)):
+            path = self.join(name)
+            if os.path.isfile(path) and \
+                    any(fnmatch.fnmatch(name, p) for p in patterns):
+                promoted.append(self.promote(path, destination))
+        return promoted
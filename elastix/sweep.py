@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+#
+# Hyperparameter sweeps over cascaded registrations. A sweep varies the
+# parameters of one or more stages of a chain (e.g. affine, then
+# B-spline), which gives one chain per combination. Chains that agree on
+# their first stages share those stages: the sweep builds a prefix tree
+# of stages, runs every node of the tree once, and feeds its transform as
+# the initial transform of its children. Independent nodes run in
+# parallel, and the final metric of every variant is read from the
+# IterationInfo files.
+
+
+from __future__ import division, print_function
+
+import hashlib
+import itertools
+import json
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from .elastix_interface import RegistrationResult
+from .log_files import load_iteration_infos
+from .parameter_file import write_overrides
+from .resources import worker_budget
+
+
+def expand_grid(options):
+    """
+    Expand a dict mapping parameter names to lists of values into the
+    list of all combinations, as dicts of overrides.
+
+    >>> expand_grid({'NumberOfResolutions': [2, 3],
+    ...              'FinalGridSpacingInPhysicalUnits': [8, 16]})
+    [{'NumberOfResolutions': 2, 'FinalGridSpacingInPhysicalUnits': 8}, ...]
+    """
+    names = sorted(options)
+    return [OrderedDict(zip(names, values))
+            for values in itertools.product(*(options[n] for n in names))]
+
+
+def _stage_variants(entry):
+    if entry is None:
+        return [OrderedDict()]
+    if isinstance(entry, dict):
+        return expand_grid(entry)
+    return [OrderedDict(sorted(overrides.items())) for overrides in entry]
+
+
+class _Node(object):
+    """A stage of the prefix tree: one elastix run."""
+    def __init__(self, stage, parameters, overrides, parent, output_dir):
+        self.stage = stage
+        self.parameters = parameters
+        self.overrides = overrides
+        self.parent = parent
+        self.children = []
+        # Named after the whole prefix, so reruns reuse the same directory
+        prefix = [] if parent is None else parent.key
+        self.key = prefix + [[parameters, list(overrides.items())]]
+        digest = hashlib.sha1(json.dumps(self.key, sort_keys=True)
+                              .encode('utf-8')).hexdigest()[:12]
+        self.output_dir = os.path.join(output_dir, 'stage{}-{}'.format(
+            stage, digest))
+        self.result = None
+
+    @property
+    def transform(self):
+        return os.path.join(self.output_dir, 'TransformParameters.0.txt')
+
+    def chain(self):
+        node, chain = self, []
+        while node is not None:
+            chain.insert(0, node)
+            node = node.parent
+        return chain
+
+
+class SweepResult(object):
+    """Outcome of one variant (one leaf of the prefix tree) of a sweep."""
+    def __init__(self, overrides, nodes):
+        self.overrides = overrides
+        self.output_dirs = [node.output_dir for node in nodes]
+        self.transform = nodes[-1].transform
+        failed = [n.result for n in nodes if not n.result.success]
+        self.error = failed[0].error if failed else None
+        self.elapsed = sum(n.result.elapsed or 0.0 for n in nodes)
+        self.metric = None
+        if self.error is None:
+            table = load_iteration_infos(self.output_dirs[-1])
+            if 'metric' in table and len(table['metric']):
+                self.metric = float(table['metric'][-1])
+
+    @property
+    def success(self):
+        return self.error is None
+
+    def __repr__(self):
+        status = 'metric {}'.format(self.metric) if self.success else \
+            'failed: {!r}'.format(self.error)
+        return 'SweepResult({}, {})'.format(
+            [dict(o) for o in self.overrides], status)
+
+
+class Sweep(object):
+    """
+    A sweep over parameter file overrides of a chain of stages.
+
+    >>> sweep = Sweep(['parameters_affine.txt', 'parameters_bspline.txt'],
+    ...               [None, {'FinalGridSpacingInPhysicalUnits': [8, 16, 32],
+    ...                       'NumberOfSpatialSamples': [2048, 4096]}])
+    >>> results = sweep.run(ElastixInterface(ELASTIX_PATH), 'results',
+    ...                     fixed_image=fixed, moving_image=moving)
+    >>> best = min((r for r in results if r.success), key=lambda r: r.metric)
+
+    Here the affine stage runs once and the six B-spline variants start
+    from its result.
+
+    Args:
+        stages: (list) Parameter files of the stages, in order.
+        grid: (list) One entry per stage: None (no variation), a dict of
+              parameter names to lists of values (all combinations are
+              tried), or a list of dicts of overrides.
+    """
+
+    def __init__(self, stages, grid=None):
+        self.stages = list(stages)
+        if grid is None:
+            grid = [None] * len(self.stages)
+        if len(grid) != len(self.stages):
+            raise ValueError('The grid needs one entry per stage')
+        self.grid = [_stage_variants(entry) for entry in grid]
+
+    @property
+    def variants(self):
+        """All combinations of overrides, one tuple of dicts per chain."""
+        return list(itertools.product(*self.grid))
+
+    def _tree(self, output_dir):
+        """Build the prefix tree. Returns the roots and the leaf chains."""
+        roots, leaves = [], []
+        nodes = {}
+        for variant in self.variants:
+            parent = None
+            for stage, overrides in enumerate(variant):
+                key = (id(parent), json.dumps(list(overrides.items())))
+                node = nodes.get(key)
+                if node is None:
+                    node = _Node(stage, self.stages[stage], overrides,
+                                 parent, output_dir)
+                    nodes[key] = node
+                    (roots if parent is None else parent.children).append(node)
+                parent = node
+            leaves.append((variant, parent))
+        return roots, leaves, len(nodes)
+
+    def _job(self, node, inputs):
+        if not os.path.exists(node.output_dir):
+            os.makedirs(node.output_dir)
+        parameters = write_overrides(
+            node.parameters, node.overrides,
+            os.path.join(node.output_dir, 'parameters.txt'))
+        job = dict(inputs)
+        job['parameters'] = [parameters]
+        job['output_dir'] = node.output_dir
+        if node.parent is not None:
+            job['initial_transform'] = node.parent.transform
+        return job
+
+    def run(self, elastix, output_dir, fixed_image=None, moving_image=None,
+            fixed_mask=None, moving_mask=None, fixed_points=None,
+            moving_points=None, initial_transform=None, max_workers=None,
+            threads_per_job=None):
+        """
+        Run the sweep.
+
+        Args:
+            elastix: (ElastixInterface) Runs the stages (and caches them,
+                     if it has a cache).
+            output_dir: (str) Every node of the tree gets a subdirectory
+                        stage<i>-<hash of the prefix>.
+            max_workers, threads_per_job: As in
+                                          `ElastixInterface.register_many`.
+            The other arguments are those of `ElastixInterface.register`;
+            `initial_transform` is the initial transform of the first stage.
+
+        Returns:
+            A list of `SweepResult` objects, one per variant, in the order
+            of `variants`. Variants whose (shared) stages failed have the
+            error set and no metric.
+        """
+        roots, leaves, count = self._tree(output_dir)
+        inputs = {'fixed_image': fixed_image, 'moving_image': moving_image,
+                  'fixed_mask': fixed_mask, 'moving_mask': moving_mask,
+                  'fixed_points': fixed_points,
+                  'moving_points': moving_points,
+                  'initial_transform': initial_transform}
+
+        max_workers, threads_per_job = worker_budget(
+            count, max_workers, threads_per_job, elastix.governor)
+
+        def skip(node, error):
+            # Children of a failed stage cannot run
+            node.result = RegistrationResult({'output_dir': node.output_dir},
+                                             error=error, elapsed=0.0)
+            for child in node.children:
+                skip(child, error)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            running = {}
+
+            def submit(node):
+                future = executor.submit(elastix.register_job,
+                                         self._job(node, inputs),
+                                         threads_per_job)
+                running[future] = node
+
+            for root in roots:
+                submit(root)
+            while running:
+                finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    node = running.pop(future)
+                    node.result = future.result()
+                    for child in node.children:
+                        if node.result.success:
+                            submit(child)
+                        else:
+                            skip(child, node.result.error)
+
+        return [SweepResult(variant, leaf.chain()) for variant, leaf in leaves]
+
+
+def run_sweep(elastix, stages, grid, output_dir, **kwargs):
+    """Shorthand for `Sweep(stages, grid).run(elastix, output_dir, ...)`."""
+    return Sweep(stages, grid).run(elastix, output_dir, **kwargs)
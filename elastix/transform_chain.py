@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+#
+# Simplification of cascaded transforms. A cascade such as rigid, then
+# affine, then B-spline makes transformix evaluate every stage at every
+# voxel. `collapse_chain` folds consecutive linear stages into a single
+# affine transform, and `bake_chain` samples the whole chain once into a
+# dense deformation field transform, which is cheap to apply to many
+# images and label maps afterwards. `invert_chain` writes the inverse of a
+# chain, exactly for linear chains and as a sampled field otherwise.
+
+
+from __future__ import division, print_function
+
+import os
+
+import numpy as np
+
+from . import metaimage
+from .parameter_file import load
+from .point_transform import (LinearTransform, TransformEvaluator,
+                              make_transform, _dimension, _direction, _vector)
+
+
+# Parameters that only make sense for a specific kind of transform, and
+# are dropped when a stage is replaced by another kind
+TRANSFORM_SPECIFIC_PARAMETERS = (
+    'TransformParameters', 'NumberOfParameters', 'CenterOfRotationPoint',
+    'ComputeZYX', 'GridSize', 'GridIndex', 'GridSpacing', 'GridOrigin',
+    'GridDirection', 'BSplineTransformSplineOrder', 'UseCyclicTransform',
+    'DeformationFieldFileName', 'DeformationFieldInterpolationOrder',
+)
+
+# Points sampled at once by `bake_chain`
+BAKE_CHUNK_SIZE = 1 << 20
+
+# Fixed-point iterations of `invert_chain` for non-linear chains, and the
+# residual (in voxels of the reference grid) at which a point is done
+INVERT_ITERATIONS = 20
+INVERT_TOLERANCE = 0.01
+
+
+def _strip(pf):
+    pf = pf.copy()
+    for key in TRANSFORM_SPECIFIC_PARAMETERS:
+        if key in pf:
+            del pf[key]
+    return pf
+
+
+def _affine_parameter_file(template, matrix, offset):
+    dimension = len(offset)
+    pf = _strip(template)
+    pf['Transform'] = 'AffineTransform'
+    pf['NumberOfParameters'] = dimension * (dimension + 1)
+    pf['TransformParameters'] = np.concatenate([matrix.ravel(), offset])
+    pf['CenterOfRotationPoint'] = [0.0] * dimension
+    return pf
+
+
+def _groups(chain):
+    """
+    Split a chain into runs of stages that can be folded together: linear
+    stages that are composed with their predecessor join the run before
+    them, everything else starts a run of its own.
+    """
+    groups = []
+    for pf in chain:
+        transform = make_transform(pf)
+        linear = isinstance(transform, LinearTransform)
+        composed = pf.scalar('HowToCombineTransforms', 'Compose') == 'Compose'
+        if groups and linear and composed and groups[-1][0]:
+            groups[-1][1].append((pf, transform))
+        else:
+            groups.append((linear, [(pf, transform)]))
+    return groups
+
+
+def _write_chain(chain, output_dir, prefix):
+    """Write a list of ParameterFiles as a chain, innermost first."""
+    previous = 'NoInitialTransform'
+    path = None
+    for i, pf in enumerate(chain):
+        pf['InitialTransformParametersFileName'] = previous
+        path = os.path.join(output_dir, '{}.{}.txt'.format(prefix, i))
+        pf.write(path)
+        previous = path
+    return path
+
+
+def collapse_chain(parameter_file, output_dir, prefix='TransformParameters.collapsed'):
+    """
+    Write a minimal equivalent of a transform chain, in which every run of
+    consecutive (composed) linear stages is folded into one affine stage.
+
+    Args:
+        parameter_file: (str) The last transform parameter file of the chain.
+        output_dir: (str) Directory for the new chain.
+        prefix: (str) File name prefix of the new chain's files.
+
+    Returns:
+        The path of the last file of the new chain, to be used with
+        transformix.
+    """
+    chain = load(parameter_file).chain()
+    collapsed = []
+    for linear, members in _groups(chain):
+        if linear and len(members) > 1:
+            matrix = np.eye(_dimension(members[0][0]))
+            offset = np.zeros(len(matrix))
+            for _, transform in members:
+                a, b = transform.affine()
+                matrix, offset = a.dot(matrix), a.dot(offset) + b
+            pf = _affine_parameter_file(members[-1][0], matrix, offset)
+            pf['HowToCombineTransforms'] = members[0][0].scalar(
+                'HowToCombineTransforms', 'Compose')
+            collapsed.append(pf)
+        else:
+            collapsed.extend(pf.copy() for pf, _ in members)
+    return _write_chain(collapsed, output_dir, prefix)
+
+
+def _grid_points(shape, spacing, direction, origin, start, stop):
+    """Physical points of the slabs start:stop of a grid, in C order."""
+    rest = np.indices(shape[1:]).reshape(len(shape) - 1, -1).T
+    cindex = np.concatenate([
+        np.repeat(np.arange(start, stop), len(rest))[:, None],
+        np.tile(rest, (stop - start, 1))], axis=1)
+    return (cindex[:, ::-1] * spacing).dot(direction.T) + origin
+
+
+def bake_chain(parameter_file, output_dir, prefix='TransformParameters.baked',
+               chunk_size=BAKE_CHUNK_SIZE):
+    """
+    Sample a whole transform chain on the fixed image grid into a dense
+    deformation field, and write a single DeformationFieldTransform that
+    refers to it. The field is computed slab by slab into a memory-mapped
+    file, so memory use is bounded by `chunk_size` points.
+
+    Returns:
+        The path of the new transform parameter file.
+    """
+    last = load(parameter_file)
+    evaluator = TransformEvaluator(last)
+    dimension = _dimension(last)
+    size = np.asarray(last['Size'], dtype=int)
+    spacing = _vector(last, 'Spacing', dimension, 1.0)
+    origin = _vector(last, 'Origin', dimension, 0.0)
+    direction = _direction(last, 'Direction', dimension)
+    index = _vector(last, 'Index', dimension, 0.0)
+    # Physical position of index 0 of the sampled grid
+    grid_origin = origin + direction.dot(spacing * index)
+
+    shape = tuple(size[::-1])
+    field_path = os.path.join(output_dir, prefix + '.field.mhd')
+    raw_path = os.path.splitext(field_path)[0] + '.raw'
+    field = np.memmap(raw_path, dtype=np.float32, mode='w+',
+                      shape=shape + (dimension,))
+
+    slice_size = int(np.prod(shape[1:]))
+    slabs = max(1, chunk_size // max(slice_size, 1))
+    for start in range(0, shape[0], slabs):
+        stop = min(start + slabs, shape[0])
+        points = _grid_points(shape, spacing, direction, grid_origin,
+                              start, stop)
+        field[start:stop] = (evaluator(points) - points).reshape(
+            (stop - start,) + shape[1:] + (dimension,))
+    field.flush()
+    metaimage.write_mhd(field_path, field, spacing=spacing,
+                        origin=grid_origin, direction=direction, vector=True,
+                        data_file=raw_path)
+    del field
+
+    pf = _strip(last)
+    pf['Transform'] = 'DeformationFieldTransform'
+    pf['NumberOfParameters'] = 0
+    pf['DeformationFieldFileName'] = field_path
+    pf['DeformationFieldInterpolationOrder'] = 1
+    pf['HowToCombineTransforms'] = 'Compose'
+    return _write_chain([pf], output_dir, prefix)
+
+
+def _invert_points(evaluator, targets, tolerance, iterations):
+    """
+    Solve T(x) = y for every target y by the fixed-point iteration
+    x <- x + y - T(x), which converges where T is close to the identity
+    locally (as for smooth, invertible deformations).
+    """
+    x = 2 * targets - evaluator(targets)
+    active = np.arange(len(targets))
+    for _ in range(iterations):
+        residual = targets[active] - evaluator(x[active])
+        x[active] += residual
+        done = np.linalg.norm(residual, axis=1) <= tolerance
+        active = active[~done]
+        if not len(active):
+            break
+    return x
+
+
+def invert_chain(parameter_file, reference, output_dir,
+                 prefix='TransformParameters.inverse',
+                 chunk_size=BAKE_CHUNK_SIZE, iterations=INVERT_ITERATIONS):
+    """
+    Write the inverse of a transform chain, i.e. the transform of the
+    registration with the fixed and moving image swapped, without running
+    elastix. A chain of composed linear stages is inverted exactly into one
+    affine stage. Any other chain is inverted point by point on the grid
+    of `reference` by fixed-point iteration, and written as a
+    DeformationFieldTransform like `bake_chain`; this is an approximation
+    that is only good where the chain is invertible.
+
+    Args:
+        parameter_file: (str) The last transform parameter file of the chain.
+        reference: (str) MetaImage whose grid the inverse is defined on:
+                   the moving image of the original registration.
+        output_dir: (str) Directory for the new transform parameter file.
+        prefix: (str) File name prefix of the new files.
+        chunk_size: (int) Points inverted at once.
+        iterations: (int) Fixed-point iterations for non-linear chains.
+
+    Returns:
+        The path of the new transform parameter file.
+    """
+    last = load(parameter_file)
+    image = metaimage.MetaImage(reference)
+    dimension = _dimension(last)
+    if image.ndim != dimension:
+        raise ValueError('The reference image is {}D, the transform {}D'
+                         .format(image.ndim, dimension))
+    spacing, origin, direction = image.spacing, image.origin, image.direction
+
+    def on_reference_grid(pf):
+        pf['Size'] = list(image.size)
+        pf['Index'] = [0] * dimension
+        pf['Spacing'] = spacing.tolist()
+        pf['Origin'] = origin.tolist()
+        # Stored like MetaIO, one axis after the other
+        pf['Direction'] = direction.T.ravel().tolist()
+        pf['HowToCombineTransforms'] = 'Compose'
+        return pf
+
+    groups = _groups(last.chain())
+    if len(groups) == 1 and groups[0][0]:
+        matrix = np.eye(dimension)
+        offset = np.zeros(dimension)
+        for _, transform in groups[0][1]:
+            a, b = transform.affine()
+            matrix, offset = a.dot(matrix), a.dot(offset) + b
+        inverse = np.linalg.inv(matrix)
+        pf = on_reference_grid(_affine_parameter_file(
+            last, inverse, -inverse.dot(offset)))
+        return _write_chain([pf], output_dir, prefix)
+
+    evaluator = TransformEvaluator(last)
+    shape = image.size[::-1]
+    tolerance = INVERT_TOLERANCE * spacing.min()
+    field_path = os.path.join(output_dir, prefix + '.field.mhd')
+    raw_path = os.path.splitext(field_path)[0] + '.raw'
+    field = np.memmap(raw_path, dtype=np.float32, mode='w+',
+                      shape=tuple(shape) + (dimension,))
+
+    slice_size = int(np.prod(shape[1:]))
+    slabs = max(1, chunk_size // max(slice_size, 1))
+    for start in range(0, shape[0], slabs):
+        stop = min(start + slabs, shape[0])
+        points = _grid_points(shape, spacing, direction, origin, start, stop)
+        field[start:stop] = (_invert_points(evaluator, points, tolerance,
+                                            iterations) - points).reshape(
+            (stop - start,) + tuple(shape[1:]) + (dimension,))
+    field.flush()
+    metaimage.write_mhd(field_path, field, spacing=spacing, origin=origin,
+                        direction=direction, vector=True, data_file=raw_path)
+    del field
+
+    pf = on_reference_grid(_strip(last))
+    pf['Transform'] = 'DeformationFieldTransform'
+    pf['NumberOfParameters'] = 0
+    pf['DeformationFieldFileName'] = field_path
+    pf['DeformationFieldInterpolationOrder'] = 1
+    return _write_chain([pf], output_dir, prefix)
@@ -14,11 +14,14 @@ See: Pg.23 of Elastix manual
 """
 import os
 
+from .parameter_file import format_value
+
 class TransformParameterFileEditor(object):
 
     def __init__(self,
                  transform_parameter_file_path=None,
-                 output_file_name=None):
+                 output_file_name=None,
+                 edits=None):
         """
 
         Args:
@@ -27,10 +30,14 @@ class TransformParameterFileEditor(object):
                                                          followed by deformable). The transform parameters files therefore
                                                          contain a pointer to a previous transformation (if any)
             output_file_name: (str) Filename for the output transform parameter file
+            edits: (dict) Additional parameter edits, applied after the default ones. Values are Python values
+                   (str, bool, int, float or lists of those). For typed access to the whole file, see
+                   elastix.parameter_file.ParameterFile
 
         """
         self.transform_parameter_file_path = transform_parameter_file_path
         self.output_file_name = output_file_name
+        self.edits = edits or {}
         self.params_dict = {}
 
     def _get_lines(self):
@@ -59,9 +66,8 @@ class TransformParameterFileEditor(object):
     def _edit_parameters(self):
         """
         Function edit the values of transform parameters.
-        Currently only supports parameter changes to support resampling of
-        binary labels
-        FIXME: Custom parameter edits
+        By default makes the parameter changes to support resampling of
+        binary labels, followed by the custom edits given to the constructor
         FIXME: Protect certain transform parameters from editing (eg: transform parameters/ dimension/ grid etc.)
 
         """
@@ -83,19 +89,19 @@ class TransformParameterFileEditor(object):
             new_path += '"' # Add trailing " so that transformix can parse the file correctly
             self.params_dict['InitialTransformParametersFileName'] = new_path
 
+        for key, value in self.edits.items():
+            self.params_dict[key] = format_value(value)
+
     def _writer_parameters_to_file(self):
         """
         Write updated parameter dict to file in the correct format
 
         """
-        parameter_file_string = ''
-        for key, value in self.params_dict.items():
-            parameter_file_string += '('
-            parameter_file_string += key
-            parameter_file_string += ' '
-            parameter_file_string += value
-            parameter_file_string += ')'
-            parameter_file_string += '\n'
+        # Join once instead of concatenating: the TransformParameters value
+        # alone can hold millions of coefficients
+        parameter_file_string = ''.join(
+            '({} {})\n'.format(key, value)
+            for key, value in self.params_dict.items())
 
         result_file = open(self.output_file_name, 'w')
         result_file.write(parameter_file_string)
@@ -6,214 +6,430 @@
 
 from __future__ import division, print_function
 
+import asyncio
 import os, shutil
-import signal
 import subprocess
 import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from . import instrumentation, metaimage, scratch
+from .asynchronous import acquire, run_process, lazy_semaphore
+from .parameter_file import write_overrides
+from .point_sets import write_points, read_output_points
+from .resources import admit, worker_budget, estimate_transformix_memory
 
 logger = logging.getLogger(__name__)
 
 
 DEFAULT_TRANSFORMIX_PATH = 'transformix'
 
+# Number of points transformed by a single transformix process in
+# `transform_point_array`
+POINT_CHUNK_SIZE = 50000
+
+# Outputs transformix can produce: command line flag, base name of the
+# result file, extensions to look for (in order) and a description.
+OUTPUTS = {
+    'image': ('-in', 'result',
+              ['.tiff', '.mhd', '.mha', '.nii'],
+              'Transformed image'),
+    'deformation_field': ('-def', 'deformationField',
+                          ['.mhd', '.dcm', '.tiff', '.nii'],
+                          'Deformation field'),
+    'jacobian_determinant': ('-jac', 'spatialJacobian',
+                             ['.mhd', '.dcm', '.tiff', '.nii', '.mha'],
+                             'Spatial Jacobian determinant'),
+    'jacobian_matrix': ('-jacmat', 'fullSpatialJacobian',
+                        ['.mhd', '.dcm', '.tiff', '.nii'],
+                        'Spatial Jacobian'),
+}
+
 
 class TransformixInterface:
 
     def __init__(self,
                  parameters,
-                 transformix_path=DEFAULT_TRANSFORMIX_PATH
+                 transformix_path=DEFAULT_TRANSFORMIX_PATH,
+                 max_concurrent=None,
+                 scratch_dir=None,
+                 governor=None,
+                 instrumentation=None
                  ):
         self.transformix_path = transformix_path
         self.parameter_file = parameters
+        # Maximum number of processes the *_async methods run at once
+        self.max_concurrent = max_concurrent
+        # Where the private working directory of every run is created;
+        # by default inside its output directory, so results are renamed
+        # into place. scratch.TMPFS stages on tmpfs instead.
+        self.scratch_dir = scratch_dir
+        # Optional ResourceGovernor that admits every run and sets its
+        # number of threads (and CPU affinity)
+        self.governor = governor
+        # Optional Instrumentation that receives structured events of
+        # every transformix process
+        self.instrumentation = instrumentation
+        self._async_semaphore = None
 
     def _execute(self, command, verbose):
         if verbose:
             logger.info('Started command ' + ' '.join(command))
-        err = ''
-
-        # Function to cleanly kill all processes post registration
-        def kill_child(child_pid):  # Sorry if that sounds cruel
-            if child_pid is None:
-                pass
-            else:
-                def kill_function():
-                    try:
-                        os.kill(child_pid, signal.SIGTERM)
-                    except OSError:
-                        logger.info('Child process {}'
-                                    ' already killed.'.format(child_pid))
-                    return kill_function
+            logger.info(command)
 
         # Actually run the command
         try:
-            if not verbose:
-                DEVNULL = open(os.devnull, 'wb')
-                proc = subprocess.Popen(command,
-                                        stderr=subprocess.PIPE,
-                                        stdout=DEVNULL)
-                out, err = proc.communicate()
-            else:
-                logger.info(command)
-                proc = subprocess.Popen(command, stderr=subprocess.PIPE)
-
-            # Register the process to be killed post registration
-            # atexit.register(kill_child(proc.pid))
-            proc.wait()
-
+            returncode, err, tail = instrumentation.run(
+                self.instrumentation, 'transformix', command,
+                None if verbose else subprocess.DEVNULL)
         except Exception as ex:
             raise TransformixError('Quitted with error', ex)
 
         # Check if succesful
-        if proc.returncode != 0:
-            raise TransformixError(proc.returncode, ' '.join(command))
+        if returncode != 0:
+            raise TransformixError(returncode, ' '.join(command), tail)
         if verbose:
             logger.info('Finished command ' + ' '.join(command))
 
-    def deformation_field(self, output_dir=None, verbose=True):
-
-        command = [self.transformix_path,
-                   '-tp', self.parameter_file,
-                   '-out', output_dir,
-                   '-def', 'all'
-                   ]
-
-        self._execute(command, verbose)
-        after = os.listdir(output_dir)
-
-        # Find out to which file the result was written
-        # On Linux, 2D images will result in dcm files, which are empty
-        # On Windows, they should result in tiff files
-        if 'deformationField.mhd' in after:
-            filename = 'deformationField.mhd'
-        elif 'deformationField.dcm' in after:
-            filename = 'deformationField.dcm'
-        elif 'deformationField.tiff' in after:
-            filename = 'deformationField.tiff'
-        elif 'deformationField.nii' in after:
-            filename = 'deformationField.nii'
-        else:
-            TransformixError('Deformation field not found in results folder {}'.format(output_dir))
-        path = os.path.join(output_dir, filename)
-        assert os.path.exists(path)
+    def _find_output(self, output_dir, basename, extensions, description):
+        """
+        Find out to which file a result was written. The file extension
+        depends on the platform and on the parameter file: on Linux, 2D
+        images will result in dcm files, which are empty, on Windows they
+        should result in tiff files. `output_dir` is the private scratch
+        directory of the run, so only files of this run are considered.
+        """
+        path = scratch.find_artifact(output_dir, basename, extensions)
+        if path is None:
+            raise TransformixError('{} not found in results folder {}'.format(
+                description, output_dir))
         return path
 
-    def jacobian_determinant(self, output_dir=None, verbose=True):
-
-        command = [self.transformix_path,
-                   '-tp', self.parameter_file,
-                   '-out', output_dir,
-                   '-jac', 'all'
-                   ]
-
+    def _scratch(self, output_dir=None):
+        # Hidden, so it is not mistaken for a result in output_dir
+        prefix = 'transformix-' if output_dir is None else '.transformix-run-'
+        return scratch.ScratchDir(prefix, self.scratch_dir, near=output_dir)
+
+    def _admit(self, outputs, image_path=None, threads=None):
+        return admit(self.governor, threads,
+                     lambda: estimate_transformix_memory(
+                         self.parameter_file, image_path, outputs))
+
+    async def _acquire_async(self, outputs, image_path=None):
+        """Wait for the governor without blocking the loop."""
+        if self.governor is None:
+            return None
+        loop = asyncio.get_running_loop()
+        memory = await loop.run_in_executor(
+            None, estimate_transformix_memory, self.parameter_file,
+            image_path, outputs)
+        return await acquire(self.governor, None, memory)
+
+    @staticmethod
+    def _allocate(command, allocation):
+        """Apply the threads and pinning of an allocation to a command."""
+        if allocation is None:
+            return command
+        if allocation.threads:
+            command = command + ['-threads', str(allocation.threads)]
+        return allocation.wrap(command)
+
+    def _keep_log(self, work, output_dir):
+        """Promote the log of a failed run, for post-mortems."""
+        log = work.join('transformix.log')
+        if output_dir is not None and os.path.exists(log):
+            work.promote(log, output_dir)
+
+    def deformation_field(self, output_dir=None, verbose=True, load=False):
+        return self.compute(['deformation_field'], output_dir=output_dir,
+                            verbose=verbose, load=load)['deformation_field']
+
+    def jacobian_determinant(self, output_dir=None, verbose=True, load=False):
         assert (os.path.exists(output_dir))
+        return self.compute(['jacobian_determinant'], output_dir=output_dir,
+                            verbose=verbose, load=load)['jacobian_determinant']
 
-        self._execute(command, verbose)
-        after = os.listdir(output_dir)
-
-        # Find out to which file the result was written
-        # On Linux, 2D images will result in dcm files, which are empty
-        # On Windows, they should result in tiff files
-        if 'spatialJacobian.mhd' in after:
-            filename = 'spatialJacobian.mhd'
-        elif 'spatialJacobian.dcm' in after:
-            filename = 'spatialJacobian.dcm'
-        elif 'spatialJacobian.tiff' in after:
-            filename = 'spatialJacobian.tiff'
-        elif 'spatialJacobian.nii' in after:
-            filename = 'spatialJacobian.nii'
-        elif 'spatialJacobian.mha' in after:
-            filename = 'spatialJacobian.mha'
-        else:
-            TransformixError('Spatial Jacobian determinant not found in results folder {}'.format(output_dir))
-        path = os.path.join(output_dir, filename)
-        assert os.path.exists(path)
-        return path
-
-    def jacobian_matrix(self, output_dir=None, verbose=True):
-
-        command = [self.transformix_path,
-                   '-tp', self.parameter_file,
-                   '-out', output_dir,
-                   '-jacmat', 'all']
-
+    def jacobian_matrix(self, output_dir=None, verbose=True, load=False):
         assert (os.path.exists(output_dir))
-
-        self._execute(command, verbose)
-        after = os.listdir(output_dir)
-
-        # Find out to which file the result was written
-        # On Linux, 2D images will result in dcm files, which are empty
-        # On Windows, they should result in tiff files
-        if 'fullSpatialJacobian.mhd' in after:
-            filename = 'fullSpatialJacobian.mhd'
-        elif 'fullSpatialJacobian.dcm' in after:
-            filename = 'fullSpatialJacobian.dcm'
-        elif 'fullSpatialJacobian.tiff' in after:
-            filename = 'fullSpatialJacobian.tiff'
-        elif 'fullSpatialJacobian.nii' in after:
-            filename = 'fullSpatialJacobian.nii'
-        else:
-            TransformixError('Spatial Jacobian not found in results folder {}'.format(output_dir))
-        path = os.path.join(output_dir, filename)
-
-        return path
-
-    def transform_image(self, image_path, output_dir=None, verbose=True):
+        return self.compute(['jacobian_matrix'], output_dir=output_dir,
+                            verbose=verbose, load=load)['jacobian_matrix']
+
+    def transform_image(self, image_path, output_dir=None, verbose=True,
+                        load=False):
+        return self.compute(['image'], image_path=image_path,
+                            output_dir=output_dir, verbose=verbose,
+                            load=load)['image']
+
+    def transform_array(self, image, spacing=None, origin=None,
+                        output_dir=None, verbose=False):
+        """
+        Transform a NumPy array without encoding it into an image file.
+
+        The array is staged as an uncompressed MetaImage in the scratch
+        directory (or referenced in place if it is a memory map of a
+        file), and the result is returned as a read-only `np.memmap` of
+        transformix' output. If `output_dir` is not given, a new temporary
+        directory is used; it is up to the caller to remove it.
+        """
+        if output_dir is None:
+            output_dir = scratch.mkdtemp('transformix-out-', self.scratch_dir)
+
+        with scratch.ScratchDir('transformix-in-', self.scratch_dir) as staging:
+            image_path = metaimage.stage_array(
+                image, staging.join('image.mhd'),
+                spacing=spacing, origin=origin)
+            result = self.compute(['image'], image_path=image_path,
+                                  output_dir=output_dir, verbose=verbose,
+                                  load=True)['image']
+        return result.data
+
+    def compute(self, outputs, image_path=None, output_dir=None, verbose=True,
+                load=False):
+        """
+        Compute several transformix outputs in a single invocation, so the
+        transform is loaded and evaluated over the grid only once.
+
+        Transformix runs in a private scratch directory (a hidden
+        directory in `output_dir`, unless `scratch_dir` is set), from
+        which only the requested outputs are moved to `output_dir`
+        (replacing files of earlier runs); everything else is removed. If
+        the run fails, its transformix.log is kept in `output_dir`.
+
+        Args:
+            outputs: (list) Any of 'image', 'deformation_field',
+                     'jacobian_determinant' and 'jacobian_matrix'.
+            image_path: (str) Image to transform, required for 'image'.
+            output_dir: (str) Directory transformix writes to.
+            load: (bool) If True, transformix is made to write MetaImages
+                  and the outputs are returned as lazily memory-mapped
+                  `MetaImage` objects instead of paths.
+
+        Returns:
+            A dict mapping every requested output to the path of its file,
+            or to a `MetaImage` if `load` is True.
+        """
+        assert (os.path.exists(output_dir))
+        with self._scratch(output_dir) as work, \
+                self._admit(outputs, image_path) as allocation:
+            command = self._allocate(
+                self._prepare(outputs, image_path, work, load), allocation)
+            try:
+                self._execute(command, verbose)
+            except TransformixError:
+                self._keep_log(work, output_dir)
+                raise
+            return self._collect(outputs, work, output_dir, load)
+
+    def _prepare(self, outputs, image_path, work, load):
+        """Build the command for `compute`, writing into `work`."""
+        unknown = set(outputs) - set(OUTPUTS)
+        if unknown:
+            raise ValueError('Unknown transformix outputs: {}'.format(
+                ', '.join(sorted(unknown))))
+        if 'image' in outputs and image_path is None:
+            raise ValueError('An image_path is required to compute the '
+                             'transformed image.')
+
+        parameter_file = self.parameter_file
+        if load:
+            parameter_file = write_overrides(
+                parameter_file, {'ResultImageFormat': 'mhd'},
+                work.join('TransformParameters.txt'))
 
         command = [self.transformix_path,
-                   '-tp', self.parameter_file,
-                   '-out', output_dir,
-                   '-in', image_path]
-
-        self._execute(command, verbose)
-        after = os.listdir(output_dir)
-
-
-        # Find out to which file the result was written
-        if 'result.tiff' in after:
-            filename = 'result.tiff'
-        elif 'result.mhd' in after:
-            filename = 'result.mhd'
-        elif 'result.mha' in after:
-            filename = 'result.mha'
-        elif 'result.nii' in after:
-            filename = 'result.nii'
-        else:
-            TransformixError('Transformed image not found in results folder {}'.format(output_dir))
-
-        path = os.path.join(output_dir, filename)
-        assert os.path.exists(path)
-        return path
+                   '-tp', parameter_file,
+                   '-out', work.path]
+        for name in outputs:
+            if name == 'image':
+                command += [OUTPUTS[name][0], image_path]
+            else:
+                command += [OUTPUTS[name][0], 'all']
+        return command
+
+    def _collect(self, outputs, work, output_dir, load):
+        paths = {}
+        for name in outputs:
+            _, basename, extensions, description = OUTPUTS[name]
+            if load:
+                extensions = ['.mhd']
+            path = work.promote(self._find_output(work.path, basename,
+                                                  extensions, description),
+                                output_dir)
+            paths[name] = metaimage.MetaImage(path) if load else path
+        return paths
+
+    async def _execute_async(self, command):
+        call = instrumentation.call(self.instrumentation, 'transformix',
+                                    command)
+        try:
+            returncode, err = await run_process(
+                command, lazy_semaphore(self, self.max_concurrent), call)
+        except OSError as ex:
+            raise TransformixError('Quitted with error', ex)
+        tail = call.finish(returncode, None, err)
+        if returncode != 0:
+            logger.error(err.decode('utf-8', 'replace'))
+            raise TransformixError(returncode, ' '.join(command), tail)
+
+    async def compute_async(self, outputs, image_path=None, output_dir=None,
+                            load=False):
+        """
+        Asyncio variant of `compute`. The event loop is never blocked, at
+        most `max_concurrent` transformix processes run at the same time,
+        and cancelling the task terminates the transformix process.
+        """
+        assert (os.path.exists(output_dir))
+        with self._scratch(output_dir) as work:
+            allocation = await self._acquire_async(outputs, image_path)
+            try:
+                command = self._allocate(
+                    self._prepare(outputs, image_path, work, load),
+                    allocation)
+                await self._execute_async(command)
+            except TransformixError:
+                self._keep_log(work, output_dir)
+                raise
+            finally:
+                if allocation is not None:
+                    self.governor.release(allocation)
+            return self._collect(outputs, work, output_dir, load)
+
+    async def transform_image_async(self, image_path, output_dir=None,
+                                    load=False):
+        paths = await self.compute_async(['image'], image_path=image_path,
+                                         output_dir=output_dir, load=load)
+        return paths['image']
+
+    async def deformation_field_async(self, output_dir=None, load=False):
+        paths = await self.compute_async(['deformation_field'],
+                                         output_dir=output_dir, load=load)
+        return paths['deformation_field']
+
+    async def jacobian_determinant_async(self, output_dir=None, load=False):
+        paths = await self.compute_async(['jacobian_determinant'],
+                                         output_dir=output_dir, load=load)
+        return paths['jacobian_determinant']
+
+    async def jacobian_matrix_async(self, output_dir=None, load=False):
+        paths = await self.compute_async(['jacobian_matrix'],
+                                         output_dir=output_dir, load=load)
+        return paths['jacobian_matrix']
+
+    async def transform_points_async(self, pointsfile_path, output_dir=None):
+        with self._scratch(output_dir) as work:
+            allocation = await self._acquire_async(['points'])
+            try:
+                command = self._allocate(
+                    self._points_command(pointsfile_path, work), allocation)
+                await self._execute_async(command)
+            except TransformixError:
+                self._keep_log(work, output_dir)
+                raise
+            finally:
+                if allocation is not None:
+                    self.governor.release(allocation)
+            return self._collect_points(work, output_dir)
+
+    def _points_command(self, pointsfile_path, work):
+        return [self.transformix_path,
+                '-tp', self.parameter_file,
+                '-out', work.path,
+                '-def', pointsfile_path]
+
+    def _collect_points(self, work, output_dir):
+        return work.promote(
+            self._find_output(work.path, 'outputpoints', ['.txt', '.vtk'],
+                              'Transformed points'),
+            output_dir)
 
     def transform_points(self,
                          pointsfile_path,
                          output_dir=None,
                          verbose=True):
-        command = [self.transformix_path,
-                   '-tp', self.parameter_file,
-                   '-out', output_dir,
-                   '-def', pointsfile_path]
-
-        self._execute(command, verbose)
-        after = os.listdir(output_dir)
-
-        # Find out to which file the result was written
-        if 'outputpoints.txt' in after:
-            filename = 'outputpoints.txt'
-        elif 'outputpoints.vtk' in after:
-            filename = 'outputpoints.vtk'
+        with self._scratch(output_dir) as work, \
+                self._admit(['points']) as allocation:
+            command = self._allocate(
+                self._points_command(pointsfile_path, work), allocation)
+            try:
+                self._execute(command, verbose)
+            except TransformixError:
+                self._keep_log(work, output_dir)
+                raise
+            return self._collect_points(work, output_dir)
+
+    def _transform_chunk(self, points, kind, threads=None):
+        with self._scratch() as work, \
+                self._admit(['points'], threads=threads) as allocation:
+            pointsfile_path = write_points(work.join('inputpoints.txt'),
+                                           points, kind)
+            command = self._allocate(
+                self._points_command(pointsfile_path, work), allocation)
+            self._execute(command, False)
+            return read_output_points(self._find_output(
+                work.path, 'outputpoints', ['.txt'], 'Transformed points'))
+
+    def transform_point_array(self, points, kind='point',
+                              chunk_size=POINT_CHUNK_SIZE, max_workers=None,
+                              threads_per_job=None):
+        """
+        Transform an (N, D) array of points without writing point files
+        by hand. Large arrays are split into chunks of `chunk_size`
+        points that are transformed by concurrent transformix processes
+        (each admitted by the governor, if there is one).
+
+        Args:
+            points: (ndarray) Physical points, or voxel indices of the
+                    fixed image if `kind` is 'index'.
+            chunk_size: (int) Points per transformix process.
+            max_workers, threads_per_job: Number of concurrent processes
+                                          and the value of their
+                                          `-threads` option, as in
+                                          `ElastixInterface.register_many`:
+                                          by default the processes share
+                                          the cores instead of each
+                                          using all of them.
+
+        Returns:
+            A dict mapping the fields of outputpoints.txt (InputPoint,
+            OutputPoint, Deformation, ...) to (N, D) arrays in the order
+            of `points`.
+        """
+        points = np.asarray(points)
+        if points.ndim != 2:
+            raise ValueError('points must be an (N, D) array')
+        chunk_size = max(1, int(chunk_size))
+        chunks = [points[i:i + chunk_size]
+                  for i in range(0, len(points), chunk_size)]
+        if not chunks:
+            return {}
+        workers, threads = worker_budget(len(chunks), max_workers,
+                                         threads_per_job, self.governor)
+        if workers == 1:
+            results = [self._transform_chunk(chunk, kind, threads)
+                       for chunk in chunks]
         else:
-            TransformixError('Transformed points not found in results folder {}'.format(output_dir))
-        path = os.path.join(output_dir, filename)
-        assert os.path.exists(path)
-        return path
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(
+                    lambda chunk: self._transform_chunk(chunk, kind, threads),
+                    chunks))
+        return dict((name, np.concatenate([r[name] for r in results]))
+                    for name in results[0])
 
 
 class TransformixError(Exception):
     """Exception at error in Transformix command."""
-    def __init__(self, returncode, command):
-        message = ('Transformix crashed with code'
-                   ' {0} for command \'{1}\'.').format(returncode, command)
+    def __init__(self, returncode, command=None, stderr=None):
+        if command is None:
+            message = str(returncode)
+        else:
+            message = ('Transformix crashed with code'
+                       ' {0} for command \'{1}\'.').format(returncode, command)
+        if stderr:
+            message += '\n' + '\n'.join(stderr)
+        self.returncode = returncode
+        # Last lines transformix wrote to stderr
+        self.stderr = stderr or []
         super(TransformixError, self).__init__(message)
         self.message = message
 
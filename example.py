@@ -81,6 +81,14 @@ jacobian_determinant_path = tr.jacobian_determinant(output_dir=r'results')
 # Get the full deformation field
 deformation_field_path = tr.deformation_field(output_dir=r'results')
 
+# Check that the in-process point transform agrees with transformix on
+# random points of the fixed image
+height, width = fixed_image.shape
+points = np.random.uniform(0, 1, (100, 2)) * [width - 1, height - 1]
+difference = elastix.point_transform.validate_against_transformix(
+    transform_path, points, TRANSFORMIX_PATH)
+print('In-process and transformix points differ by at most', difference)
+
 # Add a plot of the Jacobian determinant (in this case, the file is a tiff file)
 ax[3].imshow(imageio.imread(jacobian_determinant_path.replace('dcm', 'tiff')))
 ax[3].set_title('Jacobian\ndeterminant')
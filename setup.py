@@ -12,9 +12,9 @@ This package provides a thin wrapper that allows you to call Elastix and Transfo
     long_description_content_type="text/markdown",
     url="https://github.com/tueimage/elastix-py",
     packages=setuptools.find_packages(),
+    python_requires=">=3.7",
+    install_requires=["numpy"],
     classifiers=[
-        "Programming Language :: Python :: 2.6",
-        "Programming Language :: Python :: 2.7",
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: GNU General Public License v3 (GPLv3)",
         "Operating System :: OS Independent",
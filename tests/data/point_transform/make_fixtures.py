@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+#
+# Regenerates the transformix reference outputs of the point transform
+# tests: <case>.outputpoints.txt is transformix' outputpoints.txt for the
+# transform parameter file <case>.txt applied to points<D>d.txt. Needs the
+# itk-elastix package (pip install itk-elastix), which runs the transformix
+# of the elastix release it bundles in-process.
+
+
+from __future__ import division, print_function
+
+import os
+import shutil
+import tempfile
+
+import itk
+
+
+CASES = {
+    'euler2d': 2, 'euler3d': 3, 'euler3d_zyx': 3,
+    'similarity2d': 2, 'similarity3d': 3,
+    'affine2d': 2, 'affine3d': 3, 'translation3d': 3,
+    'bspline2d': 2, 'bspline3d': 3,
+    'chain_bspline2d': 2, 'chain_add_bspline2d': 2,
+    'deformation2d': 2, 'deformation2d_linear': 2,
+}
+
+
+def main():
+    here = os.path.dirname(os.path.abspath(__file__))
+    # Initial transforms and deformation fields are relative to here
+    os.chdir(here)
+    for case, dimension in sorted(CASES.items()):
+        image = itk.Image[itk.F, dimension].New()
+        region = itk.ImageRegion[dimension]()
+        region.SetSize([4] * dimension)
+        image.SetRegions(region)
+        image.Allocate()
+        output_dir = tempfile.mkdtemp()
+        try:
+            transformix = itk.TransformixFilter[type(image)].New()
+            transformix.SetMovingImage(image)
+            transformix.SetTransformParameterFileName(case + '.txt')
+            transformix.SetFixedPointSetFileName(
+                'points{}d.txt'.format(dimension))
+            transformix.SetOutputDirectory(output_dir)
+            transformix.SetLogToConsole(False)
+            transformix.Update()
+            shutil.copy(os.path.join(output_dir, 'outputpoints.txt'),
+                        case + '.outputpoints.txt')
+        finally:
+            shutil.rmtree(output_dir, ignore_errors=True)
+        print('Wrote', case + '.outputpoints.txt')
+
+
+if __name__ == '__main__':
+    main()
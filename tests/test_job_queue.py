@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+
+
+from __future__ import division, print_function
+
+import time
+
+import pytest
+
+from elastix.job_queue import JobQueue, LeaseLost, DONE, PENDING
+
+
+def test_complete(tmp_path):
+    queue = JobQueue(str(tmp_path / 'queue.db'))
+    queue.submit('register', {'output_dir': str(tmp_path / 'a')})
+    job = queue.claim('w1')
+    queue.complete(job, 'result.txt', 1.0, 'w1')
+    assert queue.jobs(DONE)[0].result == 'result.txt'
+
+
+def test_lease_expires_before_completion(tmp_path):
+    queue = JobQueue(str(tmp_path / 'queue.db'), lease_seconds=0.05)
+    queue.submit('register', {'output_dir': str(tmp_path / 'a')})
+    stale = queue.claim('w1')
+    time.sleep(0.1)
+    fresh = queue.claim('w2')
+    assert fresh.id == stale.id
+
+    assert not queue.renew(stale, 'w1')
+    with pytest.raises(LeaseLost):
+        queue.complete(stale, 'stale.txt', 1.0, 'w1')
+    with pytest.raises(LeaseLost):
+        queue.fail(stale, 'error', 1.0, 'w1')
+    queue.complete(fresh, 'fresh.txt', 1.0, 'w2')
+    assert queue.jobs(DONE)[0].result == 'fresh.txt'
+
+
+def test_lease_reclaimed_by_same_worker(tmp_path):
+    # A worker name is reused after a restart; the claims still differ
+    queue = JobQueue(str(tmp_path / 'queue.db'), lease_seconds=0.05)
+    queue.submit('register', {'output_dir': str(tmp_path / 'a')})
+    stale = queue.claim('w1')
+    time.sleep(0.1)
+    queue.claim('w1')
+    with pytest.raises(LeaseLost):
+        queue.complete(stale, 'stale.txt', 1.0, 'w1')
+    assert queue.status()[PENDING] == 0
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+
+
+from __future__ import division, print_function
+
+import numpy as np
+
+from elastix.log_files import load_iteration_info
+
+
+HEADER = '1:ItNr\t2:Metric\t3a:Time\t3b:StepSize\tTime[ms]\n'
+
+
+def write(tmp_path, text):
+    path = tmp_path / 'IterationInfo.0.R0.txt'
+    path.write_text(text)
+    return str(path)
+
+
+def test_complete_file(tmp_path):
+    table = load_iteration_info(write(
+        tmp_path, HEADER + '0\t-0.5\t1.0\t2.0\t3.5\n1\t-0.6\t1.0\t2.0\t3.1\n'))
+    assert list(table) == ['itnr', 'metric', 'time', 'stepsize', 'time[ms]']
+    np.testing.assert_array_equal(table['itnr'], [0, 1])
+    np.testing.assert_array_equal(table['metric'], [-0.5, -0.6])
+
+
+def test_last_number_cut_off(tmp_path):
+    # The last row is being written: all its columns are there, but its
+    # last number ('3.125') is not complete yet
+    table = load_iteration_info(write(
+        tmp_path, HEADER + '0\t-0.5\t1.0\t2.0\t3.5\n1\t-0.6\t1.0\t2.0\t3.'))
+    np.testing.assert_array_equal(table['itnr'], [0])
+    np.testing.assert_array_equal(table['time[ms]'], [3.5])
+
+
+def test_empty_and_header_only(tmp_path):
+    assert load_iteration_info(write(tmp_path, '')) == {}
+    assert load_iteration_info(write(tmp_path, HEADER[:10])) == {}
+    table = load_iteration_info(write(tmp_path, HEADER))
+    assert len(table['itnr']) == 0
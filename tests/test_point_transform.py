@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+#
+# Compares the in-process point transforms with transformix. The reference
+# outputpoints.txt files in data/point_transform were written by the
+# transformix of elastix 5.2, see data/point_transform/make_fixtures.py.
+
+
+from __future__ import division, print_function
+
+import os
+
+import numpy as np
+import pytest
+
+from elastix.point_sets import read_output_points
+from elastix.point_transform import TransformEvaluator
+
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data',
+                    'point_transform')
+
+CASES = [
+    'euler2d', 'euler3d', 'euler3d_zyx',
+    'similarity2d', 'similarity3d',
+    'affine2d', 'affine3d', 'translation3d',
+    'bspline2d', 'bspline3d',
+    # Chains through InitialTransformParametersFileName
+    'chain_bspline2d', 'chain_add_bspline2d',
+    # Without and with DeformationFieldInterpolationOrder
+    'deformation2d', 'deformation2d_linear',
+]
+
+# outputpoints.txt has six decimals
+TOLERANCE = 1e-4
+
+
+@pytest.mark.parametrize('case', CASES)
+def test_matches_transformix(case, monkeypatch):
+    # Initial transforms and deformation fields are relative paths
+    monkeypatch.chdir(DATA)
+    expected = read_output_points(case + '.outputpoints.txt')
+    actual = TransformEvaluator(case + '.txt')(expected['InputPoint'])
+    np.testing.assert_allclose(actual, expected['OutputPoint'],
+                               rtol=0, atol=TOLERANCE)
+
+
+def test_fixtures_are_displaced():
+    # Guards against reference points that all miss the B-spline grids
+    for case in ('bspline2d', 'bspline3d', 'deformation2d'):
+        points = read_output_points(os.path.join(
+            DATA, case + '.outputpoints.txt'))
+        moved = np.abs(points['Deformation']).max(axis=1) > 1e-3
+        assert moved.sum() >= 10, case